@@ -0,0 +1,190 @@
+import sqlite3
+import time
+import uuid
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+# Twilio rejects bodies over 1600 characters
+MAX_DIGEST_CHARS = 1500
+
+
+class AdminDigest(SqliteStore):
+    SCHEMA = (
+        '''
+            CREATE TABLE IF NOT EXISTS admin_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                details TEXT,
+                created_at REAL NOT NULL,
+                digest_id TEXT,
+                flushed_at REAL
+            )
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS idx_admin_events_digest
+            ON admin_events (digest_id)
+        ''',
+    )
+
+    def __init__(self, db_path: str, outbox, to_number: Optional[str], window: float = 60.0,
+                 schedule_flush: Optional[Callable[[float, str], Any]] = None,
+                 max_chars: int = MAX_DIGEST_CHARS):
+        """
+        Buffers admin notifications and texts them as one digest per window
+
+        Events are stored in the admin_events table as they happen. The first
+        event in a window schedules a flush at the end of that window, which
+        renders every unsent event into a single SMS. With window <= 0 each
+        event is texted on its own, as before.
+
+        Args:
+            db_path: Path to the SQLite database
+            outbox: SmsOutbox the digest is sent through
+            to_number: Admin phone number
+            window: Seconds of events coalesced into one digest
+            schedule_flush: Called with (run_at, dedupe_key) to arrange a
+                flush() at run_at; returns False if nothing would run it, in
+                which case the event is texted straight away
+            max_chars: Longest digest body; the rest are counted as "+N more"
+        """
+        self.db_path = db_path
+        self.outbox = outbox
+        self.to_number = to_number
+        self.window = window
+        self.schedule_flush = schedule_flush
+        self.max_chars = max_chars
+
+        self._init_table()
+
+    def record(self, kind: str, summary: str, details: Optional[str] = None) -> int:
+        """
+        Add an event to the next digest
+
+        Args:
+            kind: Event type (order, payment, pay_request, cancel, batch, signup)
+            summary: One line shown in the digest
+            details: Full text, kept for the event stream
+
+        Returns:
+            int: Event ID
+        """
+        now = time.time()
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO admin_events (kind, summary, details, created_at) VALUES (?, ?, ?, ?)",
+            (kind, summary, details, now)
+        )
+        event_id = c.lastrowid
+        conn.commit()
+        conn.close()
+
+        if self.window <= 0 or not self.schedule_flush:
+            self.flush()
+        else:
+            # One flush per window, at the window's end
+            window_index = int(now // self.window)
+            if self.schedule_flush((window_index + 1) * self.window, f"admin_digest:{window_index}") is False:
+                self.flush()
+
+        return event_id
+
+    def _claim(self) -> tuple:
+        """Mark every unsent event as part of a new digest"""
+        digest_id = uuid.uuid4().hex
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute(
+            "UPDATE admin_events SET digest_id = ?, flushed_at = ? WHERE digest_id IS NULL",
+            (digest_id, time.time())
+        )
+        events = []
+        if c.rowcount:
+            events = c.execute(
+                "SELECT id, kind, summary, details, created_at FROM admin_events WHERE digest_id = ? ORDER BY id",
+                (digest_id,)
+            ).fetchall()
+        conn.commit()
+        conn.close()
+        return digest_id, events
+
+    def render(self, events: List[sqlite3.Row]) -> str:
+        """One SMS body for a list of events"""
+        if len(events) == 1:
+            event = events[0]
+            return event['details'] or event['summary']
+
+        counts = Counter(event['kind'] for event in events)
+        header = "TreeHouse digest: " + ", ".join(f"{count} {kind}" for kind, count in counts.most_common())
+        lines = [header, ""]
+        length = len(header) + 1
+
+        for index, event in enumerate(events):
+            line = f"{datetime.fromtimestamp(event['created_at']).strftime('%H:%M')} {event['summary']}"
+            remaining = len(events) - index
+            # Leave room for the "+N more" line
+            if length + len(line) + 1 > self.max_chars - 40 and remaining > 1:
+                lines.append(f"+{remaining} more at /api/admin/events")
+                break
+            lines.append(line)
+            length += len(line) + 1
+
+        return "\n".join(lines)[:self.max_chars]
+
+    def flush(self) -> int:
+        """
+        Text every unsent event as one digest
+
+        Returns:
+            int: Number of events sent
+        """
+        digest_id, events = self._claim()
+        if not events:
+            return 0
+
+        if self.to_number:
+            self.outbox.enqueue(
+                self.to_number,
+                self.render(events),
+                kind='admin_digest',
+                dedupe_key=f"admin_digest:{digest_id}"
+            )
+            logger.info(f"Admin digest queued with {len(events)} events")
+        else:
+            logger.warning(f"No admin number set; {len(events)} admin events not texted")
+        return len(events)
+
+    def events(self, since_id: int = 0, limit: int = 100, kind: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Raw events after since_id, oldest first"""
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        query = "SELECT id, kind, summary, details, created_at, digest_id, flushed_at FROM admin_events WHERE id > ?"
+        params = [since_id]
+        if kind:
+            query += " AND kind = ?"
+            params.append(kind)
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit)
+        rows = conn.execute(query, params).fetchall()
+        conn.close()
+
+        return [
+            {
+                "id": row['id'],
+                "kind": row['kind'],
+                "summary": row['summary'],
+                "details": row['details'],
+                "created_at": datetime.fromtimestamp(row['created_at']).isoformat(),
+                "sent": row['digest_id'] is not None,
+                "sent_at": datetime.fromtimestamp(row['flushed_at']).isoformat() if row['flushed_at'] else None
+            }
+            for row in rows
+        ]
@@ -1,5 +1,6 @@
 import os
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 from dotenv import load_dotenv
 import logging
 from datetime import datetime, timedelta
@@ -7,14 +8,37 @@ from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 import sqlite3
 from twilio.twiml.messaging_response import MessagingResponse
+from twilio.request_validator import RequestValidator
 import stripe
+import click
 import openai
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+import functools
+import hmac
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
 
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from leader_lock import LeaderLease
+from job_queue import DurableJobQueue
+from sms_outbox import SmsOutbox
+from admin_digest import AdminDigest
+from webhook_dedupe import WebhookDedupe
+from sms_rate_limit import SmsRateLimiter
+from sms_segments import SmsRenderer
+from stripe_catalog import StripeCatalog
+from stripe_events import StripeEventStore
+from checkout_sessions import CheckoutSessionIndex, load_export
+from scheduler_metrics import RollingStats, SchedulerMetrics
+
 try:
-    from uber_direct_delivery import UberDirectDelivery, prepare_batch_for_delivery
+    from uber_direct_delivery import UberDirectBase, UberDirectDelivery, load_batch_routes, prepare_batch_for_delivery
     UBER_DIRECT_AVAILABLE = True
 except ImportError:
     UBER_DIRECT_AVAILABLE = False
@@ -23,12 +47,18 @@ except ImportError:
 # Load environment variables
 load_dotenv()
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
 active_sessions = {}  # Store active ordering sessions by phone number
 
+# One session is only changed under its phone's lock, so a deferred AI reply
+# can't interleave with the next inbound text. Striped to bound memory;
+# reentrant because a reply that finishes just after its budget is delivered
+# on the webhook thread that already holds the lock
+_session_locks = [threading.RLock() for _ in range(64)]
+
+def session_lock(phone_number):
+    """Lock guarding active_sessions[phone_number]"""
+    return _session_locks[hash(phone_number) % len(_session_locks)]
+
 app = Flask(__name__)
 CORS(app)
 
@@ -130,6 +160,9 @@ def init_db():
             status TEXT NOT NULL DEFAULT 'scheduled',
             driver_name TEXT,
             driver_phone TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_result TEXT,
+            claimed_at REAL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
@@ -144,7 +177,37 @@ def init_db():
             FOREIGN KEY (order_id) REFERENCES orders (id)
         )
     ''')
-    
+
+    # Lets the scheduler find pending batches without scanning the whole table
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_delivery_batches_status_time
+        ON delivery_batches (status, delivery_time)
+    ''')
+
+    # Checkout links look up the customer's open order
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_user_status
+        ON orders (user_id, status)
+    ''')
+
+    # One payment per Stripe checkout session, however often the webhook or
+    # reconciliation sees it; databases with the old plain index are upgraded
+    c.execute("PRAGMA index_list(payments)")
+    payment_indexes = {row[1]: row[2] for row in c.fetchall()}
+    if not payment_indexes.get('idx_payments_transaction_id'):
+        c.execute("DROP INDEX IF EXISTS idx_payments_transaction_id")
+        try:
+            c.execute('''
+                CREATE UNIQUE INDEX idx_payments_transaction_id
+                ON payments (transaction_id)
+            ''')
+        except sqlite3.IntegrityError:
+            logger.error("Duplicate payments.transaction_id values; keeping a non-unique index until they are cleaned up")
+            c.execute('''
+                CREATE INDEX idx_payments_transaction_id
+                ON payments (transaction_id)
+            ''')
+
     # Batch tracking table
     c.execute('''
         CREATE TABLE IF NOT EXISTS batch_tracking (
@@ -182,6 +245,19 @@ def update_database_schema():
         c.execute("ALTER TABLE users ADD COLUMN opt_in_timestamp TIMESTAMP")
         logger.info("Added opt_in_timestamp column to users table")
     
+    # Dispatch attempts per batch, so a batch that keeps failing stops
+    c.execute("PRAGMA table_info(delivery_batches)")
+    batch_columns = [column[1] for column in c.fetchall()]
+    if 'attempts' not in batch_columns:
+        c.execute("ALTER TABLE delivery_batches ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        c.execute("ALTER TABLE delivery_batches ADD COLUMN last_result TEXT")
+        logger.info("Added attempts and last_result columns to delivery_batches table")
+    
+    # When a worker claimed the batch, so one that died mid-dispatch is noticed
+    if 'claimed_at' not in batch_columns:
+        c.execute("ALTER TABLE delivery_batches ADD COLUMN claimed_at REAL")
+        logger.info("Added claimed_at column to delivery_batches table")
+    
     conn.commit()
     conn.close()
     logger.info("Database schema updated for consent tracking")
@@ -196,17 +272,47 @@ auth_token = os.getenv('TWILIO_AUTH_TOKEN')
 twilio_phone = os.getenv('TWILIO_PHONE_NUMBER')
 notification_email = os.getenv('NOTIFICATION_EMAIL')
 
+# Seconds an outbox claim lasts before another sender may retry the message
+SMS_STALE_SECONDS = float(os.getenv('SMS_STALE_SECONDS', 120))
+# Twilio calls give up well before the claim goes stale, so a hung send is
+# never still running when another worker sends the same message
+TWILIO_HTTP_TIMEOUT = min(float(os.getenv('TWILIO_HTTP_TIMEOUT', 30)), SMS_STALE_SECONDS / 2)
+
 # Twilio setup
 twilio_client = None  # Rename this
 if account_sid and auth_token:
     try:
-        twilio_client = Client(account_sid, auth_token)  # Use twilio_client
+        twilio_client = Client(account_sid, auth_token, http_client=TwilioHttpClient(timeout=TWILIO_HTTP_TIMEOUT))  # Use twilio_client
         logger.info("Twilio client initialized successfully")
     except Exception as e:
         logger.error(f"Error initializing Twilio client: {e}")
 else:
     logger.warning("Twilio credentials not found or incomplete")
 
+# Texts are queued here and sent by a background worker pool, so request
+# handlers never wait on a Twilio round trip
+sms_outbox = SmsOutbox(
+    'treehouse.db',
+    twilio_client,
+    twilio_phone,
+    max_workers=int(os.getenv('SMS_WORKERS', 4)),
+    max_attempts=int(os.getenv('SMS_MAX_ATTEMPTS', 5)),
+    stale_after=SMS_STALE_SECONDS,
+    status_callback_url=os.getenv('TWILIO_STATUS_CALLBACK_URL'),
+    on_complete=lambda kind, lag, duration, outcome: scheduler_metrics.record_job(f"sms:{kind}", lag, duration, outcome)
+)
+
+# TwiML replies use the richest template variant within this many segments
+# (GSM-7: 160 characters, 153 per part; any emoji or other non-GSM character
+# switches the whole message to UCS-2: 70, 67 per part)
+# The full menu with its how-to-order steps runs 4-7 segments for 1-7
+# restaurants, so it gets a larger budget; the compact form (same times,
+# fees and free items, without the steps) is for longer lists
+sms_renderer = SmsRenderer(
+    default_budget=int(os.getenv('SMS_SEGMENT_BUDGET', 3)),
+    budgets={'menu': int(os.getenv('SMS_MENU_SEGMENT_BUDGET', 7))}
+)
+
 
 # Stripe setup
 stripe_secret_key = os.getenv('STRIPE_SECRET_KEY')
@@ -218,6 +324,16 @@ else:
 
 stripe.api_version = "2025-03-31.basil"
 
+# PAY now creates a checkout session inside the SMS webhook, so a slow
+# Stripe call must give up well before Twilio's 15 second timeout
+stripe.default_http_client = stripe.new_default_http_client(timeout=float(os.getenv('STRIPE_TIMEOUT_SECONDS', 8)))
+
+# Checkout prices are created once per delivery fee and reused
+stripe_catalog = StripeCatalog('treehouse.db')
+
+# Which order and customer each checkout session is for
+checkout_index = CheckoutSessionIndex('treehouse.db')
+
 # OpenAI setup
 openai_api_key = os.getenv('OPENAI_API_KEY')
 if openai_api_key:
@@ -390,12 +506,8 @@ def signup():
                     f"Reply STOP at any time to unsubscribe. Msg & data rates may apply."
                 )
                 
-                message = twilio_client.messages.create(
-                    body=welcome_message,
-                    from_=twilio_phone,  # Send from your Twilio number
-                    to=f"+{clean_phone}"  # Send to the new user's phone number
-                )
-                logger.info(f"Welcome message sent: {message.sid}")
+                message_id = sms_outbox.enqueue(f"+{clean_phone}", welcome_message, kind='welcome')
+                logger.info(f"Welcome message queued: {message_id}")
 
                 # Notify admin via SMS (admin's phone number)
                 admin_message = (
@@ -404,13 +516,12 @@ def signup():
                     f"SMS consent: {'Yes' if sms_consent else 'No'}"
                 )
                 
-                # Send the admin notification SMS (admin's phone number is stored in notification_email)
-                twilio_client.messages.create(
-                    body=admin_message,
-                    from_=twilio_phone,  # Use your Twilio number to send the message
-                    to=f"+{notification_email}"  # Admin's phone number (in E.164 format)
+                # Goes out in the next admin digest
+                admin_digest.record(
+                    'signup',
+                    f"Signup {phone_number} ({dorm_building or 'no building'})",
+                    admin_message
                 )
-                logger.info(f"Admin notification sent for new signup")
                 
             except Exception as e:
                 logger.error(f"Error sending notification: {e}")
@@ -545,28 +656,15 @@ def create_order():
                 "INSERT INTO batch_orders (batch_id, order_id) VALUES (?, ?)",
                 (batch_id, order_id)
             )
-        
+
         conn.commit()
-        
-        # Send notification via Twilio
-        if twilio_client:
-            try:
-                # Get user info for notification
-                c.execute("SELECT phone_number FROM users WHERE id = ?", (user_id,))
-                user_result = c.fetchone()
-                user_phone = user_result[0] if user_result else "Unknown"
-                
-                message = twilio_client.messages.create(
-                    body=f"New TreeHouse order! Order ID: {order_id}, Amount: ${total_amount:.2f}, User: {user_phone}",
-                    from_=twilio_phone,
-                    to=notification_email
-                )
-                logger.info(f"Order notification sent: {message.sid}")
-            except Exception as e:
-                logger.error(f"Error sending order notification: {e}")
-        
-        # Inside your create_order function, add this before conn.close()
-        # Send detailed notification to admin
+
+        # Register the close job for a newly created batch so it is processed
+        # as soon as its window closes
+        if scheduled_time and not batch_result:
+            schedule_batch_close(batch_id, scheduled_time)
+
+        # Send detailed notification to admin (one digest event per order)
         if twilio_client:
             try:
                 # Get user details
@@ -631,13 +729,13 @@ def create_order():
                     time_str = scheduled_dt.strftime("%I:%M %p on %m/%d/%Y")
                     admin_note += f"\nScheduled for: {time_str}"
                 
-                # Send to your notification number
-                twilio_client.messages.create(
-                    body=admin_note,
-                    from_=twilio_phone,
-                    to=notification_email  # Make sure this is your phone number
+                admin_digest.record(
+                    'order',
+                    f"Web order #{order_id} ${total_amount:.2f} {', '.join(restaurants) or 'no items'} "
+                    f"for {user_name} ({dorm}, Room {room})",
+                    admin_note
                 )
-                logger.info(f"Admin order notification sent for order #{order_id}")
+                logger.info(f"Admin order notification recorded for order #{order_id}")
             except Exception as e:
                 logger.error(f"Error sending detailed admin notification: {e}")
         
@@ -772,11 +870,24 @@ def process_payment():
             conn.close()
             return jsonify({"error": f"Payment amount (${payment_amount:.2f}) is less than order total (${order_total:.2f})"}), 400
         
-        # Record payment
+        # Record payment; a retried request with the same transaction_id
+        # hits the unique index and gets the payment already recorded
         c.execute(
-            "INSERT INTO payments (order_id, amount, payment_method, transaction_id, status) VALUES (?, ?, ?, ?, 'completed')",
+            "INSERT OR IGNORE INTO payments (order_id, amount, payment_method, transaction_id, status) VALUES (?, ?, ?, ?, 'completed')",
             (order_id, amount, payment_method, transaction_id)
         )
+        if c.rowcount == 0:
+            c.execute("SELECT id, order_id FROM payments WHERE transaction_id = ?", (transaction_id,))
+            existing_id, existing_order_id = c.fetchone()
+            conn.close()
+            
+            if str(existing_order_id) != str(order_id):
+                return jsonify({"error": f"Transaction {transaction_id} is already recorded for another order"}), 409
+            return jsonify({
+                "success": True,
+                "message": "Payment already recorded",
+                "payment_id": existing_id
+            }), 200
         payment_id = c.lastrowid
         
         # Update order status
@@ -793,12 +904,11 @@ def process_payment():
                 user_result = c.fetchone()
                 user_phone = user_result[0] if user_result else "Unknown"
                 
-                message = twilio_client.messages.create(
-                    body=f"Payment received! Order ID: {order_id}, Amount: ${payment_amount:.2f}, User: {user_phone}",
-                    from_=twilio_phone,
-                    to=notification_email
+                admin_digest.record(
+                    'payment',
+                    f"Paid order #{order_id} ${payment_amount:.2f} ({user_phone})",
+                    f"Payment received! Order ID: {order_id}, Amount: ${payment_amount:.2f}, User: {user_phone}"
                 )
-                logger.info(f"Payment notification sent: {message.sid}")
             except Exception as e:
                 logger.error(f"Error sending payment notification: {e}")
         
@@ -1425,8 +1535,14 @@ Your tone should be friendly, helpful, and efficient while maintaining the integ
        logger.error(f"Error using OpenAI for response generation: {e}")
        return "I'm having trouble processing that right now. Please try texting ORDER followed by what you want, or text MENU to see options."
 
-def format_batch_info(batches):
-    """Format the batch information for text message display"""
+def format_batch_info(batches, compact=False):
+    """
+    Format the batch information for text message display
+    
+    Args:
+        batches: Current batches from get_current_batches
+        compact: Short form that fits in far fewer SMS segments
+    """
     if not batches:
         return "No current batches available. Please try again later."
     
@@ -1451,6 +1567,17 @@ def format_batch_info(batches):
     
     food_time_str = food_ready_time.strftime("%I:%M %p")
     
+    if compact:
+        response = f"TreeHouse: order {order_window} for food at {food_time_str}\n"
+        for batch in batches:
+            free_item = batch.get('free_item', 'Free item')
+            response += (
+                f"- {batch['restaurant_name']} ({batch_time_str}) ${batch['delivery_fee']:.2f} fee, "
+                f"{batch['current_orders']}/{batch['max_orders']} spots, share & get {free_item}\n"
+            )
+        response += "Order PICKUP from the restaurant, then text ORDER + restaurant name."
+        return response
+    
     # Format the response with strict ordering window
     response = f"TreeHouse Options (Order within the {order_window} window to get food at {food_time_str}):\n\n"
     
@@ -1463,7 +1590,7 @@ def format_batch_info(batches):
         
         response += f"- {restaurant} ({batch_time_str}) [${fee:.2f} fee, {current_orders}/{max_orders} spots] - Share & get {free_item}\n"
     
-    response += "\n📱 IMPORTANT - HOW TO ORDER:\n"
+    response += "\nIMPORTANT - HOW TO ORDER:\n"
     response += "1. First, place your order directly with the restaurant (via their app/website/phone) and select PICKUP (NOT DELIVERY)\n"
     response += "2. Then text \"ORDER\" followed by the restaurant name to us\n"
     response += "3. We'll ask for your order number/name and pickup location\n"
@@ -1472,6 +1599,77 @@ def format_batch_info(batches):
     
     return response
 
+def find_open_order(user_id):
+    """Most recent pending order for a user, or None"""
+    conn = sqlite3.connect('treehouse.db')
+    c = conn.cursor()
+    c.execute(
+        "SELECT id FROM orders WHERE user_id = ? AND status = 'pending' ORDER BY created_at DESC LIMIT 1",
+        (user_id,)
+    )
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def create_order_checkout(phone_number, user_id, delivery_fee, success_url=None, cancel_url=None, metadata=None):
+    """
+    Create a Stripe Checkout Session for one customer's order
+    
+    The price comes from stripe_catalog, so this is a single Stripe call. The
+    session is stored in checkout_index with the order it pays for, so the
+    payment can be matched to the order later by session id.
+    
+    Args:
+        phone_number: Customer phone number (digits only)
+        user_id: Customer's user ID
+        delivery_fee: Delivery fee in dollars
+        success_url: Redirect after paying (defaults to /payment-success)
+        cancel_url: Redirect if the customer backs out (defaults to /payment-cancel)
+        metadata: Extra session metadata
+        
+    Returns:
+        stripe.checkout.Session: Session with the payment URL
+    """
+    order_id = find_open_order(user_id) if user_id else None
+    session_metadata = {
+        'phone_number': phone_number,
+        'user_id': str(user_id),
+        'includes_delivery_fee': 'true',
+        **(metadata or {})
+    }
+    if order_id:
+        session_metadata['order_id'] = str(order_id)
+    
+    checkout_session = stripe_catalog.create_checkout_session(
+        delivery_fee,
+        success_url=success_url or request.url_root + 'payment-success?session_id={CHECKOUT_SESSION_ID}',
+        cancel_url=cancel_url or request.url_root + 'payment-cancel',
+        metadata=session_metadata,
+        custom_text={
+            'submit': {'message': 'Pay for order'}
+        }
+    )
+    
+    # The SMS order only lives in active_sessions, so keep what it was
+    phone_session = active_sessions.get(phone_number, {})
+    batch_info = phone_session.get('batch_info') or {}
+    try:
+        checkout_index.record(
+            checkout_session.id,
+            user_id,
+            phone_number,
+            delivery_fee,
+            order_id=order_id,
+            restaurant=phone_session.get('restaurant'),
+            order_text=phone_session.get('order_text'),
+            batch_time=str(batch_info['batch_time']) if batch_info.get('batch_time') else None,
+            location=batch_info.get('location')
+        )
+    except Exception as e:
+        logger.error(f"Error storing checkout session {checkout_session.id}: {e}")
+    
+    return checkout_session
+
 def ai_process_order(order_text, phone_number):
    """
    Process an order request using AI
@@ -1720,6 +1918,122 @@ def is_menu_request(message):
     return False
 
 
+# One Uber Direct client is shared by every batch worker
+_uber_direct_client = None
+_uber_direct_client_lock = threading.Lock()
+
+def get_uber_api_credentials():
+    return {
+        "client_id": os.getenv('UBER_CLIENT_ID'),
+        "client_secret": os.getenv('UBER_CLIENT_SECRET'),
+        "customer_id": os.getenv('UBER_CUSTOMER_ID')
+    }
+
+def get_uber_direct_client(api_credentials):
+    """
+    Get the process-wide UberDirectDelivery client, creating it on first use
+    
+    Args:
+        api_credentials: Dictionary with client_id, client_secret and customer_id
+        
+    Returns:
+        UberDirectDelivery: Shared client (or its asyncio equivalent when
+        UBER_DIRECT_ASYNC=1)
+    """
+    global _uber_direct_client
+    
+    with _uber_direct_client_lock:
+        if _uber_direct_client is None:
+            options = dict(
+                client_id=api_credentials["client_id"],
+                client_secret=api_credentials["client_secret"],
+                customer_id=api_credentials["customer_id"],
+                test_mode=True,  # Set to False for production
+                auth_url=os.getenv('UBER_AUTH_URL', 'https://auth.uber.com/oauth/v2/token'),
+                api_base_url=os.getenv('UBER_API_BASE_URL', 'https://api.uber.com'),
+                pool_size=int(os.getenv('UBER_HTTP_POOL_SIZE', 20)),
+                connect_timeout=float(os.getenv('UBER_CONNECT_TIMEOUT', 3.05)),
+                read_timeout=float(os.getenv('UBER_READ_TIMEOUT', 15)),
+                token_cache_path=os.getenv('UBER_TOKEN_CACHE_PATH'),
+                proactive_token_refresh=os.getenv('UBER_TOKEN_BACKGROUND_REFRESH', '1') == '1',
+                rate_limit=float(os.getenv('UBER_RATE_LIMIT', 5)),
+                rate_burst=int(os.getenv('UBER_RATE_BURST', 10)),
+                max_concurrency=int(os.getenv('UBER_MAX_CONCURRENCY', 5)),
+                multi_pickup=os.getenv('UBER_DIRECT_MULTI_PICKUP') == '1',
+                consolidation_radius_m=float(os.getenv('UBER_CONSOLIDATION_RADIUS_M', 150)),
+                locations_path=os.getenv('UBER_LOCATIONS_PATH')
+            )
+            
+            if os.getenv('UBER_DIRECT_ASYNC') == '1':
+                # Imported here so aiohttp is only needed when enabled
+                from uber_direct_async import AsyncUberDirectDelivery, BlockingAsyncUberDirect
+                _uber_direct_client = BlockingAsyncUberDirect(AsyncUberDirectDelivery(**options))
+                logger.info("Using asyncio Uber Direct client")
+            else:
+                _uber_direct_client = UberDirectDelivery(**options)
+        return _uber_direct_client
+
+
+def estimate_delivery_fee(restaurant_name, destination_name=None, batch_time=None, dorm_building=None):
+    """
+    Estimate the Uber Direct fee for a restaurant, reusing cached quotes
+    
+    Args:
+        restaurant_name: Name of the restaurant
+        destination_name: Campus drop-off building (defaults to the one
+            nearest dorm_building, as process_batch would pick)
+        batch_time: Batch the order is in; its delivery windows are part of
+            the cache key, so the batch later books with this quote
+        dorm_building: Customer's stated building
+        
+    Returns:
+        dict: Fee estimate, or None if Uber Direct is unavailable
+    """
+    if not UBER_DIRECT_AVAILABLE:
+        return None
+    
+    api_credentials = get_uber_api_credentials()
+    if not all(api_credentials.values()):
+        return None
+    
+    try:
+        client = get_uber_direct_client(api_credentials)
+        if restaurant_name not in client.restaurant_locations:
+            return None
+        
+        destination_name = destination_name or client.dropoff_for(dorm_building)
+        delivery_windows = None
+        if batch_time:
+            # Same conversion as plan_batch, so the windows match the batch's
+            if isinstance(batch_time, str):
+                batch_time = datetime.fromisoformat(batch_time.replace('Z', '+00:00'))
+            delivery_windows = client.get_delivery_windows(batch_time)
+        
+        return client.estimate_fee(restaurant_name, destination_name, delivery_windows)
+    except Exception as e:
+        logger.error(f"Error estimating delivery fee for {restaurant_name}: {e}")
+        return None
+
+def warm_delivery_quote(user_id, restaurant_name, batch_info):
+    """
+    Quote a new text order's route in the background
+    
+    The quote is cached for the customer's drop-off and batch window, so
+    dispatching the batch reuses it instead of requesting one then.
+    """
+    conn = sqlite3.connect('treehouse.db')
+    row = conn.execute("SELECT dorm_building FROM users WHERE id = ?", (user_id,)).fetchone()
+    conn.close()
+    
+    estimate = estimate_delivery_fee(
+        restaurant_name,
+        batch_time=(batch_info or {}).get('batch_time'),
+        dorm_building=row[0] if row else None
+    )
+    if estimate:
+        logger.info(f"Quoted {restaurant_name} for user {user_id}: {estimate['fee']} (cached: {estimate['cached']})")
+
+
 def process_batch_delivery(batch_id):
     """
     Process a batch delivery using Uber Direct
@@ -1736,11 +2050,7 @@ def process_batch_delivery(batch_id):
         return "Error: Uber Direct module not available"
     
     # Load Uber Direct API credentials from environment variables
-    api_credentials = {
-        "client_id": os.getenv('UBER_CLIENT_ID'),
-        "client_secret": os.getenv('UBER_CLIENT_SECRET'),
-        "customer_id": os.getenv('UBER_CUSTOMER_ID')
-    }
+    api_credentials = get_uber_api_credentials()
     
     # Check if credentials are available
     if not all(api_credentials.values()):
@@ -1757,84 +2067,135 @@ def process_batch_delivery(batch_id):
         
         # Check if we have any restaurants with orders
         if not batch_data.get('restaurants'):
+            # An earlier attempt may have booked every order before failing
+            c = conn.cursor()
+            c.execute("""
+                SELECT COUNT(*) FROM orders o JOIN batch_orders bo ON o.id = bo.order_id
+                WHERE bo.batch_id = ? AND o.status = 'in_delivery'
+            """, (batch_id,))
+            if c.fetchone()[0]:
+                c.execute("UPDATE delivery_batches SET status = 'in_progress' WHERE id = ?", (batch_id,))
+                conn.commit()
+                logger.info(f"Batch {batch_id} has no orders left to book; marking it in progress")
+                return "Success"
+            
             logger.info(f"Batch {batch_id} has no restaurant orders to process")
             conn.close()
             return "No orders to process"
         
-        # Create Uber Direct client
-        uber_direct = UberDirectDelivery(
-            client_id=api_credentials["client_id"],
-            client_secret=api_credentials["client_secret"],
-            customer_id=api_credentials["customer_id"],
-            test_mode=True  # Set to False for production
-        )
+        # Reuse the shared Uber Direct client
+        uber_direct = get_uber_direct_client(api_credentials)
         
         # Process the batch
         deliveries = uber_direct.process_batch(batch_data)
         
-        # Update order statuses in database
-        c = conn.cursor()
-        for restaurant, delivery_data in deliveries.items():
-            for order in delivery_data["orders"]:
-                c.execute(
-                    "UPDATE orders SET status = 'in_delivery' WHERE id = ?",
-                    (order["order_id"],)
-                )
-                
-                # Send tracking URL to customer
-                if twilio_client and 'delivery' in delivery_data and 'tracking_url' in delivery_data['delivery']:
-                    try:
-                        # Get customer phone number
-                        c.execute("""
-                            SELECT u.phone_number 
-                            FROM users u 
-                            JOIN orders o ON u.id = o.user_id 
-                            WHERE o.id = ?
-                        """, (order["order_id"],))
-                        
-                        user_result = c.fetchone()
-                        if user_result and user_result[0]:
-                            user_phone = user_result[0]
-                            tracking_message = (
-                                f"Your {restaurant} order is now with Uber! "
-                                f"Track your delivery here: {delivery_data['delivery']['tracking_url']}\n\n"
-                                f"Your food will arrive at {delivery_data['destination']} shortly."
-                            )
-                            
-                            twilio_client.messages.create(
-                                body=tracking_message,
-                                from_=twilio_phone,
-                                to=f"+{user_phone}"
-                            )
-                    except Exception as e:
-                        logger.error(f"Error sending tracking URL: {e}")
+        # Every restaurant failed: nothing was booked, so leave the orders
+        # and batch alone for a retry
+        if not deliveries:
+            logger.error(f"Batch {batch_id}: no Uber Direct deliveries were created")
+            return "Error: no deliveries created"
+        
+        # Restaurants whose delivery still failed after retries
+        booked = {order["order_id"] for delivery_data in deliveries.values() for order in delivery_data["orders"]}
+        missing = {
+            order["order_id"]: restaurant
+            for restaurant, orders in batch_data['restaurants'].items()
+            for order in orders if order["order_id"] not in booked
+        }
         
-        # Update batch status
-        c.execute(
-            "UPDATE delivery_batches SET status = 'in_progress' WHERE id = ?",
-            (batch_id,)
+        # Update order and batch statuses in one transaction. With a
+        # shortfall the batch stays claimed and run_batch sends it back for
+        # a retry, which only books the orders that are not in delivery
+        c = conn.cursor()
+        c.executemany(
+            "UPDATE orders SET status = 'in_delivery' WHERE id = ?",
+            [(order_id,) for order_id in booked]
         )
+        if not missing:
+            c.execute(
+                "UPDATE delivery_batches SET status = 'in_progress' WHERE id = ?",
+                (batch_id,)
+            )
+        
+        # Every customer's phone number in one query
+        c.execute("""
+            SELECT o.id, u.phone_number
+            FROM orders o
+            JOIN batch_orders bo ON o.id = bo.order_id
+            JOIN users u ON o.user_id = u.id
+            WHERE bo.batch_id = ?
+        """, (batch_id,))
+        phone_numbers = dict(c.fetchall())
         
+        # Commit before any texting so the write lock isn't held while
+        # messages are queued
         conn.commit()
         
+        # Send tracking URL to customers through the outbox worker pool;
+        # each message's outcome is kept in outbound_messages
+        if twilio_client:
+            tracking_messages = []
+            for delivery_data in deliveries.values():
+                tracking_url = delivery_data.get('delivery', {}).get('tracking_url')
+                if not tracking_url:
+                    continue
+                
+                for order in delivery_data["orders"]:
+                    user_phone = phone_numbers.get(order["order_id"])
+                    if not user_phone:
+                        continue
+                    
+                    # Consolidated deliveries carry orders from several restaurants
+                    restaurant = order.get("restaurant", delivery_data["restaurant"])
+                    tracking_messages.append({
+                        "to_number": f"+{user_phone}",
+                        "body": (
+                            f"Your {restaurant} order is now with Uber! "
+                            f"Track your delivery here: {tracking_url}\n\n"
+                            f"Your food will arrive at {delivery_data['destination']} shortly."
+                        ),
+                        "kind": 'tracking',
+                        # Keyed so a re-run of the batch doesn't text twice
+                        "dedupe_key": f"tracking:{batch_id}:{order['order_id']}"
+                    })
+            
+            try:
+                queued = sms_outbox.enqueue_many(tracking_messages)
+                logger.info(f"Queued {queued} tracking texts for batch {batch_id}")
+            except Exception as e:
+                logger.error(f"Error sending tracking URLs for batch {batch_id}: {e}")
+        
         # Send admin notification
         if twilio_client:
             try:
                 admin_notification = (
                     f"Batch {batch_id} processed!\n\n"
-                    f"Delivery set for {batch_data['location']}\n"
-                    f"Restaurants: {', '.join(deliveries.keys())}\n"
-                    f"Total orders: {sum(len(data['orders']) for _, data in deliveries.items())}"
+                    f"Drop-offs: {', '.join(sorted({data['destination'] for data in deliveries.values()}))}\n"
+                    f"Restaurants: {', '.join(sorted({name for data in deliveries.values() for name in data['restaurants']}))}\n"
+                    f"Couriers: {len(deliveries)}\n"
+                    f"Total orders: {len(booked)}"
                 )
+                summary = f"Batch {batch_id} dispatched: {len(booked)} orders, {len(deliveries)} couriers"
                 
-                twilio_client.messages.create(
-                    body=admin_notification,
-                    from_=twilio_phone,
-                    to=notification_email
-                )
+                if missing:
+                    failed_restaurants = ', '.join(sorted(set(missing.values())))
+                    admin_notification += (
+                        f"\n\nNOT BOOKED: {len(missing)} orders from {failed_restaurants}. "
+                        f"The batch will be retried for these orders."
+                    )
+                    summary += f"; {len(missing)} orders not booked ({failed_restaurants}), retrying"
+                
+                admin_digest.record('batch', summary, admin_notification)
+                # Batch close always sends what has built up, rather than
+                # waiting for the end of the window
+                admin_digest.flush()
             except Exception as e:
                 logger.error(f"Error sending admin notification: {e}")
         
+        if missing:
+            logger.error(f"Batch {batch_id}: {len(missing)} of {len(booked) + len(missing)} orders were not booked")
+            return f"Error: {len(missing)} of {len(booked) + len(missing)} orders not booked ({', '.join(sorted(set(missing.values())))})"
+        
         return "Success"
     
     except Exception as e:
@@ -1850,96 +2211,949 @@ def process_batch_delivery(batch_id):
 # Initialize the scheduler
 scheduler = BackgroundScheduler()
 
-def check_and_process_batches():
+# Lag, duration and outcome of every scheduler and job queue run
+scheduler_metrics = SchedulerMetrics(window=float(os.getenv('SCHEDULER_METRICS_WINDOW', 3600)))
+scheduler_metrics.attach(scheduler)
+
+# The minute-by-minute scan is only a safety net now; batches register their
+# own close job when they are created
+BATCH_SAFETY_NET_MINUTES = int(os.getenv('BATCH_SAFETY_NET_MINUTES', 15))
+
+# Durable delayed work (batch close, follow-up texts). Any worker can
+# enqueue; only the scheduler leader dispatches. Jobs enqueued by other
+# workers are picked up at the next poll (JOB_QUEUE_POLL_SECONDS).
+job_queue = DurableJobQueue(
+    'treehouse.db',
+    refresh_interval=float(os.getenv('JOB_QUEUE_POLL_SECONDS', 60)),
+    max_workers=int(os.getenv('JOB_WORKERS', 4)),
+    on_complete=lambda kind, lag, duration, outcome: scheduler_metrics.record_job(f"queue:{kind}", lag, duration, outcome)
+)
+
+def schedule_admin_digest(run_at, dedupe_key):
     """
-    Check for batches that have closed and need to be processed for delivery
-    This function runs every minute to find batches that have reached their time
+    Queue a digest flush for the scheduler leader's job queue
+    
+    Returns False when no process holds the scheduler lease (for example
+    SCHEDULER_ENABLED=0 everywhere), so the digest is sent inline instead of
+    waiting for a job nobody runs.
+    """
+    if not scheduler_lease.current_holder():
+        return False
+    job_queue.enqueue('admin_digest', run_at=run_at, dedupe_key=dedupe_key)
+    return True
+
+# Admin texts are coalesced into one digest per window instead of one SMS
+# per event; ADMIN_DIGEST_SECONDS=0 texts each event straight away
+admin_digest = AdminDigest(
+    'treehouse.db',
+    sms_outbox,
+    notification_email,
+    window=float(os.getenv('ADMIN_DIGEST_SECONDS', 60)),
+    schedule_flush=schedule_admin_digest
+)
+
+# Verified Stripe webhook events, stored by id and processed once by a job
+stripe_events = StripeEventStore('treehouse.db')
+
+# Bounded pool so one slow Uber Direct call doesn't hold up other batches
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 4))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch-worker')
+
+def parse_batch_time(value):
+    """
+    Convert a delivery_time value from the database to a naive local datetime
+
+    delivery_time is stored however the client sent it, so it may be a
+    datetime, an ISO string, or an ISO string with a trailing Z.
+    """
+    if isinstance(value, datetime):
+        batch_time = value
+    else:
+        batch_time = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    
+    if batch_time.tzinfo is not None:
+        batch_time = batch_time.astimezone().replace(tzinfo=None)
+    
+    return batch_time
+
+def schedule_batch_close(batch_id, delivery_time):
+    """
+    Enqueue a durable job that processes a batch at its exact delivery_time
+    
+    Safe to call more than once per batch; only the first call is kept.
+    
+    Args:
+        batch_id: ID of the delivery batch
+        delivery_time: When the batch closes (datetime or ISO string)
     """
     try:
-        now = datetime.now()
-        logger.info(f"Running scheduled batch check at {now}")
-        
-        # Connect to database
+        run_date = parse_batch_time(delivery_time)
+    except (TypeError, ValueError) as e:
+        logger.error(f"Cannot schedule batch {batch_id}, bad delivery time {delivery_time!r}: {e}")
+        return
+    
+    job_id = job_queue.enqueue(
+        'batch_close',
+        {'batch_id': batch_id},
+        run_at=run_date.timestamp(),
+        dedupe_key=f"batch_close:{batch_id}"
+    )
+    if job_id:
+        logger.info(f"Batch {batch_id} will close at {run_date}")
+
+def schedule_pending_batches():
+    """Make sure every batch still waiting to be processed has a close job"""
+    try:
         conn = sqlite3.connect('treehouse.db')
-        conn.row_factory = sqlite3.Row
         c = conn.cursor()
-        
-        # Find batches where:
-        # 1. The batch time has passed (window closed)
-        # 2. Status is still 'scheduled' (not yet processed)
-        # 3. Has at least one order
-        c.execute("""
-            SELECT db.id, db.delivery_time, 
-                  (SELECT COUNT(*) FROM batch_orders WHERE batch_id = db.id) AS order_count
-            FROM delivery_batches db
-            WHERE db.delivery_time <= ? 
-              AND db.status = 'scheduled'
-              AND (SELECT COUNT(*) FROM batch_orders WHERE batch_id = db.id) > 0
-            ORDER BY db.delivery_time
-        """, (now,))
-        
-        batches = c.fetchall()
+        c.execute("SELECT id, delivery_time FROM delivery_batches WHERE status = 'scheduled'")
+        pending = c.fetchall()
         conn.close()
-        
-        if not batches:
-            logger.info("No batches ready for delivery")
-            return
-        
-        # Process each batch that's ready
-        for batch in batches:
-            batch_id = batch['id']
-            batch_time = batch['delivery_time']
-            order_count = batch['order_count']
-            
-            # Only process if there are orders in this batch
-            if order_count > 0:
-                try:
-                    logger.info(f"Auto-processing batch {batch_id} with {order_count} orders")
-                    result = process_batch_delivery(batch_id)
-                    logger.info(f"Successfully processed batch {batch_id}: {result}")
-                except Exception as e:
-                    logger.error(f"Error processing batch {batch_id}: {e}")
-            else:
-                logger.info(f"Skipping empty batch {batch_id}")
-    
     except Exception as e:
-        logger.error(f"Error in batch check scheduler: {e}")
-
-# Schedule the task to run every minute
-scheduler.add_job(
-    func=check_and_process_batches,
-    trigger="interval",
-    minutes=1
-)
+        logger.error(f"Error loading pending batches: {e}")
+        return
+    
+    for batch_id, delivery_time in pending:
+        schedule_batch_close(batch_id, delivery_time)
 
-# Start the scheduler
-def start_scheduler():
-    scheduler.start()
-    logger.info("Started batch processing scheduler")
+def find_ready_batches(batch_id=None):
+    """
+    Find scheduled batches whose window has closed and that have orders
+    
+    Args:
+        batch_id: Optionally restrict the search to a single batch
+        
+    Returns:
+        list: (batch_id, order_count) tuples ordered by delivery time
+    """
+    conn = sqlite3.connect('treehouse.db')
+    c = conn.cursor()
+    
+    query = """
+        SELECT db.id, db.delivery_time, COUNT(bo.order_id) AS order_count
+        FROM delivery_batches db
+        JOIN batch_orders bo ON bo.batch_id = db.id
+        WHERE db.status = 'scheduled'
+    """
+    params = []
+    if batch_id is not None:
+        query += " AND db.id = ?"
+        params.append(batch_id)
+    query += " GROUP BY db.id"
+    
+    c.execute(query, params)
+    rows = c.fetchall()
+    conn.close()
+    
+    # delivery_time is stored in mixed formats, so compare parsed values
+    # rather than relying on SQLite string ordering
+    now = datetime.now()
+    ready = []
+    for row_id, delivery_time, order_count in rows:
+        try:
+            batch_time = parse_batch_time(delivery_time)
+        except (TypeError, ValueError):
+            logger.warning(f"Batch {row_id} has an unreadable delivery time: {delivery_time!r}")
+            continue
+        if batch_time <= now:
+            ready.append((batch_time, row_id, order_count))
+    
+    ready.sort()
+    return [(row_id, order_count) for _, row_id, order_count in ready]
 
-# Shut down the scheduler when the app stops
-def stop_scheduler():
-    scheduler.shutdown()
-    logger.info("Stopped batch processing scheduler")
+def claim_batch(batch_id):
+    """
+    Move a batch from 'scheduled' to 'processing'
+    
+    The conditional UPDATE means only one worker (or process) can win the
+    claim for a given batch.
+    
+    Returns:
+        bool: True if this caller now owns the batch
+    """
+    conn = sqlite3.connect('treehouse.db')
+    c = conn.cursor()
+    c.execute(
+        "UPDATE delivery_batches SET status = 'processing', claimed_at = ? WHERE id = ? AND status = 'scheduled'",
+        (time.time(), batch_id)
+    )
+    claimed = c.rowcount == 1
+    conn.commit()
+    conn.close()
+    return claimed
 
-# Register the shutdown function
-atexit.register(stop_scheduler)
+# Failed dispatch attempts before a batch is marked 'failed' for good
+BATCH_MAX_ATTEMPTS = int(os.getenv('BATCH_MAX_ATTEMPTS', 5))
 
+# Seconds a batch may stay 'processing' before its worker is presumed dead;
+# keep it above the longest dispatch, Uber retries included
+BATCH_CLAIM_TIMEOUT = float(os.getenv('BATCH_CLAIM_TIMEOUT_SECONDS', 900))
 
-@app.route('/webhook/sms', methods=['POST'])
-def sms_webhook():
-    # Get the incoming message details
-    incoming_message = request.values.get('Body', '').strip()
-    from_number = request.values.get('From', '')
+def release_batch(batch_id, result):
+    """
+    Settle a claimed batch that was not dispatched
     
-    # Clean the phone number
-    clean_phone = ''.join(filter(str.isdigit, from_number))
+    - "No orders to process": 'empty', final; nothing will ever join it
+    - Missing module or credentials: back to 'scheduled' without counting
+      an attempt, so it goes out once the configuration is fixed
+    - Anything else counts an attempt: back to 'scheduled' for a retry, or
+      'failed' after BATCH_MAX_ATTEMPTS
+    
+    Returns:
+        str: The batch's new status
+    """
+    empty = result == "No orders to process"
+    counted = 0 if empty or result in PERMANENT_BATCH_RESULTS else 1
+    
+    conn = sqlite3.connect('treehouse.db')
+    c = conn.cursor()
+    c.execute(
+        """
+        UPDATE delivery_batches
+        SET attempts = attempts + ?,
+            last_result = ?,
+            status = CASE
+                WHEN ? THEN 'empty'
+                WHEN attempts + ? >= ? THEN 'failed'
+                ELSE 'scheduled'
+            END
+        WHERE id = ? AND status = 'processing'
+        """,
+        (counted, result, empty, counted, BATCH_MAX_ATTEMPTS, batch_id)
+    )
+    c.execute("SELECT status, attempts FROM delivery_batches WHERE id = ?", (batch_id,))
+    status, attempts = c.fetchone()
+    conn.commit()
+    conn.close()
+    
+    if status == 'failed':
+        logger.error(f"Batch {batch_id} failed after {attempts} attempts: {result}")
+    elif status == 'empty':
+        logger.warning(f"Batch {batch_id} has no orders that can be delivered; closing it")
+    return status
+
+def requeue_stale_batches():
+    """
+    Return batches left 'processing' past BATCH_CLAIM_TIMEOUT to 'scheduled'
+    
+    A worker that crashed or was killed mid-dispatch never releases its
+    batch. Each recovery counts as an attempt, so a batch that keeps taking
+    its worker down ends up 'failed'. Dispatching again is safe: delivery
+    requests carry idempotency keys, so a booking that went through before
+    the crash is returned rather than made twice.
+    
+    Returns:
+        int: Number of batches recovered
+    """
+    conn = sqlite3.connect('treehouse.db')
+    c = conn.cursor()
+    c.execute(
+        """
+        UPDATE delivery_batches
+        SET attempts = attempts + 1,
+            last_result = 'Error: worker stopped while processing',
+            status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'scheduled' END
+        WHERE status = 'processing' AND (claimed_at IS NULL OR claimed_at < ?)
+        """,
+        (BATCH_MAX_ATTEMPTS, time.time() - BATCH_CLAIM_TIMEOUT)
+    )
+    recovered = c.rowcount
+    conn.commit()
+    conn.close()
+    
+    if recovered:
+        logger.warning(f"Recovered {recovered} batches left processing past {BATCH_CLAIM_TIMEOUT:.0f}s")
+    return recovered
+
+def run_batch(batch_id, order_count):
+    """
+    Claim and process a single batch, isolated from every other batch
+    
+    Returns:
+        tuple: (batch_id, result, elapsed seconds)
+    """
+    if not claim_batch(batch_id):
+        logger.info(f"Batch {batch_id} already claimed by another worker")
+        return batch_id, "Already claimed", 0.0
+    
+    started = time.perf_counter()
+    result = None
+    try:
+        logger.info(f"Auto-processing batch {batch_id} with {order_count} orders")
+        result = process_batch_delivery(batch_id)
+    except Exception as e:
+        logger.error(f"Error processing batch {batch_id}: {e}")
+        result = f"Error: {e}"
+    finally:
+        elapsed = time.perf_counter() - started
+        scheduler_metrics.record_batch(elapsed, result or "Error")
+        # Anything short of a dispatched batch is retried by the next close
+        # job or sweep, up to BATCH_MAX_ATTEMPTS
+        if result != "Success":
+            status = release_batch(batch_id, result or "Error")
+            if status != 'scheduled':
+                result = f"{result} (batch {status})"
+    
+    return batch_id, result, elapsed
+
+def process_ready_batches(batches):
+    """Process (batch_id, order_count) pairs concurrently on the batch pool"""
+    futures = [batch_executor.submit(run_batch, batch_id, order_count) for batch_id, order_count in batches]
+    
+    for future in as_completed(futures):
+        batch_id, result, elapsed = future.result()
+        logger.info(f"Batch {batch_id} finished in {elapsed:.2f}s: {result}")
+
+# Results a retry cannot change. They wait for someone to fix the setup (the
+# safety-net sweep picks the batch up again) rather than using up retries.
+PERMANENT_BATCH_RESULTS = (
+    "Error: Uber Direct module not available",
+    "Error: Uber Direct API credentials not configured"
+)
+
+def close_batch(payload):
+    """
+    batch_close job handler, fired at a batch's delivery_time
+    
+    Raises if the batch could not be dispatched for a transient reason so
+    the job queue retries it with backoff; permanent failures are logged and
+    end the job.
+    """
+    batch_id = payload['batch_id']
+    batches = find_ready_batches(batch_id)
+    if not batches:
+        logger.info(f"Batch {batch_id} has no orders or was already processed")
+        return
+    
+    _, order_count = batches[0]
+    _, result, elapsed = run_batch(batch_id, order_count)
+    logger.info(f"Batch {batch_id} finished in {elapsed:.2f}s: {result}")
+    
+    if result in PERMANENT_BATCH_RESULTS or result.endswith(("(batch empty)", "(batch failed)")):
+        logger.error(f"Batch {batch_id} not dispatched and will not be retried by this job: {result}")
+    elif result not in ("Success", "Already claimed"):
+        raise RuntimeError(f"Batch {batch_id} not dispatched: {result}")
+
+def send_batch_confirmation(payload):
+    """batch_confirmation job handler: tell a customer their batch is locked in"""
+    if not twilio_client:
+        return
+    
+    restaurant = payload['restaurant']
+    batch_location = payload['batch_location']
+    batch_time_str = payload['batch_time_str']
+    batch_confirm = f"""Your {restaurant} batch is locked in!
+
+5 orders total. Delivery to {batch_location} at {batch_time_str}.
+
+Your pickup window: {batch_time_str}-{batch_time_str[:-3]}:03{batch_time_str[-3:]}"""
+    
+    # Keyed so a job that runs twice (lease taken over, retry after a
+    # partial failure) still texts once; older jobs have no payment id
+    confirmation_id = payload.get('payment_id') or f"{payload['phone_number']}:{restaurant}:{batch_time_str}"
+    sms_outbox.enqueue(
+        f"+{payload['phone_number']}",
+        batch_confirm,
+        kind='batch_confirmation',
+        dedupe_key=f"confirm:{confirmation_id}"
+    )
+    logger.info(f"Batch confirmation queued for +{payload['phone_number']}")
+
+def record_stripe_payment(session):
+    """
+    Apply a completed Checkout Session: payment row, customer texts, admin event
+    
+    Safe to run again for the same session: the payment row is inserted once
+    and the customer texts are deduplicated by session id.
+    
+    Args:
+        session: checkout.session.completed event object
+    """
+    metadata = session.get('metadata') or {}
+    phone_number = metadata.get('phone_number')
+    user_id = metadata.get('user_id')
+    if not (phone_number and user_id):
+        logger.info(f"Checkout session {session.get('id')} has no customer metadata; no payment recorded")
+        return
+    
+    # Get payment details
+    payment_amount = (session.get('amount_total') or 0) / 100  # Convert cents to dollars
+    payment_id = session.get('id')
+    
+    # The order this checkout was created for (0 if there was none)
+    checkout = checkout_index.lookup(payment_id) or {}
+    order_id = metadata.get('order_id') or checkout.get('order_id') or 0
+    
+    conn = sqlite3.connect('treehouse.db')
+    c = conn.cursor()
+    c.execute(
+        "INSERT OR IGNORE INTO payments (order_id, amount, payment_method, transaction_id, status) "
+        "SELECT ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM payments WHERE transaction_id = ?)",
+        (int(order_id), payment_amount, "stripe", payment_id, "completed", payment_id)
+    )
+    new_payment = c.rowcount == 1
+    payment_row_id = c.lastrowid if new_payment else None
+    conn.commit()
+    conn.close()
+    
+    checkout_index.mark_paid(payment_id, payment_amount, payment_row_id)
+    
+    if new_payment:
+        logger.info(f"Payment recorded for user_id {user_id}, amount ${payment_amount}")
+    else:
+        logger.info(f"Payment {payment_id} already recorded")
+    
+    if not twilio_client:
+        return
+    
+    # Order details were stored with the checkout session when the link was
+    # sent; this runs on the leader, whose active_sessions are not the
+    # customer's
+    restaurant = checkout.get('restaurant') or "your order"
+    batch_location = checkout.get('location') or "your location"
+    order_details = f"\nOrder: {checkout['order_text']}" if checkout.get('order_text') else ""
+    if checkout.get('restaurant'):
+        order_details += f"\nRestaurant: {checkout['restaurant']}"
+    batch_time_str = "upcoming batch"
+    if checkout.get('batch_time'):
+        try:
+            batch_time_str = parse_batch_time(checkout['batch_time']).strftime("%I:%M %p")
+        except ValueError:
+            logger.warning(f"Unreadable batch time {checkout['batch_time']!r} for checkout session {payment_id}")
+    
+    # Create confirmation message
+    confirmation = f"""Payment confirmed! Your {restaurant} order is set for pickup at {batch_location} between {batch_time_str}-{batch_time_str[:-3]}:03{batch_time_str[-3:]}.
+
+Your batch is currently 5/10 full.
+
+We'll text you when the batch is locked in.
+
+Reply "CANCEL" within the next 10 minutes if you need to cancel."""
+    
+    sms_outbox.enqueue(
+        f"+{phone_number}",
+        confirmation,
+        kind='payment_confirmation',
+        dedupe_key=f"payment_confirmation:{payment_id}"
+    )
+    logger.info(f"Payment confirmation queued for +{phone_number}")
+    
+    # Send the "batch locked in" message 30 seconds later
+    job_queue.enqueue(
+        'batch_confirmation',
+        {
+            'phone_number': phone_number,
+            'restaurant': restaurant,
+            'batch_location': batch_location,
+            'batch_time_str': batch_time_str,
+            'payment_id': payment_id
+        },
+        delay=30,
+        dedupe_key=f"batch_confirmation:{payment_id}"
+    )
+    
+    # Notify admin about payment (once, with the payment row)
+    if new_payment:
+        admin_digest.record(
+            'payment',
+            f"Paid ${payment_amount:.2f} by +{phone_number}",
+            f"Payment received! Phone: +{phone_number}, Amount: ${payment_amount:.2f}, Stripe ID: {payment_id}{order_details}"
+        )
+
+# Stripe event types we act on; others are marked ignored
+STRIPE_EVENT_HANDLERS = {
+    'checkout.session.completed': lambda event: record_stripe_payment(event['data']['object'])
+}
+
+def process_stripe_event(payload, force=False):
+    """
+    stripe_event job handler: run a stored event's side effects once
+    
+    Args:
+        payload: {'event_id': ...}
+        force: Run again even if the event was already processed
+        
+    Returns:
+        bool: Whether this call processed the event
+    """
+    event_id = payload['event_id']
+    event = stripe_events.claim(event_id, force=force)
+    if event is None:
+        logger.info(f"Stripe event {event_id} already processed or in progress")
+        return False
+    
+    handler = STRIPE_EVENT_HANDLERS.get(event['type'])
+    if handler is None:
+        stripe_events.finish(event_id, 'ignored')
+        return True
+    
+    try:
+        handler(event)
+    except Exception as e:
+        # Left failed for the job retry or replay-stripe-events
+        stripe_events.finish(event_id, 'failed', str(e))
+        raise
+    
+    stripe_events.finish(event_id, 'processed')
+    logger.info(f"Processed Stripe event {event_id} ({event['type']})")
+    return True
+
+def schedule_stripe_events():
+    """Queue a job for any stored event that never got one (e.g. crash after storing)"""
+    try:
+        for event_id in stripe_events.event_ids(['received']):
+            job_queue.enqueue('stripe_event', {'event_id': event_id}, dedupe_key=f"stripe_event:{event_id}")
+    except Exception as e:
+        logger.error(f"Error scheduling stored Stripe events: {e}")
+
+def check_and_process_batches():
+    """
+    Check for batches that have closed and need to be processed for delivery
+    Batches normally close through their own job; this low-frequency sweep
+    catches any that were missed (e.g. the process was down at close time)
+    and any whose worker died mid-dispatch
+    """
+    try:
+        now = datetime.now()
+        logger.info(f"Running scheduled batch check at {now}")
+        
+        requeue_stale_batches()
+        batches = find_ready_batches()
+        
+        if not batches:
+            logger.info("No batches ready for delivery")
+            return
+        
+        process_ready_batches(batches)
+    
+    except Exception as e:
+        logger.error(f"Error in batch check scheduler: {e}")
+
+# Safety-net sweep for batches whose close job never ran
+scheduler.add_job(
+    func=check_and_process_batches,
+    trigger="interval",
+    minutes=BATCH_SAFETY_NET_MINUTES,
+    id="batch-safety-net",
+    replace_existing=True
+)
+
+def get_scheduler_backlog():
+    """Count batches and jobs waiting on the scheduler"""
+    conn = sqlite3.connect('treehouse.db')
+    c = conn.cursor()
+    c.execute("SELECT status, COUNT(*) FROM delivery_batches WHERE status IN ('scheduled', 'processing', 'failed') GROUP BY status")
+    batch_counts = dict(c.fetchall())
+    conn.close()
+    
+    return {
+        "batches_ready": len(find_ready_batches()),
+        "batches_scheduled": batch_counts.get('scheduled', 0),
+        "batches_processing": batch_counts.get('processing', 0),
+        "batches_failed": batch_counts.get('failed', 0),
+        "jobs_pending": job_queue.pending_count()
+    }
+
+def log_scheduler_summary():
+    scheduler_metrics.log_summary(get_scheduler_backlog())
+
+# Rolling summary of scheduler health in the logs
+scheduler.add_job(
+    func=log_scheduler_summary,
+    trigger="interval",
+    minutes=int(os.getenv('SCHEDULER_SUMMARY_MINUTES', 5)),
+    id="scheduler-summary",
+    replace_existing=True
+)
+
+def reconcile_payments():
+    """Link payments to orders through checkout_sessions, plus the export if configured"""
+    try:
+        export_path = os.getenv('STRIPE_EXPORT_PATH')
+        export = load_export(export_path) if export_path and os.path.exists(export_path) else None
+        checkout_index.reconcile(export)
+    except Exception as e:
+        logger.error(f"Error reconciling payments: {e}")
+
+# Periodic payment-to-order reconciliation
+scheduler.add_job(
+    func=reconcile_payments,
+    trigger="interval",
+    minutes=int(os.getenv('PAYMENT_RECONCILE_MINUTES', 15)),
+    id="payment-reconciliation",
+    replace_existing=True
+)
+
+job_queue.register('batch_close', close_batch)
+job_queue.register('batch_confirmation', send_batch_confirmation)
+job_queue.register('admin_digest', lambda payload: admin_digest.flush())
+job_queue.register('stripe_event', process_stripe_event)
+
+# Start the scheduler (called when this process becomes leader)
+def start_scheduler():
+    if not scheduler.running:
+        scheduler.start()
+    else:
+        scheduler.resume()
+    requeue_stale_batches()
+    schedule_pending_batches()
+    schedule_stripe_events()
+    job_queue.start()
+    logger.info("Started batch processing scheduler")
+
+# Pause the scheduler (called when this process loses leadership)
+def pause_scheduler():
+    job_queue.stop()
+    if scheduler.running:
+        scheduler.pause()
+        logger.info("Paused batch processing scheduler")
+
+# Shut down the scheduler when the app stops
+def stop_scheduler():
+    scheduler_lease.stop()
+    job_queue.stop()
+    sms_outbox.stop()
+    if scheduler.running:
+        scheduler.shutdown()
+    batch_executor.shutdown(wait=False)
+    ai_reply_executor.shutdown(wait=False)
+    logger.info("Stopped batch processing scheduler")
+
+# Only the process holding this lease runs the scheduler, so gunicorn
+# workers don't each dispatch the same batches
+scheduler_lease = LeaderLease(
+    'treehouse.db',
+    'batch-scheduler',
+    ttl=float(os.getenv('SCHEDULER_LEASE_TTL', 15)),
+    heartbeat_interval=float(os.getenv('SCHEDULER_HEARTBEAT_SECONDS', 5)),
+    on_elected=start_scheduler,
+    on_demoted=pause_scheduler
+)
+
+_background_started = False
+_background_lock = threading.Lock()
+
+def start_background_services():
+    """
+    Start the leader lease and the SMS sender in this process, once
+    
+    Nothing is started at import, so gunicorn --preload and the reloader's
+    parent process never own threads. Server entrypoints call this after
+    the fork: gunicorn.conf.py from each worker's post_worker_init hook,
+    and __main__ below for the development server.
+    """
+    global _background_started
+    
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    
+    if os.getenv('SCHEDULER_ENABLED', '1') == '1':
+        scheduler_lease.start()
+    
+    # Every process sends its own queued texts; claims are atomic so workers
+    # never send the same message twice
+    if twilio_client:
+        sms_outbox.start()
+
+# Register the shutdown function
+atexit.register(stop_scheduler)
+
+
+@app.route('/api/scheduler/metrics', methods=['GET'])
+def get_scheduler_metrics():
+    """
+    Scheduler, queue and SMS/Stripe pipeline health for this process
+    
+    Exposes the worker pid, backlogs and payment reconciliation counts, so
+    this needs the ADMIN_API_TOKEN bearer token.
+    """
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    try:
+        metrics = scheduler_metrics.snapshot()
+        metrics["backlog"] = get_scheduler_backlog()
+        # Metrics are kept in memory by the process running the scheduler
+        metrics["is_leader"] = scheduler_lease.is_leader
+        metrics["pid"] = os.getpid()
+        if _uber_direct_client is not None:
+            metrics["quote_cache"] = _uber_direct_client.quote_cache.snapshot()
+        metrics["sms_outbox"] = sms_outbox.snapshot()
+        metrics["sms_webhook_dedupe"] = sms_webhook_dedupe.snapshot()
+        metrics["sms_rate_limit"] = sms_rate_limiter.snapshot()
+        metrics["stripe_catalog"] = stripe_catalog.snapshot()
+        metrics["stripe_events"] = stripe_events.snapshot()
+        metrics["checkout_sessions"] = checkout_index.snapshot()
+        # Outbound texts are in sms_outbox.segments_sent; these are TwiML replies
+        metrics["sms_reply_segments"] = {
+            "budget": sms_renderer.default_budget,
+            **sms_renderer.stats.snapshot()
+        }
+        with webhook_metrics_lock:
+            metrics["sms_webhook_latency"] = {
+                "response_seconds": webhook_latency["response"].summary(),
+                "ai_reply_seconds": webhook_latency["ai_reply"].summary(),
+                "budget_seconds": SMS_REPLY_BUDGET_SECONDS,
+                **webhook_counts
+            }
+        return jsonify(metrics), 200
+    except Exception as e:
+        logger.error(f"Error collecting scheduler metrics: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/delivery-batches/<int:batch_id>/notifications', methods=['GET'])
+def get_batch_notifications(batch_id):
+    """Send outcome of each tracking text for a batch"""
+    try:
+        messages = sms_outbox.messages(f"tracking:{batch_id}:")
+        statuses = {}
+        for message in messages:
+            statuses[message['status']] = statuses.get(message['status'], 0) + 1
+        return jsonify({"batch_id": batch_id, "statuses": statuses, "messages": messages}), 200
+    except Exception as e:
+        logger.error(f"Error listing notifications for batch {batch_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# Bearer token for /api/admin endpoints; they are disabled while unset
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN')
+
+def admin_authorized():
+    """Check the request's Authorization: Bearer header against ADMIN_API_TOKEN"""
+    if not ADMIN_API_TOKEN:
+        return False
+    header = request.headers.get('Authorization', '')
+    token = header[7:] if header.startswith('Bearer ') else ''
+    return hmac.compare_digest(token.encode(), ADMIN_API_TOKEN.encode())
+
+
+@app.route('/api/admin/events', methods=['GET'])
+def get_admin_events():
+    """
+    Raw admin notification events, for consumers that want more than the digest
+    
+    Events contain phone numbers, order text and Stripe ids, so this needs
+    the ADMIN_API_TOKEN bearer token.
+    """
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    since_id = request.args.get('since_id', 0, type=int)
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    kind = request.args.get('kind')
+    
+    try:
+        events = admin_digest.events(since_id, limit, kind)
+        return jsonify({
+            "events": events,
+            "next_since_id": events[-1]["id"] if events else since_id
+        }), 200
+    except Exception as e:
+        logger.error(f"Error listing admin events: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/delivery-estimate', methods=['GET'])
+def get_delivery_estimate():
+    """Uber Direct fee for a route; admin only, since a cache miss is a real quote call"""
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    restaurant_name = request.args.get('restaurant')
+    destination_name = request.args.get('destination', 'Library')
+    
+    if not restaurant_name:
+        return jsonify({"error": "restaurant is required"}), 400
+    
+    estimate = estimate_delivery_fee(restaurant_name, destination_name)
+    if estimate is None:
+        return jsonify({"error": "Delivery estimate unavailable"}), 503
+    
+    return jsonify(estimate), 200
+
+
+# Most batches a consolidation simulation may replay per request
+SIMULATION_MAX_BATCHES = 200
+
+_consolidation_planner = None
+_consolidation_planner_lock = threading.Lock()
+
+def get_consolidation_planner():
+    """
+    Planner shared by consolidation simulations
+    
+    Planning only needs locations, so it is built once, without credentials,
+    token refresh or a rate limiter.
+    """
+    global _consolidation_planner
+    
+    with _consolidation_planner_lock:
+        if _consolidation_planner is None:
+            _consolidation_planner = UberDirectBase.planner(
+                consolidation_radius_m=float(os.getenv('UBER_CONSOLIDATION_RADIUS_M', 150)),
+                locations_path=os.getenv('UBER_LOCATIONS_PATH')
+            )
+        return _consolidation_planner
+
+
+@app.route('/api/delivery-consolidation/simulation', methods=['GET'])
+def simulate_delivery_consolidation():
+    """Replay past batches through the consolidation planner (no API calls)"""
+    if not UBER_DIRECT_AVAILABLE:
+        return jsonify({"error": "Uber Direct module not available"}), 503
+    
+    limit = min(max(request.args.get('limit', 50, type=int), 1), SIMULATION_MAX_BATCHES)
+    radius_m = request.args.get('radius_m', float(os.getenv('UBER_CONSOLIDATION_RADIUS_M', 150)), type=float)
+    
+    conn = sqlite3.connect('treehouse.db')
+    try:
+        batches = load_batch_routes(conn, limit)
+    except Exception as e:
+        logger.error(f"Error loading batches for consolidation simulation: {e}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+    
+    return jsonify(get_consolidation_planner().simulate_consolidation(batches, radius_m / 1000.0)), 200
+
+
+# AI replies run on their own pool. If one isn't ready within the budget the
+# webhook answers straight away and the reply follows through the outbox,
+# well inside Twilio's 15 second timeout
+SMS_REPLY_BUDGET_SECONDS = float(os.getenv('SMS_REPLY_BUDGET_SECONDS', 4))
+SMS_HOLDING_REPLY = os.getenv('SMS_HOLDING_REPLY', '')
+ai_reply_executor = ThreadPoolExecutor(max_workers=int(os.getenv('AI_REPLY_WORKERS', 4)), thread_name_prefix='ai-reply')
+
+# Webhook response time and how long AI replies actually take
+webhook_latency = {
+    "response": RollingStats(scheduler_metrics.window),
+    "ai_reply": RollingStats(scheduler_metrics.window)
+}
+webhook_counts = {"ai_inline": 0, "ai_deferred": 0}
+# Request threads and the AI pool both update these
+webhook_metrics_lock = threading.Lock()
+
+def record_latency(stats):
+    """Decorator adding each call's duration in seconds to a RollingStats"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                with webhook_metrics_lock:
+                    stats.add(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+def count_webhook(name):
+    with webhook_metrics_lock:
+        webhook_counts[name] += 1
+
+def reply_within_budget(func, args, on_late):
+    """
+    Run a slow reply on the AI pool, waiting at most SMS_REPLY_BUDGET_SECONDS
+    
+    Args:
+        func: Function producing the reply text
+        args: Arguments for func
+        on_late: Called with the reply if it arrives after the budget
+        
+    Returns:
+        str: The reply, or None if it will be delivered through on_late
+    """
+    timed_func = record_latency(webhook_latency["ai_reply"])(func)
+    future = ai_reply_executor.submit(timed_func, *args)
+    try:
+        reply = future.result(timeout=SMS_REPLY_BUDGET_SECONDS)
+        count_webhook("ai_inline")
+        return reply
+    except FutureTimeout:
+        count_webhook("ai_deferred")
+    
+    def deliver(done):
+        try:
+            on_late(done.result())
+        except Exception as e:
+            logger.error(f"Error delivering deferred reply: {e}")
+    
+    future.add_done_callback(deliver)
+    return None
+
+# Opt-out keywords; these are always processed, even when rate limited
+OPT_OUT_KEYWORDS = ['STOP', 'CANCEL', 'UNSUBSCRIBE', 'END', 'QUIT']
+
+# Flood protection: token buckets per sender and overall, shared by every
+# worker through SQLite
+sms_rate_limiter = SmsRateLimiter(
+    'treehouse.db',
+    phone_rate=float(os.getenv('SMS_PHONE_RATE_PER_MINUTE', 10)) / 60.0,
+    phone_burst=int(os.getenv('SMS_PHONE_BURST', 5)),
+    global_rate=float(os.getenv('SMS_GLOBAL_RATE_PER_SECOND', 20)),
+    global_burst=int(os.getenv('SMS_GLOBAL_BURST', 100))
+)
+
+def rate_limit_sms(view):
+    """Drop new inbound texts over the per-phone or global rate before any other work"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.values.get('Body', '').strip().upper() not in OPT_OUT_KEYWORDS:
+            clean_phone = ''.join(filter(str.isdigit, request.values.get('From', '')))
+            try:
+                limited = sms_rate_limiter.allow(clean_phone)
+            except Exception as e:
+                # Fail open; a limiter error shouldn't stop customers ordering
+                logger.error(f"Error checking SMS rate limit: {e}")
+                limited = None
+            
+            if limited:
+                logger.warning(f"Dropped text from {request.values.get('From', '')}: {limited} rate limit")
+                # Empty TwiML, so the drop costs no outbound message
+                return str(MessagingResponse())
+        return view(*args, **kwargs)
+    return wrapper
+
+# Twilio retries slow webhooks with the same MessageSid; retries get the
+# first response back instead of re-running the order flow
+sms_webhook_dedupe = WebhookDedupe(
+    'treehouse.db',
+    ttl=float(os.getenv('SMS_WEBHOOK_DEDUPE_TTL', 3600)),
+    wait=float(os.getenv('SMS_WEBHOOK_RETRY_WAIT', 10))
+)
+
+def hold_session_lock(view):
+    """Handle one sender's texts one at a time in this process"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        clean_phone = ''.join(filter(str.isdigit, request.values.get('From', '')))
+        with session_lock(clean_phone):
+            return view(*args, **kwargs)
+    return wrapper
+
+# Dedupe runs first so Twilio retries of a MessageSid replay the stored
+# reply without spending rate limit tokens; only new messages are charged
+@app.route('/webhook/sms', methods=['POST'])
+@record_latency(webhook_latency["response"])
+@sms_webhook_dedupe.deduplicate
+@rate_limit_sms
+@hold_session_lock
+def sms_webhook():
+    # Get the incoming message details
+    incoming_message = request.values.get('Body', '').strip()
+    from_number = request.values.get('From', '')
+    
+    # Clean the phone number
+    clean_phone = ''.join(filter(str.isdigit, from_number))
     
     # Create a TwiML response
     resp = MessagingResponse()
     
     # Handle STOP, UNSUBSCRIBE commands (opt-out)
-    if incoming_message.upper() in ['STOP', 'CANCEL', 'UNSUBSCRIBE', 'END', 'QUIT']:
+    if incoming_message.upper() in OPT_OUT_KEYWORDS:
         try:
             conn = sqlite3.connect('treehouse.db')
             c = conn.cursor()
@@ -1954,7 +3168,7 @@ def sms_webhook():
             conn.close()
             
             # Send confirmation message
-            resp.message("You have been unsubscribed from TreeHouse messages. Text JOIN to resubscribe at any time.")
+            resp.message(sms_renderer.render('opt_out', "You have been unsubscribed from TreeHouse messages. Text JOIN to resubscribe at any time."))
             logger.info(f"User {from_number} opted out of messages")
             
             # Remove from active sessions if present
@@ -1977,7 +3191,7 @@ def sms_webhook():
             "For assistance, call (708) 901-1754\n"
             "Msg & data rates may apply."
         )
-        resp.message(help_text)
+        resp.message(sms_renderer.render('help', help_text))
         return str(resp)
     
     # Handle JOIN or START for resubscribing
@@ -1998,7 +3212,7 @@ def sms_webhook():
                 conn.close()
                 
                 # Send confirmation message
-                resp.message("Welcome back to TreeHouse! You're now subscribed to receive messages. Text MENU to see restaurant options.")
+                resp.message(sms_renderer.render('join', "Welcome back to TreeHouse! You're now subscribed to receive messages. Text MENU to see restaurant options."))
                 logger.info(f"User {from_number} opted back in to messages")
                 return str(resp)
             else:
@@ -2008,7 +3222,7 @@ def sms_webhook():
                 conn.commit()
                 conn.close()
                 
-                resp.message("Welcome to TreeHouse! You're now subscribed to receive messages. Text MENU to see restaurant options.")
+                resp.message(sms_renderer.render('join', "Welcome to TreeHouse! You're now subscribed to receive messages. Text MENU to see restaurant options."))
                 logger.info(f"New user {from_number} joined via text")
                 return str(resp)
         except Exception as e:
@@ -2060,7 +3274,7 @@ def sms_webhook():
             user_history.append({'role': 'assistant', 'content': ai_response})
             active_sessions[clean_phone]['conversation_history'] = user_history
             
-            resp.message(ai_response)
+            resp.message(sms_renderer.render('order', ai_response))
             logger.info(f"Processed location response for order from {from_number} using TwiML")
             
             # Send admin notification if order is now complete
@@ -2090,12 +3304,12 @@ def sms_webhook():
                     admin_note += f"Order: {order_text}\n\n"
                     admin_note += "Customer will need to text 'PAY' to receive payment link."
                     
-                    twilio_message = twilio_client.messages.create(
-                        body=admin_note,
-                        from_=twilio_phone,
-                        to=notification_email
+                    admin_digest.record(
+                        'order',
+                        f"Text order {restaurant_name} for {user_name} ({dorm}, Room {room}): {order_text[:80]}",
+                        admin_note
                     )
-                    logger.info(f"Admin notification sent for completed order with location: {twilio_message.sid}")
+                    logger.info(f"Admin notification recorded for completed order with location")
                 except Exception as e:
                     logger.error(f"Error sending admin notification for location update: {e}")
             
@@ -2123,7 +3337,7 @@ def sms_webhook():
             user_history.append({'role': 'assistant', 'content': response})
             active_sessions[clean_phone]['conversation_history'] = user_history
             
-            resp.message(response)
+            resp.message(sms_renderer.render('order', response))
             logger.info(f"Asked for customer name after no order number from {from_number}")
             
             conn.close()
@@ -2144,7 +3358,7 @@ def sms_webhook():
             user_history.append({'role': 'assistant', 'content': response})
             active_sessions[clean_phone]['conversation_history'] = user_history
             
-            resp.message(response)
+            resp.message(sms_renderer.render('order', response))
             logger.info(f"Processed order number from {from_number}: {order_number}")
             
             conn.close()
@@ -2184,7 +3398,7 @@ def sms_webhook():
             user_history.append({'role': 'assistant', 'content': response})
             active_sessions[clean_phone]['conversation_history'] = user_history
             
-            resp.message(response)
+            resp.message(sms_renderer.render('order', response))
             logger.info(f"Processed customer name response from {from_number} using TwiML")
             
             conn.close()
@@ -2197,11 +3411,14 @@ def sms_webhook():
     if first_word == 'menu' or first_word == 'restaurants' or is_menu_request(incoming_message):
         # Get current batches
         batches = get_current_batches()
-        response = format_batch_info(batches)
         
-        # Add welcome message if needed
-        if welcome_msg:
-            response = welcome_msg + response
+        # Full menu if it fits the segment budget, otherwise the short one
+        # (welcome message added if needed)
+        response = sms_renderer.render(
+            'menu',
+            welcome_msg + format_batch_info(batches),
+            welcome_msg + format_batch_info(batches, compact=True)
+        )
         
         # Update conversation history
         user_history.append({'role': 'user', 'content': incoming_message})
@@ -2241,6 +3458,11 @@ def sms_webhook():
                 if batch_info:
                     active_sessions[clean_phone]['batch_info'] = batch_info
             
+            # Quote the delivery now, off the request thread, so the batch
+            # books with a cached quote
+            if restaurant_name and is_complete_order:
+                batch_executor.submit(warm_delivery_quote, user_id, restaurant_name, batch_info)
+            
             # Send notification to admin ONLY for complete orders
             if twilio_client and restaurant_name and is_complete_order:
                 try:
@@ -2268,13 +3490,12 @@ def sms_webhook():
                     admin_note += f"Order: {order_text}\n\n"
                     admin_note += "Customer will need to text 'PAY' to receive payment link."
                     
-                    # Make sure you're using the right Twilio client and notification number
-                    twilio_message = twilio_client.messages.create(
-                        body=admin_note,
-                        from_=twilio_phone,
-                        to=notification_email  # Make sure this is your phone number in E.164 format
+                    admin_digest.record(
+                        'order',
+                        f"Text order {restaurant_name} for {user_name} ({dorm}, Room {room}): {order_text[:80]}",
+                        admin_note
                     )
-                    logger.info(f"Admin notification sent for new text order from {from_number}: {twilio_message.sid}")
+                    logger.info(f"Admin notification recorded for new text order from {from_number}")
                 except Exception as e:
                     logger.error(f"Error sending admin notification: {e}")
 
@@ -2291,7 +3512,7 @@ def sms_webhook():
             user_history.append({'role': 'assistant', 'content': response})
             active_sessions[clean_phone]['conversation_history'] = user_history
             
-            resp.message(response)
+            resp.message(sms_renderer.render('order', response))
             logger.info(f"Processed order request from {from_number} using TwiML")
         
     elif first_word == 'pay':
@@ -2305,13 +3526,22 @@ def sms_webhook():
             if batch_info and 'delivery_fee' in batch_info:
                 delivery_fee = float(batch_info['delivery_fee'])
         
-        # Use the fixed payment link from your Stripe dashboard
-        payment_link = "https://buy.stripe.com/4gweYm6zB6FbfbWdQQ"
-        
         # Generate a unique session ID for tracking
         import datetime as dt
         payment_session_id = f"pay_{clean_phone}_{int(dt.datetime.now().timestamp())}"
         
+        # A checkout session per order when Stripe is configured, so the
+        # payment carries this customer's metadata; otherwise the fixed link
+        # from the Stripe dashboard
+        payment_link = "https://buy.stripe.com/4gweYm6zB6FbfbWdQQ"
+        if stripe_secret_key:
+            try:
+                checkout_session = create_order_checkout(clean_phone, user_id, delivery_fee)
+                payment_session_id = checkout_session.id
+                payment_link = checkout_session.url
+            except Exception as e:
+                logger.error(f"Error creating Stripe checkout session, using fixed payment link: {e}")
+        
         # Store the session ID in the active session
         if not has_active_order:
             active_sessions[clean_phone] = {
@@ -2326,6 +3556,7 @@ def sms_webhook():
         response = "Here's your payment link:\n" + payment_link + "\n\n"
         response += f"IMPORTANT: If you already paid for your food through the restaurant's app/website (recommended), enter ONLY the $4.00 delivery fee.\n\n"
         response += f"If you ordered by phone and haven't paid for your food yet, enter the TOTAL amount including BOTH your food cost AND the $4.00 delivery fee. For example, if your food costs $15, enter $19.00 total."
+        compact_response = f"Pay here: {payment_link}\nAlready paid the restaurant? Enter just the $4.00 fee. If not, enter food + $4.00 (e.g. $15 food = $19.00)."
         if has_active_order:
             order_text = active_sessions[clean_phone].get('order_text', '')
             restaurant = active_sessions[clean_phone].get('restaurant', '')
@@ -2349,9 +3580,13 @@ def sms_webhook():
                             batch_time_str = batch_time
             
             response += f"\n\nFor reference, your order was: {order_text}"
+            compact_response += f"\nYour order: {order_text}"
             
             if restaurant and batch_time_str:
                 response += f"\nRestaurant: {restaurant}, Pickup at {batch_time_str}"
+                compact_response += f" ({restaurant}, {batch_time_str})"
+        
+        response = sms_renderer.render('pay', response, compact_response)
         
         # Update conversation history
         user_history.append({'role': 'user', 'content': incoming_message})
@@ -2374,10 +3609,10 @@ def sms_webhook():
                     admin_note += "Note: Customer likely called in their order\n"
                 admin_note += f"Session ID: {payment_session_id}"
                 
-                twilio_client.messages.create(
-                    body=admin_note,
-                    from_=twilio_phone,
-                    to=notification_email
+                admin_digest.record(
+                    'pay_request',
+                    f"PAY requested by {from_number} ({restaurant if has_active_order else 'called-in order'})",
+                    admin_note
                 )
             except Exception as e:
                 logger.error(f"Error sending admin notification: {e}")
@@ -2397,7 +3632,7 @@ def sms_webhook():
         user_history.append({'role': 'assistant', 'content': response})
         active_sessions[clean_phone]['conversation_history'] = user_history
         
-        resp.message(response)
+        resp.message(sms_renderer.render('help', response))
         logger.info(f"Sent help info to {from_number} using TwiML")
     
     elif first_word == 'cancel':
@@ -2441,11 +3676,7 @@ def sms_webhook():
                         admin_note += f"Customer: {from_number}\n"
                         admin_note += f"Restaurant: {restaurant}\n"
                         
-                        twilio_client.messages.create(
-                            body=admin_note,
-                            from_=twilio_phone,
-                            to=notification_email
-                        )
+                        admin_digest.record('cancel', f"Cancelled {restaurant} order from {from_number}", admin_note)
                     except Exception as e:
                         logger.error(f"Error sending admin notification for cancellation: {e}")
             else:
@@ -2460,19 +3691,54 @@ def sms_webhook():
         user_history.append({'role': 'assistant', 'content': response})
         active_sessions[clean_phone]['conversation_history'] = user_history
         
-        resp.message(response)
+        resp.message(sms_renderer.render('cancel', response))
         logger.info(f"Processed cancellation request from {from_number}")
     
     else:
         # Process general message with AI assistance
         # Check if OpenAI API is available
         if openai_api_key:
-            # Use the improved AI response function that maintains better order flow
-            response = ai_generate_response(incoming_message, user_history)
+            def finish_reply(reply):
+                # Add a suggestion to use primary commands if not mentioned
+                if not any(keyword in reply.lower() for keyword in ['menu', 'order', 'pay']):
+                    reply += "\n\nText 'MENU' to see restaurant options or 'ORDER' followed by what you want."
+                return reply
+            
+            def send_late_reply(reply):
+                reply = finish_reply(reply)
+                # The request is over; take the session's current history
+                # under its lock rather than the list this request saw
+                with session_lock(clean_phone):
+                    history = active_sessions.get(clean_phone, {}).get('conversation_history')
+                    if history is not None:
+                        history.append({'role': 'user', 'content': incoming_message})
+                        history.append({'role': 'assistant', 'content': reply})
+                sms_outbox.enqueue(
+                    from_number,
+                    reply,
+                    kind='ai_reply',
+                    dedupe_key=f"ai_reply:{request_sid}" if request_sid else None
+                )
+                logger.info(f"Queued deferred AI response to {from_number}")
+            
+            # Use the improved AI response function that maintains better order flow.
+            # Without Twilio there is no way to send a late reply, so wait for it.
+            request_sid = request.values.get('MessageSid')
+            if twilio_client:
+                response = reply_within_budget(ai_generate_response, (incoming_message, list(user_history)), send_late_reply)
+            else:
+                response = ai_generate_response(incoming_message, user_history)
             
-            # Add a suggestion to use primary commands if not mentioned
-            if not any(keyword in response.lower() for keyword in ['menu', 'order', 'pay']):
-                response += "\n\nText 'MENU' to see restaurant options or 'ORDER' followed by what you want."
+            if response is None:
+                # Acknowledge now; the reply follows from the outbox
+                if SMS_HOLDING_REPLY:
+                    resp.message(sms_renderer.render('holding', SMS_HOLDING_REPLY))
+                active_sessions[clean_phone]['conversation_history'] = user_history
+                logger.info(f"AI response to {from_number} over {SMS_REPLY_BUDGET_SECONDS}s budget; replying later")
+                conn.close()
+                return str(resp)
+            
+            response = finish_reply(response)
         else:
             # Fallback response without AI
             response = "I didn't understand that command. Text 'MENU' to see restaurants, 'ORDER' followed by what you want, or 'PAY' to get a payment link. Need help? Text 'HELP' or call (708) 901-1754."
@@ -2482,12 +3748,44 @@ def sms_webhook():
         user_history.append({'role': 'assistant', 'content': response})
         active_sessions[clean_phone]['conversation_history'] = user_history
         
-        resp.message(response)
+        resp.message(sms_renderer.render('ai_reply', response))
         logger.info(f"Sent AI-powered response to {from_number} using TwiML")
     
     conn.close()
     return str(resp)
 
+def require_twilio_signature(signed_url=None):
+    """
+    Reject requests whose X-Twilio-Signature doesn't match TWILIO_AUTH_TOKEN
+    
+    Args:
+        signed_url: URL Twilio was given and signs (request.url if None;
+            behind a proxy the two can differ in scheme or host)
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            signature = request.headers.get('X-Twilio-Signature', '')
+            if not auth_token or not RequestValidator(auth_token).validate(signed_url or request.url, request.form, signature):
+                logger.warning(f"Rejected {request.path} request without a valid Twilio signature")
+                return jsonify({"error": "Invalid signature"}), 403
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@app.route('/webhook/sms-status', methods=['POST'])
+@require_twilio_signature(os.getenv('TWILIO_STATUS_CALLBACK_URL'))
+def sms_status_webhook():
+    """Twilio delivery status callback for texts sent from the outbox"""
+    message_sid = request.values.get('MessageSid')
+    status = request.values.get('MessageStatus')
+    if not message_sid or not status:
+        return jsonify({"error": "MessageSid and MessageStatus are required"}), 400
+    
+    if not sms_outbox.record_status(message_sid, status, request.values.get('ErrorCode')):
+        logger.warning(f"Status {status} for unknown message {message_sid}")
+    return '', 204
+
 @app.route('/test-sms')
 def test_sms_simple():
     # Test parameters
@@ -2631,40 +3929,14 @@ def test_sms_simple():
         # If Stripe is configured, create a real checkout session for testing
         if stripe_secret_key:
             try:
-                # Create a product for the food order
-                food_product = stripe.Product.create(
-                    name="TreeHouse Food Order",
-                    description=f"Your food order + ${delivery_fee:.2f} delivery fee"
-                )
-                
-                # Create a price with custom_unit_amount enabled
-                food_price = stripe.Price.create(
-                    product=food_product.id,
-                    currency="usd",
-                    custom_unit_amount={"enabled": True}
-                )
-                
-                # Create a checkout session with the custom amount price
-                checkout_session = stripe.checkout.Session.create(
-                    payment_method_types=['card'],
-                    line_items=[
-                        {
-                            'price': food_price.id,
-                            'quantity': 1
-                        }
-                    ],
-                    mode='payment',
+                # Create a checkout session with the cached custom amount price
+                checkout_session = create_order_checkout(
+                    clean_phone,
+                    user_id,
+                    delivery_fee,
                     success_url=request.base_url + '?result=success&session_id={CHECKOUT_SESSION_ID}',
                     cancel_url=request.base_url + '?result=cancel',
-                    metadata={
-                        'phone_number': clean_phone,
-                        'test': 'true',
-                        'user_id': str(user_id),
-                        'includes_delivery_fee': 'true'
-                    },
-                    custom_text={
-                        'submit': {'message': 'Pay for order'}
-                    }
+                    metadata={'test': 'true'}
                 )
                 
                 payment_session_id = checkout_session.id
@@ -3137,128 +4409,62 @@ def stripe_webhook():
         logger.error(f"Invalid Stripe signature: {e}")
         return jsonify({"error": "Invalid signature"}), 400
     
-    # Handle the checkout.session.completed event
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        
-        # Extract metadata
-        phone_number = session.get('metadata', {}).get('phone_number')
-        user_id = session.get('metadata', {}).get('user_id')
-        
-        if phone_number and user_id:
-            # Get payment details
-            payment_amount = session.get('amount_total', 0) / 100  # Convert cents to dollars
-            payment_id = session.get('id')
-            
-            # Record payment in database
-            try:
-                conn = sqlite3.connect('treehouse.db')
-                c = conn.cursor()
-                
-                # Create a record in your payments table
-                c.execute(
-                    "INSERT INTO payments (order_id, amount, payment_method, transaction_id, status) VALUES (?, ?, ?, ?, ?)",
-                    (0, payment_amount, "stripe", payment_id, "completed")
-                )
-                
-                conn.commit()
-                conn.close()
-                logger.info(f"Payment recorded for user_id {user_id}, amount ${payment_amount}")
-                
-                # Notify the user about successful payment
-                if twilio_client:
-                    try:
-                        # Get batch information if available
-                        batch_time_str = "upcoming batch"
-                        restaurant = "your order"
-                        batch_location = "your location"
-                        
-                        if phone_number in active_sessions:
-                            phone_session = active_sessions[phone_number]
-                            restaurant = phone_session.get('restaurant', 'your order')
-                            
-                            if 'batch_info' in phone_session:
-                                batch_info = phone_session['batch_info']
-                                
-                                if batch_info and 'batch_time' in batch_info:
-                                    batch_time = batch_info['batch_time']
-                                    batch_time_str = datetime.fromisoformat(str(batch_time)).strftime("%I:%M %p") if isinstance(batch_time, str) else batch_time.strftime("%I:%M %p")
-                                
-                                if batch_info and 'location' in batch_info:
-                                    batch_location = batch_info['location']
-                        
-                        # Create confirmation message
-                        confirmation = f"""Payment confirmed! Your {restaurant} order is set for pickup at {batch_location} between {batch_time_str}-{batch_time_str[:-3]}:03{batch_time_str[-3:]}.
-
-Your batch is currently 5/10 full.
-
-We'll text you when the batch is locked in.
+    # Store the event and answer straight away so Stripe doesn't time out
+    # and redeliver; the stripe_event job does the work once per event id
+    if not stripe_events.record(event.to_dict()):
+        logger.info(f"Ignoring redelivered Stripe event {event['id']}")
+        return jsonify({"status": "duplicate"}), 200
+    
+    job_queue.enqueue('stripe_event', {'event_id': event['id']}, dedupe_key=f"stripe_event:{event['id']}")
+    logger.info(f"Queued Stripe event {event['id']} ({event['type']})")
+    
+    return jsonify({"status": "success"}), 200
 
-Reply "CANCEL" within the next 10 minutes if you need to cancel."""
-                        
-                        message = twilio_client.messages.create(
-                            body=confirmation,
-                            from_=twilio_phone,
-                            to=f"+{phone_number}"
-                        )
-                        logger.info(f"Payment confirmation sent to +{phone_number}")
-                        
-                        # Also simulate the "batch locked in" message after 30 seconds
-                        import threading
-                        def send_batch_confirmation():
-                            time.sleep(30)  # Wait 30 seconds
-                            try:
-                                batch_confirm = f"""Your {restaurant} batch is locked in!
 
-5 orders total. Delivery to {batch_location} at {batch_time_str}.
+@app.cli.command('replay-stripe-events')
+@click.option('--event-id', 'event_ids', multiple=True, help='Process this event again, even if already processed')
+@click.option('--backfill-hours', type=float, default=0, help='Fetch events from Stripe for the last N hours and process any never received')
+def replay_stripe_events(event_ids, backfill_hours):
+    """
+    Process stored Stripe events that failed or never ran, in this process
+    
+    With --backfill-hours, events Stripe has (up to 30 days) but the webhook
+    never stored are fetched and processed too. Each event still runs once.
+    """
+    if backfill_hours:
+        since = int(time.time() - backfill_hours * 3600)
+        fetched = stored = 0
+        for event_type in STRIPE_EVENT_HANDLERS:
+            for event in stripe.Event.list(type=event_type, created={'gte': since}, limit=100).auto_paging_iter():
+                fetched += 1
+                stored += stripe_events.record(event.to_dict())
+        click.echo(f"Fetched {fetched} events from Stripe, {stored} not seen before")
+    
+    pending = stripe_events.event_ids(['received', 'failed', 'processing'])
+    processed = failed = 0
+    for event_id, force in [(event_id, True) for event_id in event_ids] + [(event_id, False) for event_id in pending]:
+        try:
+            processed += process_stripe_event({'event_id': event_id}, force=force)
+        except Exception as e:
+            failed += 1
+            click.echo(f"{event_id}: {e}", err=True)
+    
+    click.echo(f"Processed {processed} events, {failed} failed")
 
-Your pickup window: {batch_time_str}-{batch_time_str[:-3]}:03{batch_time_str[-3:]}"""
-                                
-                                twilio_client.messages.create(
-                                    body=batch_confirm,
-                                    from_=twilio_phone,
-                                    to=f"+{phone_number}"
-                                )
-                                logger.info(f"Batch confirmation sent to +{phone_number}")
-                            except Exception as e:
-                                logger.error(f"Error sending batch confirmation: {e}")
-                        
-                        # Start the timer thread
-                        timer_thread = threading.Thread(target=send_batch_confirmation)
-                        timer_thread.daemon = True
-                        timer_thread.start()
-                        
-                    except Exception as e:
-                        logger.error(f"Error sending payment confirmation: {e}")
-                
-                # Notify admin about payment
-                if twilio_client:
-                    try:
-                        # Get order details if available
-                        order_details = ""
-                        if phone_number in active_sessions:
-                            order_text = active_sessions[phone_number].get('order_text', '')
-                            restaurant = active_sessions[phone_number].get('restaurant', '')
-                            
-                            if order_text:
-                                order_details = f"\nOrder: {order_text}"
-                            
-                            if restaurant:
-                                order_details += f"\nRestaurant: {restaurant}"
-                        
-                        twilio_client.messages.create(
-                            body=f"Payment received! Phone: +{phone_number}, Amount: ${payment_amount:.2f}, Stripe ID: {payment_id}{order_details}",
-                            from_=twilio_phone,
-                            to=notification_email
-                        )
-                        logger.info(f"Admin payment notification sent")
-                    except Exception as e:
-                        logger.error(f"Error sending admin payment notification: {e}")
-                
-            except Exception as e:
-                logger.error(f"Error recording payment: {e}")
+@app.cli.command('reconcile-payments')
+@click.argument('export_csv', required=False, type=click.Path(exists=True, dir_okay=False))
+def reconcile_payments_command(export_csv):
+    """
+    Match Stripe checkout sessions, payments and orders in bulk
     
-    return jsonify({"status": "success"}), 200
+    EXPORT_CSV is a Checkout Sessions export from the Stripe dashboard; paid
+    sessions missing from payments are added and linked to their orders.
+    Without it only the local checkout_sessions table is used.
+    """
+    export = load_export(export_csv) if export_csv else None
+    stats = checkout_index.reconcile(export)
+    for name, count in stats.items():
+        click.echo(f"{name}: {count}")
 
 
 @app.route('/privacy-policy.html')
@@ -3365,8 +4571,10 @@ def serve_react_files(path):
         return send_from_directory('static/react', 'index.html')
 
 if __name__ == '__main__':
-    # Start the scheduler
-    start_scheduler()
+    # The scheduler is started by the leader lease once this process wins it;
+    # with the reloader only the child that serves requests takes part
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     
     # Run the Flask app
     port = int(os.environ.get('PORT', 5001))
@@ -0,0 +1,169 @@
+"""
+Benchmark UberDirectDelivery against the local Uber Direct stub
+
+    python bench_uber_direct.py --deliveries 200 --latency 0.005
+    python bench_uber_direct.py --scenario batch --batches 5 --latency 0.05
+    python bench_uber_direct.py --scenario async --batches 20 --latency 0.05
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+from uber_direct_delivery import UberDirectDelivery
+from uber_direct_stub import UberDirectStub
+
+
+class UnpooledUberDirectDelivery(UberDirectDelivery):
+    """The pre-session behaviour: module-level requests.post per call"""
+
+    def _post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return requests.post(url, **kwargs)
+
+
+def make_client(cls, stub, **kwargs):
+    kwargs.setdefault('rate_limit', 1000)
+    kwargs.setdefault('rate_burst', 1000)
+    return cls(
+        client_id="bench",
+        client_secret="bench",
+        customer_id="bench-customer",
+        auth_url=stub.auth_url,
+        api_base_url=stub.url,
+        **kwargs
+    )
+
+
+def run_deliveries(client, count):
+    """Time quote + delivery pairs, returning per-delivery latencies in ms"""
+    orders = [{"customer_name": "Bench", "order_number": "1"}]
+    latencies = []
+
+    for _ in range(count):
+        started = time.perf_counter()
+        quote = client.create_quote("Chipotle", "Library")
+        client.create_delivery("Chipotle", "Library", orders, quote)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    return latencies
+
+
+def report(name, latencies, stub_stats):
+    latencies = sorted(latencies)
+    p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+    print(
+        f"{name:<10} mean={statistics.mean(latencies):7.2f}ms "
+        f"p50={statistics.median(latencies):7.2f}ms p99={p99:7.2f}ms "
+        f"connections={stub_stats.get('connections', 0)} requests={stub_stats.get('requests', 0)}"
+    )
+
+
+def bench_session(args):
+    for name, cls in (("unpooled", UnpooledUberDirectDelivery), ("pooled", UberDirectDelivery)):
+        with UberDirectStub(latency=args.latency) as stub:
+            client = make_client(cls, stub)
+            # Token fetch is not part of the per-delivery cost
+            client.get_access_token()
+            stub.stats.clear()
+            report(name, run_deliveries(client, args.deliveries), stub.stats)
+            client.close()
+
+
+def make_batch():
+    orders = [{"customer_name": "Bench", "order_number": "1", "order_id": 1}]
+    return {
+        "batch_id": 1,
+        "restaurants": {
+            name: list(orders)
+            for name in ("Chipotle", "McDonald's", "Chick-fil-A", "Portillo's", "Starbucks")
+        }
+    }
+
+
+def bench_batch(args):
+    batch = make_batch()
+    runs = (
+        ("sequential", {"max_concurrency": 1}),
+        ("concurrent", {"max_concurrency": 5}),
+        ("limited", {"max_concurrency": 5, "rate_limit": args.rate_limit, "rate_burst": args.rate_burst})
+    )
+
+    for name, kwargs in runs:
+        with UberDirectStub(latency=args.latency) as stub:
+            client = make_client(UberDirectDelivery, stub, **kwargs)
+            client.get_access_token()
+            stub.stats.clear()
+
+            latencies = []
+            for _ in range(args.batches):
+                started = time.perf_counter()
+                deliveries = client.process_batch(batch)
+                latencies.append((time.perf_counter() - started) * 1000)
+                assert len(deliveries) == len(batch["restaurants"])
+
+            report(name, latencies, stub.stats)
+            client.close()
+
+    # The old loop also slept 1s after every restaurant
+    print(f"(pre-change sequential loop added {len(batch['restaurants'])}s of sleep per batch)")
+
+
+def bench_async(args):
+    """Many batches at once: blocking client on threads vs one event loop"""
+    from uber_direct_async import AsyncUberDirectDelivery
+
+    batches = [make_batch() for _ in range(args.batches)]
+
+    with UberDirectStub(latency=args.latency) as stub:
+        # 4 batch workers x 5 restaurants each need 20 pooled connections
+        client = make_client(UberDirectDelivery, stub, pool_size=20)
+        client.get_access_token()
+        stub.stats.clear()
+
+        started = time.perf_counter()
+        # Matches the default BATCH_WORKERS pool in app.py
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(client.process_batch, batches))
+        report("threads", [(time.perf_counter() - started) * 1000], stub.stats)
+        client.close()
+
+    with UberDirectStub(latency=args.latency) as stub:
+        client = make_client(AsyncUberDirectDelivery, stub)
+        client.token_provider.get_token()
+        stub.stats.clear()
+
+        async def run():
+            await asyncio.gather(*(client.process_batch(batch) for batch in batches))
+            await client.close()
+
+        started = time.perf_counter()
+        asyncio.run(run())
+        report("asyncio", [(time.perf_counter() - started) * 1000], stub.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--deliveries', type=int, default=200, help="Quote + delivery pairs per run")
+    parser.add_argument('--latency', type=float, default=0.0, help="Stub server latency per request (seconds)")
+    parser.add_argument('--scenario', choices=('session', 'batch', 'async'), default='session')
+    parser.add_argument('--batches', type=int, default=5, help="Batches per run for the batch scenario")
+    parser.add_argument('--rate-limit', type=float, default=5.0, help="Requests per second for the limited batch run")
+    parser.add_argument('--rate-burst', type=int, default=10, help="Burst size for the limited batch run")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    if args.scenario == 'batch':
+        bench_batch(args)
+    elif args.scenario == 'async':
+        bench_async(args)
+    else:
+        bench_session(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+import csv
+import sqlite3
+import time
+import logging
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+# Header names accepted in a Checkout Sessions export, first match wins
+EXPORT_COLUMNS = {
+    'session_id': ('checkout_session_id', 'Checkout Session ID', 'id', 'ID'),
+    'amount_cents': ('amount_total', 'Amount Total (cents)'),
+    'amount': ('Amount Total', 'Amount', 'amount'),
+    'status': ('payment_status', 'Payment Status', 'status', 'Status'),
+    'order_id': ('metadata[order_id]', 'order_id (metadata)', 'metadata.order_id', 'order_id'),
+    'phone_number': ('metadata[phone_number]', 'phone_number (metadata)', 'metadata.phone_number', 'phone_number')
+}
+PAID_STATUSES = {'paid', 'complete', 'succeeded', 'no_payment_required'}
+
+
+def load_export(path: str) -> List[Dict[str, Any]]:
+    """
+    Read a Stripe Checkout Sessions CSV export
+
+    Args:
+        path: CSV file with a session id column plus amount, payment status
+            and metadata columns where available (see EXPORT_COLUMNS)
+
+    Returns:
+        list: Dicts with session_id, amount (dollars), paid, order_id, phone_number
+
+    Raises:
+        ValueError: If the export has no session id or payment status column
+    """
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        headers = reader.fieldnames or []
+        columns = {
+            field: next((name for name in names if name in headers), None)
+            for field, names in EXPORT_COLUMNS.items()
+        }
+        # Without a status every session would look paid
+        for field in ('session_id', 'status'):
+            if not columns[field]:
+                raise ValueError(f"{path} has no {field} column (expected one of {EXPORT_COLUMNS[field]})")
+
+        def value(record, field):
+            return (record.get(columns[field]) or '').strip() if columns[field] else ''
+
+        rows = []
+        for line, record in enumerate(reader, start=2):
+            session_id = value(record, 'session_id')
+            if not session_id.startswith('cs_'):
+                continue
+
+            # amount_total is cents ("1200"), but some tools write it in
+            # dollars ("12.00"); the formatted amount looks like "$1,200.00"
+            try:
+                if value(record, 'amount_cents'):
+                    cents = value(record, 'amount_cents')
+                    amount = float(Decimal(cents) if '.' in cents else Decimal(cents) / 100)
+                elif value(record, 'amount'):
+                    amount = float(Decimal(value(record, 'amount').replace(',', '').lstrip('$')))
+                else:
+                    amount = None
+            except InvalidOperation:
+                logger.warning(f"{path} line {line}: skipping {session_id}, unreadable amount")
+                continue
+
+            order_id = value(record, 'order_id')
+            rows.append({
+                'session_id': session_id,
+                'amount': amount,
+                'paid': value(record, 'status').lower() in PAID_STATUSES,
+                'order_id': int(order_id) if order_id.isdigit() else None,
+                'phone_number': value(record, 'phone_number') or None
+            })
+
+    return rows
+
+
+class CheckoutSessionIndex(SqliteStore):
+    SCHEMA = (
+        '''
+            CREATE TABLE IF NOT EXISTS checkout_sessions (
+                session_id TEXT PRIMARY KEY,
+                user_id INTEGER,
+                phone_number TEXT,
+                order_id INTEGER,
+                delivery_fee DECIMAL(5,2),
+                restaurant TEXT,
+                order_text TEXT,
+                batch_time TEXT,
+                location TEXT,
+                status TEXT NOT NULL DEFAULT 'open',
+                amount_paid DECIMAL(10,2),
+                payment_id INTEGER,
+                created_at REAL NOT NULL,
+                paid_at REAL
+            )
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS idx_checkout_sessions_order
+            ON checkout_sessions (order_id)
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS idx_checkout_sessions_phone
+            ON checkout_sessions (phone_number, created_at)
+        ''',
+    )
+    COLUMNS = {'checkout_sessions': {'location': 'TEXT'}}
+
+    def __init__(self, db_path: str):
+        """
+        Which user, order and SMS conversation each Checkout Session belongs to
+
+        A row is written when the checkout link is created, so a payment can be
+        tied to its order by session id (the payments.transaction_id) instead
+        of guessing from in-memory sessions. Reconciliation fills in
+        payments.order_id and adds payments the webhook never delivered, in
+        bulk SQL over the local table and an optional Stripe export.
+
+        Args:
+            db_path: Path to the SQLite database
+        """
+        self.db_path = db_path
+
+        self._init_table()
+
+    def record(self, session_id: str, user_id: Optional[int], phone_number: Optional[str],
+               delivery_fee: float, order_id: Optional[int] = None, restaurant: Optional[str] = None,
+               order_text: Optional[str] = None, batch_time: Optional[str] = None,
+               location: Optional[str] = None):
+        """Store who a new Checkout Session is for"""
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO checkout_sessions "
+            "(session_id, user_id, phone_number, order_id, delivery_fee, restaurant, order_text, batch_time, location, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (session_id, user_id, phone_number, order_id, delivery_fee, restaurant, order_text, batch_time, location, time.time())
+        )
+        conn.commit()
+        conn.close()
+
+    def lookup(self, session_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM checkout_sessions WHERE session_id = ?", (session_id,)).fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    def mark_paid(self, session_id: str, amount: float, payment_id: Optional[int] = None):
+        conn = self._connect()
+        conn.execute(
+            "UPDATE checkout_sessions SET status = 'paid', amount_paid = ?, "
+            "payment_id = COALESCE(?, payment_id), paid_at = COALESCE(paid_at, ?) WHERE session_id = ?",
+            (amount, payment_id, time.time(), session_id)
+        )
+        conn.commit()
+        conn.close()
+
+    def _link(self, c: sqlite3.Cursor) -> Dict[str, int]:
+        """Tie payments and paid sessions together by session id"""
+        # Payments recorded without an order take the session's order
+        c.execute('''
+            UPDATE payments SET order_id = (
+                SELECT cs.order_id FROM checkout_sessions cs WHERE cs.session_id = payments.transaction_id
+            )
+            WHERE order_id = 0 AND EXISTS (
+                SELECT 1 FROM checkout_sessions cs
+                WHERE cs.session_id = payments.transaction_id AND cs.order_id IS NOT NULL
+            )
+        ''')
+        orders_linked = c.rowcount
+
+        c.execute('''
+            UPDATE checkout_sessions SET
+                status = 'paid',
+                payment_id = (SELECT MIN(p.id) FROM payments p WHERE p.transaction_id = checkout_sessions.session_id),
+                amount_paid = COALESCE(amount_paid, (SELECT MIN(p.amount) FROM payments p WHERE p.transaction_id = checkout_sessions.session_id)),
+                paid_at = COALESCE(paid_at, ?)
+            WHERE payment_id IS NULL AND EXISTS (
+                SELECT 1 FROM payments p WHERE p.transaction_id = checkout_sessions.session_id
+            )
+        ''', (time.time(),))
+        return {"orders_linked": orders_linked, "sessions_linked": c.rowcount}
+
+    def reconcile(self, export: Optional[Iterable[Dict[str, Any]]] = None) -> Dict[str, int]:
+        """
+        Match payments, checkout sessions and orders in bulk
+
+        Args:
+            export: Rows from load_export; paid sessions missing from payments
+                are added, and their metadata order id fills gaps locally
+
+        Returns:
+            dict: Counts of what was added and linked
+        """
+        conn = self._connect()
+        c = conn.cursor()
+        stats = {"export_rows": 0, "unknown_sessions": 0, "payments_added": 0}
+
+        try:
+            if export is not None:
+                c.execute('''
+                    CREATE TEMP TABLE IF NOT EXISTS stripe_export (
+                        session_id TEXT PRIMARY KEY,
+                        amount DECIMAL(10,2),
+                        paid INTEGER,
+                        order_id INTEGER,
+                        phone_number TEXT
+                    )
+                ''')
+                c.execute("DELETE FROM stripe_export")
+                c.executemany(
+                    "INSERT OR REPLACE INTO stripe_export (session_id, amount, paid, order_id, phone_number) VALUES (?, ?, ?, ?, ?)",
+                    [(row['session_id'], row['amount'], int(row['paid']), row['order_id'], row['phone_number']) for row in export]
+                )
+                stats["export_rows"] = c.execute("SELECT COUNT(*) FROM stripe_export").fetchone()[0]
+
+                # Sessions created before this table existed
+                c.execute('''
+                    INSERT OR IGNORE INTO checkout_sessions (session_id, phone_number, order_id, created_at)
+                    SELECT session_id, phone_number, order_id, ? FROM stripe_export
+                ''', (time.time(),))
+                stats["unknown_sessions"] = c.rowcount
+
+                c.execute('''
+                    UPDATE checkout_sessions SET order_id = (
+                        SELECT e.order_id FROM stripe_export e WHERE e.session_id = checkout_sessions.session_id
+                    )
+                    WHERE order_id IS NULL AND EXISTS (
+                        SELECT 1 FROM stripe_export e
+                        WHERE e.session_id = checkout_sessions.session_id AND e.order_id IS NOT NULL
+                    )
+                ''')
+
+                # Paid in Stripe but the webhook never recorded it
+                c.execute('''
+                    INSERT INTO payments (order_id, amount, payment_method, transaction_id, status)
+                    SELECT COALESCE(cs.order_id, 0), e.amount, 'stripe', e.session_id, 'completed'
+                    FROM stripe_export e
+                    JOIN checkout_sessions cs ON cs.session_id = e.session_id
+                    WHERE e.paid = 1 AND e.amount IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.transaction_id = e.session_id)
+                ''')
+                stats["payments_added"] = c.rowcount
+
+            stats.update(self._link(c))
+            stats["payments_unlinked"] = c.execute(
+                "SELECT COUNT(*) FROM payments WHERE order_id = 0 AND payment_method = 'stripe'"
+            ).fetchone()[0]
+            conn.commit()
+        finally:
+            conn.close()
+
+        if stats["payments_added"] or stats["orders_linked"]:
+            logger.info(f"Payment reconciliation: {stats}")
+        return stats
+
+    def snapshot(self) -> Dict[str, Any]:
+        conn = self._connect()
+        statuses = dict(conn.execute("SELECT status, COUNT(*) FROM checkout_sessions GROUP BY status").fetchall())
+        with_order = conn.execute("SELECT COUNT(*) FROM checkout_sessions WHERE order_id IS NOT NULL").fetchone()[0]
+        unlinked = conn.execute(
+            "SELECT COUNT(*) FROM payments WHERE order_id = 0 AND payment_method = 'stripe'"
+        ).fetchone()[0]
+        conn.close()
+
+        return {
+            "sessions": statuses,
+            "sessions_with_order": with_order,
+            "payments_without_order": unlinked
+        }
@@ -0,0 +1,13 @@
+# Loaded by gunicorn from the working directory: gunicorn app:app
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5001)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+
+def post_worker_init(worker):
+    # Runs in each worker once the app is loaded, after the fork, so the
+    # leader lease, job queue and SMS sender start without waiting for a
+    # request and never in the preloading master
+    from app import start_background_services
+    start_background_services()
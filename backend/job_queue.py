@@ -0,0 +1,411 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    def __init__(self, tick: float = 1.0, size: int = 512):
+        """
+        Hashed timer wheel holding job ids by due time
+
+        Adding and firing a timer are O(1), so thousands of pending timers cost
+        one slot lookup per tick instead of one sleeping thread each.
+
+        Args:
+            tick: Resolution of the wheel in seconds
+            size: Number of slots (the wheel spans tick * size seconds)
+        """
+        self.tick = tick
+        self.size = size
+        self.slots = [[] for _ in range(size)]
+        self.current_tick = int(time.time() / tick)
+        self.count = 0
+
+    def add(self, job_id: int, run_at: float):
+        due_tick = max(int(run_at / self.tick), self.current_tick)
+        self.slots[due_tick % self.size].append((due_tick, job_id))
+        self.count += 1
+
+    def advance(self, now: float) -> list:
+        """
+        Move the wheel up to now
+
+        Returns:
+            list: Job ids that are due
+        """
+        due = []
+        target_tick = int(now / self.tick)
+
+        while self.current_tick <= target_tick:
+            slot_index = self.current_tick % self.size
+            slot = self.slots[slot_index]
+            if slot:
+                # Entries for a later rotation stay in the slot
+                keep = []
+                for due_tick, job_id in slot:
+                    if due_tick <= self.current_tick:
+                        due.append(job_id)
+                    else:
+                        keep.append((due_tick, job_id))
+                self.slots[slot_index] = keep
+            self.current_tick += 1
+
+        # Stay on the current tick so timers added before the next advance
+        # still land in a slot that will be visited
+        self.current_tick = target_tick
+        self.count -= len(due)
+        return due
+
+
+class DurableJobQueue(SqliteStore):
+    SCHEMA = (
+        '''
+            CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT,
+                run_at REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                dedupe_key TEXT UNIQUE,
+                locked_at REAL,
+                locked_by TEXT,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_status_run_at
+            ON scheduled_jobs (status, run_at)
+        ''',
+    )
+    COLUMNS = {'scheduled_jobs': {'locked_at': 'REAL', 'locked_by': 'TEXT'}}
+
+    def __init__(self, db_path: str, tick: float = 1.0, wheel_size: int = 512,
+                 horizon: float = 300.0, refresh_interval: float = 60.0,
+                 max_workers: int = 4, max_attempts: int = 5, retry_delay: float = 30.0,
+                 lease_timeout: float = 900.0,
+                 on_complete: Optional[Callable[[str, float, float, str], None]] = None):
+        """
+        SQLite-backed delayed job queue with a single timer-wheel dispatcher
+
+        Any process can enqueue; jobs survive restarts because they live in the
+        scheduled_jobs table. Only the process that calls start() dispatches,
+        loading jobs due within the horizon into an in-memory timer wheel and
+        running handlers on a small worker pool. Jobs enqueued in the
+        dispatching process go straight into the wheel; the table is only
+        polled every refresh_interval to pick up jobs from other processes,
+        and the dispatcher sleeps through idle periods until that poll.
+
+        Args:
+            db_path: Path to the SQLite database
+            tick: Timer wheel resolution in seconds
+            wheel_size: Number of timer wheel slots
+            horizon: How far ahead (seconds) jobs are loaded into the wheel
+            refresh_interval: Seconds between polls for jobs enqueued by other
+                processes (the most such a job waits past its run time)
+            max_workers: Size of the handler thread pool
+            max_attempts: Attempts before a failing job is marked failed
+            retry_delay: Base delay in seconds before retrying a failed job
+            lease_timeout: Seconds without a heartbeat before another
+                dispatcher treats a running job's owner as dead and runs it
+                again; the owner renews its running jobs every third of this
+            on_complete: Called with (kind, lag, duration, outcome) after each run
+        """
+        self.db_path = db_path
+        self.tick = tick
+        self.wheel_size = wheel_size
+        # Loading past one rotation would make the wheel wrap
+        self.horizon = min(horizon, tick * wheel_size)
+        self.refresh_interval = refresh_interval
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_timeout = lease_timeout
+        self.owner = None
+        self.on_complete = on_complete
+        self.handlers = {}
+
+        self._wheel = None
+        self._loaded = set()
+        self._running = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+
+        self._init_table()
+
+    def register(self, kind: str, handler: Callable[[Dict[str, Any]], Any]):
+        """
+        Register the handler for a job kind
+
+        Args:
+            kind: Job kind passed to enqueue
+            handler: Called with the job payload; raising schedules a retry
+        """
+        self.handlers[kind] = handler
+
+    def enqueue(self, kind: str, payload: Optional[Dict[str, Any]] = None,
+                run_at: Optional[float] = None, delay: float = 0,
+                dedupe_key: Optional[str] = None) -> Optional[int]:
+        """
+        Persist a job to run at a given time
+
+        Args:
+            kind: Job kind (must have a registered handler in the dispatcher)
+            payload: JSON-serialisable job arguments
+            run_at: Unix timestamp to run at (defaults to now + delay)
+            delay: Seconds from now, used when run_at is not given
+            dedupe_key: Jobs with a key already in the table are ignored
+
+        Returns:
+            int: Job ID, or None if the dedupe key already exists
+        """
+        if run_at is None:
+            run_at = time.time() + delay
+
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute(
+            "INSERT OR IGNORE INTO scheduled_jobs (kind, payload, run_at, dedupe_key) VALUES (?, ?, ?, ?)",
+            (kind, json.dumps(payload or {}), run_at, dedupe_key)
+        )
+        job_id = c.lastrowid if c.rowcount == 1 else None
+        conn.commit()
+        conn.close()
+
+        # A local dispatcher takes the job straight into its wheel
+        if job_id is not None:
+            self._schedule(job_id, run_at)
+
+        return job_id
+
+    def pending_count(self) -> int:
+        conn = self._connect()
+        count = conn.execute("SELECT COUNT(*) FROM scheduled_jobs WHERE status = 'pending'").fetchone()[0]
+        conn.close()
+        return count
+
+    def _requeue_stale(self, now: float):
+        """Return jobs whose owner stopped renewing past the lease timeout"""
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute(
+            "UPDATE scheduled_jobs SET status = 'pending', locked_by = NULL "
+            "WHERE status = 'running' AND (locked_at IS NULL OR locked_at < ?)",
+            (now - self.lease_timeout,)
+        )
+        if c.rowcount:
+            logger.warning(f"Re-queued {c.rowcount} jobs left running past the {self.lease_timeout:.0f}s lease")
+        conn.commit()
+        conn.close()
+
+    def _renew_leases(self, now: float):
+        """Heartbeat the jobs this dispatcher is running so they are not taken over"""
+        with self._lock:
+            running = list(self._running)
+        if not running:
+            return
+
+        conn = self._connect()
+        conn.execute(
+            f"UPDATE scheduled_jobs SET locked_at = ? WHERE status = 'running' AND locked_by = ? "
+            f"AND id IN ({', '.join('?' * len(running))})",
+            [now, self.owner] + running
+        )
+        conn.commit()
+        conn.close()
+
+    def _schedule(self, job_id: int, run_at: float):
+        """Put a job in this process's wheel if it is dispatching and the job is due soon"""
+        if run_at - time.time() >= self.horizon:
+            return
+        with self._lock:
+            if self._wheel is None or self._stop.is_set() or job_id in self._loaded:
+                return
+            self._loaded.add(job_id)
+            self._wheel.add(job_id, run_at)
+        self._wake.set()
+
+    def _load_due(self, now: float):
+        """Add pending jobs due within the horizon to the wheel"""
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT id, run_at FROM scheduled_jobs WHERE status = 'pending' AND run_at <= ?",
+            (now + self.horizon,)
+        ).fetchall()
+        conn.close()
+
+        with self._lock:
+            for job_id, run_at in rows:
+                if job_id not in self._loaded:
+                    self._loaded.add(job_id)
+                    self._wheel.add(job_id, run_at)
+
+    def _claim(self, job_id: int) -> Optional[sqlite3.Row]:
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute(
+            "UPDATE scheduled_jobs SET status = 'running', attempts = attempts + 1, locked_at = ?, locked_by = ? "
+            "WHERE id = ? AND status = 'pending'",
+            (time.time(), self.owner, job_id)
+        )
+        job = None
+        if c.rowcount == 1:
+            c.execute("SELECT id, kind, payload, run_at, attempts FROM scheduled_jobs WHERE id = ?", (job_id,))
+            job = c.fetchone()
+        conn.commit()
+        conn.close()
+        return job
+
+    def _finish(self, job_id: int, status: str, error: Optional[str] = None, run_at: Optional[float] = None):
+        # Only the owner may finish a job; if its lease expired and another
+        # dispatcher took the job over, that dispatcher's result stands
+        conn = self._connect()
+        if status == 'pending':
+            conn.execute(
+                "UPDATE scheduled_jobs SET status = 'pending', run_at = ?, last_error = ?, locked_by = NULL "
+                "WHERE id = ? AND locked_by = ?",
+                (run_at, error, job_id, self.owner)
+            )
+        else:
+            conn.execute(
+                "UPDATE scheduled_jobs SET status = ?, last_error = ?, finished_at = CURRENT_TIMESTAMP "
+                "WHERE id = ? AND locked_by = ?",
+                (status, error, job_id, self.owner)
+            )
+        conn.commit()
+        conn.close()
+
+    def _execute(self, job):
+        job_id = job['id']
+        kind = job['kind']
+        handler = self.handlers.get(kind)
+        lag = time.time() - job['run_at']
+        started = time.perf_counter()
+
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for job kind '{kind}'")
+
+            handler(json.loads(job['payload'] or '{}'))
+            self._finish(job_id, 'done')
+            outcome = 'success'
+        except Exception as e:
+            if job['attempts'] < self.max_attempts:
+                retry_at = time.time() + self.retry_delay * (2 ** (job['attempts'] - 1))
+                logger.error(f"Job {job_id} ({kind}) failed, retrying at {time.ctime(retry_at)}: {e}")
+                self._finish(job_id, 'pending', str(e), retry_at)
+                self._schedule(job_id, retry_at)
+                outcome = 'retry'
+            else:
+                logger.error(f"Job {job_id} ({kind}) failed after {job['attempts']} attempts: {e}")
+                self._finish(job_id, 'failed', str(e))
+                outcome = 'error'
+
+        with self._lock:
+            self._running.discard(job_id)
+
+        if self.on_complete:
+            try:
+                self.on_complete(kind, lag, time.perf_counter() - started, outcome)
+            except Exception as e:
+                logger.error(f"Error in job completion callback: {e}")
+
+    def _fire(self, job_ids):
+        for job_id in job_ids:
+            with self._lock:
+                self._loaded.discard(job_id)
+
+            job = self._claim(job_id)
+            if job is not None:
+                with self._lock:
+                    self._running.add(job_id)
+                self._executor.submit(self._execute, job)
+
+    def _run(self):
+        next_refresh = 0.0
+        renew_interval = self.lease_timeout / 3
+        next_renew = time.time() + renew_interval
+
+        while not self._stop.is_set():
+            self._wake.clear()
+            now = time.time()
+            waiting = 0
+
+            try:
+                if now >= next_renew:
+                    self._renew_leases(now)
+                    next_renew = now + renew_interval
+
+                if now >= next_refresh:
+                    self._requeue_stale(now)
+                    self._load_due(now)
+                    next_refresh = now + self.refresh_interval
+
+                with self._lock:
+                    due = self._wheel.advance(now)
+                    waiting = self._wheel.count
+                self._fire(due)
+            except Exception as e:
+                logger.error(f"Error in job dispatcher: {e}")
+
+            # With timers in the wheel, sleep to the next tick; with none,
+            # sleep until the next poll. A local enqueue wakes us either way.
+            if waiting:
+                timeout = self.tick - (time.time() % self.tick)
+            else:
+                timeout = next_refresh - time.time()
+            if self._running:
+                timeout = min(timeout, next_renew - time.time())
+            self._wake.wait(max(timeout, 0.01))
+
+    def start(self):
+        """Start dispatching jobs in this process"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        # Owner is taken at start so it follows the process after a fork
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        # Jobs still within their lease may be running in a dispatcher that
+        # has not noticed it lost leadership; only expired ones are retaken
+        self._requeue_stale(time.time())
+
+        self._wheel = TimerWheel(self.tick, self.wheel_size)
+        self._loaded = set()
+        self._running = set()
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job-worker')
+        self._thread = threading.Thread(target=self._run, name='job-dispatcher', daemon=True)
+        self._thread.start()
+        logger.info("Started job dispatcher")
+
+    def stop(self):
+        """Stop dispatching; pending jobs stay in the table"""
+        if not self._thread:
+            return
+
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=self.tick * 2)
+        self._thread = None
+        with self._lock:
+            self._wheel = None
+        self._executor.shutdown(wait=False)
+        logger.info("Stopped job dispatcher")
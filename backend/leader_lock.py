@@ -0,0 +1,166 @@
+import os
+import socket
+import threading
+import time
+import uuid
+import logging
+from typing import Callable, Optional
+
+from sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLease(SqliteStore):
+    SCHEMA = (
+        '''
+            CREATE TABLE IF NOT EXISTS leader_leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''',
+    )
+
+    def __init__(self, db_path: str, name: str, ttl: float = 15.0,
+                 heartbeat_interval: float = 5.0,
+                 on_elected: Optional[Callable[[], None]] = None,
+                 on_demoted: Optional[Callable[[], None]] = None):
+        """
+        Lease-based leader election backed by a SQLite row
+
+        Every process that wants to run the scheduler creates a lease with the
+        same name. The holder renews the row on each heartbeat; if it stops
+        renewing (crash, kill -9) another process takes over once the lease
+        expires. A clean shutdown releases the row so failover is immediate.
+
+        Args:
+            db_path: Path to the SQLite database shared by all processes
+            name: Name of the lease (one leader per name)
+            ttl: Seconds a lease stays valid without a heartbeat
+            heartbeat_interval: Seconds between renew/acquire attempts
+            on_elected: Called when this process becomes leader
+            on_demoted: Called when this process loses leadership
+        """
+        self.db_path = db_path
+        self.name = name
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        # Taken per process (see _holder), so workers forked after the lease
+        # was created never share an id and both renew the row
+        self.holder_id = None
+        self._holder_pid = None
+        self.is_leader = False
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._init_table()
+
+    def _holder(self) -> str:
+        """This process's holder id, made fresh after a fork"""
+        if self._holder_pid != os.getpid():
+            self.holder_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            self._holder_pid = os.getpid()
+            # Leadership held by the parent is not ours
+            self.is_leader = False
+        return self.holder_id
+
+    def try_acquire(self) -> bool:
+        """
+        Acquire the lease, or renew it if we already hold it
+
+        Returns:
+            bool: True if this process holds the lease afterwards
+        """
+        holder_id = self._holder()
+        now = time.time()
+        conn = self._connect()
+        try:
+            # Take the row if it is free, expired, or already ours
+            conn.execute('''
+                INSERT INTO leader_leases (name, holder, expires_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    holder = excluded.holder,
+                    expires_at = excluded.expires_at
+                WHERE leader_leases.holder = excluded.holder
+                   OR leader_leases.expires_at < ?
+            ''', (self.name, holder_id, now + self.ttl, now))
+            conn.commit()
+
+            row = conn.execute(
+                "SELECT holder FROM leader_leases WHERE name = ?", (self.name,)
+            ).fetchone()
+            return bool(row) and row[0] == holder_id
+        finally:
+            conn.close()
+
+    def current_holder(self) -> Optional[str]:
+        """Holder of an unexpired lease, from any process, or None"""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT holder FROM leader_leases WHERE name = ? AND expires_at >= ?",
+            (self.name, time.time())
+        ).fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def release(self):
+        """Give up the lease so another process can take over right away"""
+        try:
+            conn = self._connect()
+            conn.execute(
+                "DELETE FROM leader_leases WHERE name = ? AND holder = ?",
+                (self.name, self._holder())
+            )
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error releasing leader lease '{self.name}': {e}")
+
+        self._set_leader(False)
+
+    def _set_leader(self, leader: bool):
+        if leader == self.is_leader:
+            return
+
+        self.is_leader = leader
+        callback = self.on_elected if leader else self.on_demoted
+        logger.info(f"Process {self.holder_id} {'acquired' if leader else 'lost'} leader lease '{self.name}'")
+
+        if callback:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error in leader lease callback: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._set_leader(self.try_acquire())
+            except Exception as e:
+                # If we can't reach the database we can't prove we still hold
+                # the lease, so step down rather than risk two leaders
+                logger.error(f"Leader lease heartbeat failed: {e}")
+                self._set_leader(False)
+
+            self._stop.wait(self.heartbeat_interval)
+
+    def start(self):
+        """Start the heartbeat thread"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._holder()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"leader-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop heartbeating and release the lease"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.heartbeat_interval)
+        self.release()
@@ -0,0 +1,150 @@
+"""
+Drive process_batch_delivery end to end against the local Uber Direct stub
+
+Seeds a throwaway database with closed batches, points the app at an
+in-process stub and dispatches every batch through the same worker pool the
+scheduler uses. Nothing leaves the machine: Twilio, Stripe and OpenAI are
+disabled for the run.
+
+    python load_test_batches.py --batches 50 --latency 0.05 --jitter 0.05
+    python load_test_batches.py --batches 50 --error-rate 0.05 --stub-rate-limit 20
+"""
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from uber_direct_stub import UberDirectStub
+
+RESTAURANTS = ["Chipotle", "McDonald's", "Chick-fil-A", "Portillo's", "Starbucks"]
+
+# What customers type for their building, including unknown places
+DORMS = ["JST 1204", "University Hall", "Courtyard", "TBH room 3", "Student Center East", "ARC", "Library", "off campus"]
+
+
+def seed(db_path, batches, orders_per_batch, restaurants):
+    """Create closed batches with orders spread across restaurants"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+
+    menu_items = {}
+    for name in RESTAURANTS[:restaurants]:
+        c.execute("INSERT INTO menus (restaurant_name) VALUES (?)", (name,))
+        menu_id = c.lastrowid
+        c.execute(
+            "INSERT INTO menu_items (menu_id, item_name, price, category) VALUES (?, ?, ?, ?)",
+            (menu_id, f"{name} Meal", 9.99, "Meals")
+        )
+        menu_items[name] = c.lastrowid
+
+    closed_at = (datetime.now() - timedelta(minutes=1)).strftime('%Y-%m-%d %H:%M:%S')
+    names = list(menu_items)
+    user_number = 0
+
+    for _ in range(batches):
+        c.execute("INSERT INTO delivery_batches (delivery_time, status) VALUES (?, 'scheduled')", (closed_at,))
+        batch_id = c.lastrowid
+
+        for _ in range(orders_per_batch):
+            user_number += 1
+            c.execute(
+                "INSERT INTO users (phone_number, name, dorm_building) VALUES (?, ?, ?)",
+                (f"1555{user_number:07d}", f"Student {user_number}", random.choice(DORMS))
+            )
+            user_id = c.lastrowid
+
+            c.execute(
+                "INSERT INTO orders (user_id, total_amount, delivery_fee, status) VALUES (?, ?, ?, 'paid')",
+                (user_id, 9.99, 4.00)
+            )
+            order_id = c.lastrowid
+
+            c.execute(
+                "INSERT INTO order_items (order_id, menu_item_id, quantity, item_price) VALUES (?, ?, 1, ?)",
+                (order_id, menu_items[random.choice(names)], 9.99)
+            )
+            c.execute("INSERT INTO batch_orders (batch_id, order_id) VALUES (?, ?)", (batch_id, order_id))
+
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--orders-per-batch', type=int, default=10)
+    parser.add_argument('--restaurants', type=int, default=5, choices=range(1, len(RESTAURANTS) + 1))
+    parser.add_argument('--workers', type=int, default=4, help="BATCH_WORKERS for the run")
+    parser.add_argument('--latency', type=float, default=0.05, help="Stub latency per request (seconds)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Extra random stub latency (seconds)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of stub requests failing with 5xx")
+    parser.add_argument('--stub-rate-limit', type=float, default=None, help="Stub requests/s before it answers 429")
+    parser.add_argument('--client-rate-limit', type=float, default=50.0, help="UBER_RATE_LIMIT for the client")
+    parser.add_argument('--async-client', action='store_true', help="Use the asyncio client (UBER_DIRECT_ASYNC=1)")
+    args = parser.parse_args()
+
+    stub = UberDirectStub(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit=args.stub_rate_limit
+    ).start()
+
+    # app.py opens treehouse.db relative to the working directory
+    workdir = tempfile.mkdtemp(prefix='treehouse-load-')
+    os.chdir(workdir)
+
+    os.environ.update({
+        'SCHEDULER_ENABLED': '0',
+        'BATCH_WORKERS': str(args.workers),
+        'UBER_CLIENT_ID': 'load-test',
+        'UBER_CLIENT_SECRET': 'load-test',
+        'UBER_CUSTOMER_ID': 'load-test-customer',
+        'UBER_AUTH_URL': stub.auth_url,
+        'UBER_API_BASE_URL': stub.url,
+        'UBER_RATE_LIMIT': str(args.client_rate_limit),
+        'UBER_RATE_BURST': str(max(10, int(args.client_rate_limit))),
+        'UBER_DIRECT_ASYNC': '1' if args.async_client else '0',
+        # Set (empty) so a local .env can't switch real services on
+        'TWILIO_ACCOUNT_SID': '',
+        'TWILIO_AUTH_TOKEN': '',
+        'STRIPE_SECRET_KEY': '',
+        'OPENAI_API_KEY': ''
+    })
+
+    logging.disable(logging.WARNING)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+
+    seed('treehouse.db', args.batches, args.orders_per_batch, args.restaurants)
+    ready = app.find_ready_batches()
+
+    started = time.perf_counter()
+    app.process_ready_batches(ready)
+    elapsed = time.perf_counter() - started
+
+    conn = sqlite3.connect('treehouse.db')
+    statuses = dict(conn.execute("SELECT status, COUNT(*) FROM delivery_batches GROUP BY status").fetchall())
+    in_delivery = conn.execute("SELECT COUNT(*) FROM orders WHERE status = 'in_delivery'").fetchone()[0]
+    conn.close()
+
+    batch_stats = app.scheduler_metrics.snapshot()["batches"]
+    print(f"batches:    {len(ready)} dispatched in {elapsed:.2f}s ({len(ready) / elapsed:.1f} batches/s)")
+    print(f"durations:  {batch_stats['duration_seconds']}")
+    print(f"statuses:   {statuses}")
+    print(f"orders:     {in_delivery}/{args.batches * args.orders_per_batch} in delivery")
+    print(f"stub:       {stub.stats}")
+    print(f"database:   {os.path.join(workdir, 'treehouse.db')}")
+
+    stub.stop()
+    app.batch_executor.shutdown(wait=False)
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
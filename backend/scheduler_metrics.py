@@ -0,0 +1,166 @@
+import threading
+import time
+import logging
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from apscheduler.events import (
+    EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR,
+    EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+)
+
+logger = logging.getLogger(__name__)
+
+
+class RollingStats:
+    def __init__(self, window: float = 3600.0, max_samples: int = 5000):
+        """
+        Samples kept for a rolling time window
+
+        Args:
+            window: Seconds of history to keep
+            max_samples: Hard cap on stored samples
+        """
+        self.window = window
+        self.samples = deque(maxlen=max_samples)
+
+    def add(self, value: float, timestamp: Optional[float] = None):
+        self.samples.append((timestamp or time.time(), value))
+
+    def _trim(self):
+        cutoff = time.time() - self.window
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+
+    def summary(self) -> Dict[str, Any]:
+        self._trim()
+        values = sorted(value for _, value in self.samples)
+        if not values:
+            return {"count": 0}
+
+        def percentile(p):
+            return round(values[min(int(len(values) * p), len(values) - 1)], 4)
+
+        return {
+            "count": len(values),
+            "mean": round(sum(values) / len(values), 4),
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+            "max": round(values[-1], 4)
+        }
+
+
+class SchedulerMetrics:
+    def __init__(self, window: float = 3600.0):
+        """
+        Per-job lag, duration and outcome counters for the batch scheduler
+
+        Args:
+            window: Seconds of history used for lag/duration percentiles
+        """
+        self.window = window
+        self.lag = defaultdict(lambda: RollingStats(window))
+        self.duration = defaultdict(lambda: RollingStats(window))
+        self.outcomes = defaultdict(lambda: defaultdict(int))
+        self.batch_duration = RollingStats(window)
+        self.batch_outcomes = defaultdict(int)
+        self.last_run = {}
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def attach(self, scheduler):
+        """Register APScheduler listeners on a scheduler"""
+        scheduler.add_listener(self._on_submitted, EVENT_JOB_SUBMITTED)
+        scheduler.add_listener(self._on_finished, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+        scheduler.add_listener(self._on_skipped, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+
+    def _on_submitted(self, event):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            for run_time in event.scheduled_run_times:
+                self.lag[event.job_id].add((now - run_time).total_seconds())
+                self._started[(event.job_id, run_time)] = time.perf_counter()
+
+    def _on_finished(self, event):
+        outcome = "error" if event.exception else "success"
+        with self._lock:
+            started = self._started.pop((event.job_id, event.scheduled_run_time), None)
+        duration = time.perf_counter() - started if started is not None else None
+        self.record_job(event.job_id, None, duration, outcome)
+
+    def _on_skipped(self, event):
+        outcome = "misfire" if event.code == EVENT_JOB_MISSED else "max_instances"
+        self.record_job(event.job_id, None, None, outcome)
+
+    def record_job(self, job_id: str, lag: Optional[float], duration: Optional[float], outcome: str):
+        """
+        Record one run of a job
+
+        Args:
+            job_id: Scheduler job ID or job queue kind
+            lag: Seconds between scheduled and actual start, if known
+            duration: Run time in seconds, if the job ran
+            outcome: success, error, misfire or max_instances
+        """
+        with self._lock:
+            if lag is not None:
+                self.lag[job_id].add(lag)
+            if duration is not None:
+                self.duration[job_id].add(duration)
+            self.outcomes[job_id][outcome] += 1
+            self.last_run[job_id] = {"at": datetime.now().isoformat(), "outcome": outcome}
+
+    def record_batch(self, duration: float, result: str):
+        """Record how long process_batch_delivery took for one batch"""
+        outcome = "success" if result == "Success" else "failed"
+        with self._lock:
+            self.batch_duration.add(duration)
+            self.batch_outcomes[outcome] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            job_ids = set(self.lag) | set(self.duration) | set(self.outcomes)
+            jobs = {
+                job_id: {
+                    "lag_seconds": self.lag[job_id].summary(),
+                    "duration_seconds": self.duration[job_id].summary(),
+                    "outcomes": dict(self.outcomes[job_id]),
+                    "last_run": self.last_run.get(job_id)
+                }
+                for job_id in sorted(job_ids)
+            }
+            return {
+                "window_seconds": self.window,
+                "jobs": jobs,
+                "batches": {
+                    "duration_seconds": self.batch_duration.summary(),
+                    "outcomes": dict(self.batch_outcomes)
+                }
+            }
+
+    def log_summary(self, backlog: Optional[Dict[str, Any]] = None):
+        """Write a one-line-per-job summary of the rolling window to the log"""
+        snapshot = self.snapshot()
+
+        for job_id, stats in snapshot["jobs"].items():
+            lag = stats["lag_seconds"]
+            duration = stats["duration_seconds"]
+            logger.info(
+                f"[scheduler] {job_id}: runs={duration.get('count', 0)} "
+                f"lag p50={lag.get('p50', '-')}s p99={lag.get('p99', '-')}s "
+                f"duration p50={duration.get('p50', '-')}s max={duration.get('max', '-')}s "
+                f"outcomes={stats['outcomes']}"
+            )
+
+        batches = snapshot["batches"]
+        logger.info(
+            f"[scheduler] batches: processed={batches['duration_seconds'].get('count', 0)} "
+            f"p50={batches['duration_seconds'].get('p50', '-')}s "
+            f"max={batches['duration_seconds'].get('max', '-')}s "
+            f"outcomes={batches['outcomes']}"
+        )
+
+        if backlog is not None:
+            logger.info(f"[scheduler] backlog: {backlog}")
@@ -0,0 +1,424 @@
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from sms_segments import count_segments, gsm_normalize
+
+from sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+# Twilio statuses that mean the message will never arrive
+FAILED_STATUSES = {'failed', 'undelivered'}
+
+
+class SmsOutbox(SqliteStore):
+    SCHEMA = (
+        '''
+            CREATE TABLE IF NOT EXISTS outbound_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL DEFAULT 'sms',
+                to_number TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                send_at REAL NOT NULL,
+                claimed_at REAL,
+                claim_token TEXT,
+                dedupe_key TEXT UNIQUE,
+                encoding TEXT,
+                segments INTEGER,
+                message_sid TEXT,
+                delivery_status TEXT,
+                error_code TEXT,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP,
+                updated_at TIMESTAMP
+            )
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS idx_outbound_messages_status_send_at
+            ON outbound_messages (status, send_at)
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS idx_outbound_messages_sid
+            ON outbound_messages (message_sid)
+        ''',
+    )
+    COLUMNS = {'outbound_messages': {'encoding': 'TEXT', 'segments': 'INTEGER', 'claim_token': 'TEXT'}}
+
+    def __init__(self, db_path: str, client, from_number: Optional[str],
+                 max_workers: int = 4, max_attempts: int = 5, retry_delay: float = 5.0,
+                 max_retry_delay: float = 300.0, poll_interval: float = 2.0,
+                 stale_after: float = 120.0, claim_batch: int = 50,
+                 status_callback_url: Optional[str] = None,
+                 on_complete: Optional[Callable[[str, float, float, str], None]] = None):
+        """
+        Durable outbound SMS queue sent from a background worker pool
+
+        Request handlers call enqueue(), which is one SQLite insert. Messages
+        live in the outbound_messages table until Twilio accepts them, so they
+        survive restarts and are retried with exponential backoff. Every
+        process may run a sender: rows are claimed atomically with a fresh
+        claim token, and a row left 'sending' by a process that died is
+        re-queued after stale_after. Only the holder of the latest claim may
+        record the outcome, so keep the client's HTTP timeout below
+        stale_after.
+
+        Args:
+            db_path: Path to the SQLite database
+            client: Twilio REST client (anything with messages.create)
+            from_number: Number messages are sent from
+            max_workers: Messages sent in parallel
+            max_attempts: Attempts before a message is marked failed
+            retry_delay: Delay in seconds before the first retry
+            max_retry_delay: Longest delay between retries
+            poll_interval: Seconds between checks for messages queued elsewhere
+            stale_after: Seconds before a claimed but unfinished message is retried
+            claim_batch: Most messages claimed per poll
+            status_callback_url: Public URL Twilio posts delivery updates to
+            on_complete: Called with (kind, lag, duration, outcome) after each send
+        """
+        self.db_path = db_path
+        self.client = client
+        self.from_number = from_number
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.claim_batch = claim_batch
+        self.status_callback_url = status_callback_url
+        self.on_complete = on_complete
+
+        self._inflight = 0
+        self._inflight_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+
+        self._init_table()
+
+    def enqueue(self, to_number: str, body: str, kind: str = 'sms',
+                dedupe_key: Optional[str] = None, delay: float = 0) -> Optional[int]:
+        """
+        Queue a text for the background sender
+
+        Args:
+            to_number: Recipient in E.164 format
+            body: Message text; quote and dash lookalikes are swapped for GSM-7
+                characters so they don't turn the message into UCS-2
+            kind: Label used in logs and metrics (e.g. admin_order, tracking)
+            dedupe_key: Messages with a key already in the table are ignored
+            delay: Seconds from now before the message may be sent
+
+        Returns:
+            int: Message ID, or None if the dedupe key already exists
+        """
+        body = gsm_normalize(body)
+        info = count_segments(body)
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute(
+            "INSERT OR IGNORE INTO outbound_messages (kind, to_number, body, send_at, dedupe_key, encoding, segments) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (kind, to_number, body, time.time() + delay, dedupe_key, info['encoding'], info['segments'])
+        )
+        message_id = c.lastrowid if c.rowcount == 1 else None
+        conn.commit()
+        conn.close()
+
+        if message_id is not None and not delay:
+            self._wake.set()
+
+        return message_id
+
+    def enqueue_many(self, messages: List[Dict[str, Any]]) -> int:
+        """
+        Queue many texts in one transaction
+
+        Args:
+            messages: Dicts with to_number, body and optional kind/dedupe_key
+
+        Returns:
+            int: Number of messages queued (duplicates by dedupe key are skipped)
+        """
+        if not messages:
+            return 0
+
+        now = time.time()
+        conn = self._connect()
+        before = conn.total_changes
+        rows = []
+        for message in messages:
+            body = gsm_normalize(message['body'])
+            info = count_segments(body)
+            rows.append((
+                message.get('kind', 'sms'), message['to_number'], body, now,
+                message.get('dedupe_key'), info['encoding'], info['segments']
+            ))
+        conn.executemany(
+            "INSERT OR IGNORE INTO outbound_messages (kind, to_number, body, send_at, dedupe_key, encoding, segments) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        queued = conn.total_changes - before
+        conn.commit()
+        conn.close()
+
+        if queued:
+            self._wake.set()
+        return queued
+
+    def messages(self, dedupe_prefix: str) -> List[Dict[str, Any]]:
+        """Send outcome of every message whose dedupe key starts with dedupe_prefix"""
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(
+            "SELECT id, kind, to_number, status, attempts, segments, message_sid, delivery_status, error_code, last_error, "
+            "created_at, sent_at, dedupe_key FROM outbound_messages WHERE dedupe_key >= ? AND dedupe_key < ? ORDER BY id",
+            (dedupe_prefix, dedupe_prefix + '\uffff')
+        ).fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+
+    def record_status(self, message_sid: str, status: str, error_code: Optional[str] = None) -> bool:
+        """
+        Store a delivery update from Twilio's status callback
+
+        Returns:
+            bool: Whether the message was one of ours
+        """
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute(
+            "UPDATE outbound_messages SET delivery_status = ?, error_code = ?, updated_at = CURRENT_TIMESTAMP WHERE message_sid = ?",
+            (status, error_code, message_sid)
+        )
+        found = c.rowcount > 0
+        conn.commit()
+        conn.close()
+
+        if status in FAILED_STATUSES:
+            logger.error(f"SMS {message_sid} was not delivered: {status} (error {error_code})")
+        return found
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Counts by status, segments sent per kind and the age of the oldest waiting message"""
+        conn = self._connect()
+        statuses = dict(conn.execute("SELECT status, COUNT(*) FROM outbound_messages GROUP BY status").fetchall())
+        delivery = dict(conn.execute(
+            "SELECT delivery_status, COUNT(*) FROM outbound_messages WHERE delivery_status IS NOT NULL GROUP BY delivery_status"
+        ).fetchall())
+        segments = {
+            kind: {
+                "messages": messages,
+                "segments": total or 0,
+                "avg_segments": round((total or 0) / messages, 2),
+                "ucs2": ucs2 or 0
+            }
+            for kind, messages, total, ucs2 in conn.execute(
+                "SELECT kind, COUNT(*), SUM(segments), SUM(encoding = 'UCS-2') FROM outbound_messages "
+                "WHERE status = 'sent' GROUP BY kind"
+            ).fetchall()
+        }
+        oldest = conn.execute(
+            "SELECT MIN(send_at) FROM outbound_messages WHERE status = 'queued' AND send_at <= ?", (time.time(),)
+        ).fetchone()[0]
+        conn.close()
+
+        return {
+            "statuses": statuses,
+            "delivery_statuses": delivery,
+            "segments_sent": segments,
+            "oldest_queued_seconds": round(time.time() - oldest, 1) if oldest else 0.0,
+            "sending": self._thread is not None and self._thread.is_alive()
+        }
+
+    def _requeue_stale(self, now: float):
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute(
+            "UPDATE outbound_messages SET status = 'queued' WHERE status = 'sending' AND claimed_at < ?",
+            (now - self.stale_after,)
+        )
+        if c.rowcount:
+            logger.warning(f"Re-queued {c.rowcount} SMS left sending by a stopped worker")
+        conn.commit()
+        conn.close()
+
+    def _claim_due(self, now: float, limit: int) -> list:
+        """Mark up to limit due messages as sending and return them"""
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        ids = [row[0] for row in c.execute(
+            "SELECT id FROM outbound_messages WHERE status = 'queued' AND send_at <= ? ORDER BY send_at LIMIT ?",
+            (now, limit)
+        ).fetchall()]
+
+        claimed = []
+        for message_id in ids:
+            c.execute(
+                "UPDATE outbound_messages SET status = 'sending', attempts = attempts + 1, claimed_at = ?, claim_token = ? "
+                "WHERE id = ? AND status = 'queued'",
+                (now, uuid.uuid4().hex, message_id)
+            )
+            if c.rowcount == 1:
+                c.execute(
+                    "SELECT id, kind, to_number, body, send_at, attempts, claim_token FROM outbound_messages WHERE id = ?",
+                    (message_id,)
+                )
+                claimed.append(c.fetchone())
+        conn.commit()
+        conn.close()
+        return claimed
+
+    def _finish(self, message_id: int, claim_token: str, status: str, message_sid: Optional[str] = None,
+                error: Optional[str] = None, send_at: Optional[float] = None) -> bool:
+        """
+        Record a send outcome, if the claim is still ours
+
+        A row re-queued as stale keeps its token until another sender claims
+        it, so a slow send that finishes first still marks it sent.
+
+        Returns:
+            bool: False if another sender has claimed the message since
+        """
+        conn = self._connect()
+        c = conn.cursor()
+        if status == 'sent':
+            c.execute(
+                "UPDATE outbound_messages SET status = 'sent', message_sid = ?, last_error = NULL, "
+                "sent_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND claim_token = ?",
+                (message_sid, message_id, claim_token)
+            )
+        elif status == 'queued':
+            c.execute(
+                "UPDATE outbound_messages SET status = 'queued', send_at = ?, last_error = ?, "
+                "updated_at = CURRENT_TIMESTAMP WHERE id = ? AND claim_token = ?",
+                (send_at, error, message_id, claim_token)
+            )
+        else:
+            c.execute(
+                "UPDATE outbound_messages SET status = ?, last_error = ?, updated_at = CURRENT_TIMESTAMP "
+                "WHERE id = ? AND claim_token = ?",
+                (status, error, message_id, claim_token)
+            )
+        owned = c.rowcount == 1
+        conn.commit()
+        conn.close()
+
+        if not owned:
+            logger.warning(f"SMS {message_id} was claimed by another sender; not recording '{status}'")
+        return owned
+
+    @staticmethod
+    def _is_permanent(error: Exception) -> bool:
+        # Twilio answers 4xx for bad numbers, opted-out recipients and the
+        # like; retrying those only burns attempts. 429 is worth retrying.
+        status = getattr(error, 'status', None)
+        return isinstance(status, int) and 400 <= status < 500 and status != 429
+
+    def _send(self, message):
+        try:
+            self._deliver(message)
+        except Exception as e:
+            logger.error(f"Error finishing SMS {message['id']}: {e}")
+        finally:
+            with self._inflight_lock:
+                self._inflight -= 1
+            self._wake.set()
+
+    def _deliver(self, message):
+        message_id = message['id']
+        kind = message['kind']
+        lag = time.time() - message['send_at']
+        started = time.perf_counter()
+
+        params = {"body": message['body'], "from_": self.from_number, "to": message['to_number']}
+        if self.status_callback_url:
+            params["status_callback"] = self.status_callback_url
+
+        try:
+            sent = self.client.messages.create(**params)
+            self._finish(message_id, message['claim_token'], 'sent', message_sid=getattr(sent, 'sid', None))
+            logger.info(f"SMS {message_id} ({kind}) sent to {message['to_number']}: {getattr(sent, 'sid', None)}")
+            outcome = 'success'
+        except Exception as e:
+            if not self._is_permanent(e) and message['attempts'] < self.max_attempts:
+                delay = min(self.max_retry_delay, self.retry_delay * (2 ** (message['attempts'] - 1)))
+                logger.error(f"SMS {message_id} ({kind}) failed, retrying in {delay:.0f}s: {e}")
+                self._finish(message_id, message['claim_token'], 'queued', error=str(e), send_at=time.time() + delay)
+                outcome = 'retry'
+            else:
+                logger.error(f"SMS {message_id} ({kind}) to {message['to_number']} failed after {message['attempts']} attempts: {e}")
+                self._finish(message_id, message['claim_token'], 'failed', error=str(e))
+                outcome = 'error'
+
+        if self.on_complete:
+            try:
+                self.on_complete(kind, lag, time.perf_counter() - started, outcome)
+            except Exception as e:
+                logger.error(f"Error in SMS completion callback: {e}")
+
+    def _run(self):
+        next_stale_check = 0.0
+
+        while not self._stop.is_set():
+            self._wake.clear()
+            now = time.time()
+
+            try:
+                if now >= next_stale_check:
+                    self._requeue_stale(now)
+                    next_stale_check = now + self.stale_after / 2
+
+                # Only claim what the pool can start soon, so a backlog
+                # doesn't sit claimed long enough to look stale to others
+                with self._inflight_lock:
+                    capacity = min(self.claim_batch, self.max_workers * 2 - self._inflight)
+
+                claimed = self._claim_due(now, capacity) if capacity > 0 else []
+                with self._inflight_lock:
+                    self._inflight += len(claimed)
+                for message in claimed:
+                    self._executor.submit(self._send, message)
+            except Exception as e:
+                logger.error(f"Error in SMS outbox dispatcher: {e}")
+                claimed, capacity = [], 0
+
+            # A full claim means more are waiting; otherwise sleep until a
+            # local enqueue, a finished send or the next poll
+            if not claimed or len(claimed) < capacity:
+                self._wake.wait(self.poll_interval)
+
+    def start(self):
+        """Start sending queued messages from this process"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='sms-worker')
+        self._thread = threading.Thread(target=self._run, name='sms-outbox', daemon=True)
+        self._thread.start()
+        logger.info("Started SMS outbox sender")
+
+    def stop(self, wait: bool = False):
+        """Stop sending; queued messages stay in the table"""
+        if not self._thread:
+            return
+
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=self.poll_interval * 2)
+        self._thread = None
+        self._executor.shutdown(wait=wait)
+        logger.info("Stopped SMS outbox sender")
@@ -0,0 +1,164 @@
+import sqlite3
+import threading
+import time
+import logging
+from typing import Any, Dict, Optional
+
+from sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_KEY = 'global'
+
+
+class SmsRateLimiter(SqliteStore):
+    SCHEMA = (
+        '''
+            CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS rate_limit_drops (
+                scope TEXT PRIMARY KEY,
+                dropped INTEGER NOT NULL DEFAULT 0,
+                last_dropped_at REAL
+            )
+        ''',
+    )
+
+    def __init__(self, db_path: str, phone_rate: float = 10 / 60.0, phone_burst: int = 5,
+                 global_rate: float = 20.0, global_burst: int = 100, purge_every: int = 500):
+        """
+        Token buckets per phone number and across all senders
+
+        Buckets live in SQLite so every worker process shares them. Each check
+        is one short write transaction and runs before any other work for the
+        message, so a flood costs a lookup per text rather than OpenAI calls
+        and user rows.
+
+        Args:
+            db_path: Path to the SQLite database
+            phone_rate: Messages per second each phone number earns
+            phone_burst: Messages a phone may send back to back
+            global_rate: Messages per second across all numbers
+            global_burst: Messages allowed back to back across all numbers
+            purge_every: Full (idle) phone buckets are deleted once per this many checks
+        """
+        self.db_path = db_path
+        self.phone_rate = phone_rate
+        self.phone_burst = phone_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.purge_every = purge_every
+        self._checks = 0
+        self._lock = threading.Lock()
+
+        self._init_table()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit mode so BEGIN IMMEDIATE controls the transaction
+        return sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+
+    def _refill(self, row, rate: float, burst: int, now: float) -> float:
+        if row is None:
+            return float(burst)
+        tokens, updated_at = row
+        return min(float(burst), tokens + max(0.0, now - updated_at) * rate)
+
+    def allow(self, phone_number: str) -> Optional[str]:
+        """
+        Take one message from the phone's and the global bucket
+
+        Args:
+            phone_number: Sender, digits only
+
+        Returns:
+            str: 'phone' or 'global' if the message should be dropped, else None
+        """
+        now = time.time()
+        phone_key = f"phone:{phone_number}"
+        limited = None
+
+        conn = self._connect()
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            phone = self._refill(
+                c.execute("SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?", (phone_key,)).fetchone(),
+                self.phone_rate, self.phone_burst, now
+            )
+            total = self._refill(
+                c.execute("SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?", (GLOBAL_KEY,)).fetchone(),
+                self.global_rate, self.global_burst, now
+            )
+
+            # A noisy phone is dropped without using up the global allowance
+            if phone < 1:
+                limited = 'phone'
+            elif total < 1:
+                limited = 'global'
+            else:
+                phone -= 1
+                total -= 1
+
+            c.executemany(
+                "INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                [(phone_key, phone, now), (GLOBAL_KEY, total, now)]
+            )
+            if limited:
+                c.execute(
+                    "INSERT INTO rate_limit_drops (scope, dropped, last_dropped_at) VALUES (?, 1, ?) "
+                    "ON CONFLICT(scope) DO UPDATE SET dropped = dropped + 1, last_dropped_at = excluded.last_dropped_at",
+                    (limited, now)
+                )
+            c.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._checks += 1
+            purge = self._checks % self.purge_every == 0
+        if purge:
+            self._purge(now)
+
+        return limited
+
+    def _purge(self, now: float):
+        """Delete phone buckets that have refilled completely"""
+        idle = self.phone_burst / self.phone_rate if self.phone_rate else float('inf')
+        try:
+            conn = self._connect()
+            conn.execute(
+                "DELETE FROM rate_limit_buckets WHERE key != ? AND updated_at < ?",
+                (GLOBAL_KEY, now - idle)
+            )
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error purging rate limit buckets: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        conn = self._connect()
+        drops = {
+            scope: {"dropped": dropped, "last_dropped_at": last_dropped_at}
+            for scope, dropped, last_dropped_at in conn.execute(
+                "SELECT scope, dropped, last_dropped_at FROM rate_limit_drops"
+            ).fetchall()
+        }
+        tracked = conn.execute("SELECT COUNT(*) FROM rate_limit_buckets WHERE key != ?", (GLOBAL_KEY,)).fetchone()[0]
+        conn.close()
+
+        return {
+            "phone_rate_per_minute": round(self.phone_rate * 60, 2),
+            "phone_burst": self.phone_burst,
+            "global_rate_per_second": self.global_rate,
+            "global_burst": self.global_burst,
+            "phones_tracked": tracked,
+            "dropped": drops
+        }
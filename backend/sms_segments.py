@@ -0,0 +1,150 @@
+import threading
+import logging
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# GSM 03.38 default alphabet; anything outside it (and the extension table)
+# forces the whole message into UCS-2
+GSM7_BASIC = set(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+# Extension characters take an escape plus the character (2 septets)
+GSM7_EXTENDED = set("^{}\\[~]|€\f")
+
+# (single message, per segment once concatenated) in characters/septets
+GSM7_LIMITS = (160, 153)
+UCS2_LIMITS = (70, 67)
+
+# Punctuation lookalikes that sneak in from templates and AI replies and
+# would otherwise switch a message to UCS-2. Letters are never replaced, so
+# names and order text keep their spelling even when that costs UCS-2
+GSM7_REPLACEMENTS = {
+    "‘": "'", "’": "'", "‚": "'", "‛": "'",
+    "“": '"', "”": '"', "„": '"',
+    "–": "-", "—": "-", "−": "-",
+    "…": "...", "•": "-", "·": "-",
+    " ": " ", " ": " ", "​": ""
+}
+
+
+def is_gsm7(text: str) -> bool:
+    return all(ch in GSM7_BASIC or ch in GSM7_EXTENDED for ch in text)
+
+
+def gsm_normalize(text: str) -> str:
+    """Replace smart quotes, dashes and similar punctuation with GSM-7 characters"""
+    return "".join(GSM7_REPLACEMENTS.get(ch, ch) for ch in text)
+
+
+def count_segments(text: str) -> Dict[str, Any]:
+    """
+    Work out how a message will be encoded and split by the carrier
+
+    Returns:
+        dict: encoding (GSM-7 or UCS-2), units (septets or UTF-16 code
+        units) and segments
+    """
+    if is_gsm7(text):
+        encoding = "GSM-7"
+        costs = [2 if ch in GSM7_EXTENDED else 1 for ch in text]
+        single, per_segment = GSM7_LIMITS
+    else:
+        encoding = "UCS-2"
+        # Characters outside the BMP (most emoji) are surrogate pairs
+        costs = [2 if ord(ch) > 0xFFFF else 1 for ch in text]
+        single, per_segment = UCS2_LIMITS
+
+    units = sum(costs)
+    if units == 0:
+        segments = 0
+    elif units <= single:
+        segments = 1
+    else:
+        # Escapes and surrogate pairs are never split across segments
+        segments, used = 1, 0
+        for cost in costs:
+            if used + cost > per_segment:
+                segments += 1
+                used = 0
+            used += cost
+
+    return {"encoding": encoding, "units": units, "segments": segments}
+
+
+class SegmentStats:
+    def __init__(self):
+        """Messages, segments and UCS-2 share per message type"""
+        self.kinds = defaultdict(lambda: {"messages": 0, "segments": 0, "ucs2": 0, "max_segments": 0})
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, info: Dict[str, Any]):
+        with self._lock:
+            stats = self.kinds[kind]
+            stats["messages"] += 1
+            stats["segments"] += info["segments"]
+            stats["max_segments"] = max(stats["max_segments"], info["segments"])
+            if info["encoding"] == "UCS-2":
+                stats["ucs2"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            kinds = {
+                kind: {
+                    **stats,
+                    "avg_segments": round(stats["segments"] / stats["messages"], 2) if stats["messages"] else 0.0
+                }
+                for kind, stats in sorted(self.kinds.items())
+            }
+        return {
+            "total_segments": sum(stats["segments"] for stats in kinds.values()),
+            "kinds": kinds
+        }
+
+
+class SmsRenderer:
+    def __init__(self, default_budget: int = 3, budgets: Optional[Dict[str, int]] = None,
+                 stats: Optional[SegmentStats] = None):
+        """
+        Picks the richest template variant that fits a segment budget
+
+        Args:
+            default_budget: Segments allowed when a kind has no budget of its own
+            budgets: Segment budget per message kind
+            stats: Where segments of rendered messages are recorded
+        """
+        self.default_budget = default_budget
+        self.budgets = budgets or {}
+        self.stats = stats or SegmentStats()
+
+    def choose(self, kind: str, variants: List[str]) -> tuple:
+        """
+        Normalise each variant and pick the first within budget
+
+        Args:
+            kind: Message type, for the budget and stats
+            variants: Candidate texts, richest first
+
+        Returns:
+            tuple: (text, segment info); the smallest variant if none fit
+        """
+        budget = self.budgets.get(kind, self.default_budget)
+        best = None
+        for variant in variants:
+            text = gsm_normalize(variant)
+            info = count_segments(text)
+            if info["segments"] <= budget:
+                return text, info
+            if best is None or info["segments"] < best[1]["segments"]:
+                best = (text, info)
+
+        logger.info(f"No {kind} variant fits {budget} segments; using {best[1]['segments']}")
+        return best
+
+    def render(self, kind: str, *variants: str) -> str:
+        """Choose a variant for a reply sent now and record its segments"""
+        text, info = self.choose(kind, list(variants))
+        self.stats.record(kind, info)
+        return text
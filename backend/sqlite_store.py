@@ -0,0 +1,35 @@
+import sqlite3
+from typing import Dict, Tuple
+
+
+class SqliteStore:
+    """
+    Base for helpers that keep their state in the app's SQLite database
+
+    Subclasses set self.db_path, list their CREATE TABLE / CREATE INDEX
+    statements in SCHEMA and call _init_table() from __init__. Columns added
+    after a table first shipped go in COLUMNS, so older databases get them too.
+    """
+    SCHEMA: Tuple[str, ...] = ()
+    # {table: {column: definition}}
+    COLUMNS: Dict[str, Dict[str, str]] = {}
+
+    db_path: str
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def _init_table(self):
+        conn = self._connect()
+        try:
+            c = conn.cursor()
+            for statement in self.SCHEMA:
+                c.execute(statement)
+            for table, columns in self.COLUMNS.items():
+                existing = {row[1] for row in c.execute(f"PRAGMA table_info({table})").fetchall()}
+                for column, definition in columns.items():
+                    if column not in existing:
+                        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            conn.commit()
+        finally:
+            conn.close()
@@ -0,0 +1,156 @@
+import threading
+import time
+import logging
+from typing import Any, Dict, Optional
+
+import stripe
+
+from sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+class StripeCatalog(SqliteStore):
+    SCHEMA = (
+        '''
+            CREATE TABLE IF NOT EXISTS stripe_catalog (
+                lookup_key TEXT PRIMARY KEY,
+                fee_cents INTEGER NOT NULL,
+                product_id TEXT NOT NULL,
+                price_id TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''',
+    )
+
+    def __init__(self, db_path: str, product_name: str = "TreeHouse Food Order",
+                 currency: str = "usd"):
+        """
+        Product/Price ids for checkout, created once per delivery fee
+
+        The customer enters their own total, so a price is a custom-amount
+        Price whose product names the delivery fee. Ids are kept in the
+        stripe_catalog table and in memory, which makes a checkout link one
+        API call (Session.create) instead of three. Prices carry a lookup_key,
+        so a fresh database finds the existing price instead of creating a
+        duplicate.
+
+        Args:
+            db_path: Path to the SQLite database
+            product_name: Product name shown on the checkout page
+            currency: Price currency
+        """
+        self.db_path = db_path
+        self.product_name = product_name
+        self.currency = currency
+        self.stats = {"hits": 0, "loaded": 0, "found": 0, "created": 0}
+        self._prices = {}
+        self._lock = threading.Lock()
+
+        self._init_table()
+
+    def _lookup_key(self, fee_cents: int) -> str:
+        # Test and live mode have separate objects
+        mode = 'live' if (stripe.api_key or '').startswith(('sk_live', 'rk_live')) else 'test'
+        return f"treehouse_order_{mode}_{self.currency}_{fee_cents}"
+
+    def _load(self, lookup_key: str) -> Optional[str]:
+        conn = self._connect()
+        row = conn.execute("SELECT price_id FROM stripe_catalog WHERE lookup_key = ?", (lookup_key,)).fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def _save(self, lookup_key: str, fee_cents: int, product_id: str, price_id: str) -> str:
+        """Store a price; if another process stored one first, use theirs"""
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR IGNORE INTO stripe_catalog (lookup_key, fee_cents, product_id, price_id, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (lookup_key, fee_cents, product_id, price_id, time.time())
+        )
+        conn.commit()
+        conn.close()
+        return self._load(lookup_key)
+
+    def _fetch_or_create(self, lookup_key: str, fee_cents: int) -> str:
+        existing = stripe.Price.list(lookup_keys=[lookup_key], active=True, limit=1)
+        if existing.data:
+            price = existing.data[0]
+            self.stats["found"] += 1
+            logger.info(f"Found Stripe price {price.id} for {lookup_key}")
+            return self._save(lookup_key, fee_cents, price.product, price.id)
+
+        product = stripe.Product.create(
+            name=self.product_name,
+            description=f"Your food order + ${fee_cents / 100:.2f} delivery fee",
+            idempotency_key=f"{lookup_key}:product"
+        )
+        price = stripe.Price.create(
+            product=product.id,
+            currency=self.currency,
+            custom_unit_amount={"enabled": True},
+            lookup_key=lookup_key,
+            idempotency_key=f"{lookup_key}:price"
+        )
+        self.stats["created"] += 1
+        logger.info(f"Created Stripe price {price.id} for {lookup_key}")
+        return self._save(lookup_key, fee_cents, product.id, price.id)
+
+    def price_for_fee(self, delivery_fee: float) -> str:
+        """
+        Price id for orders with this delivery fee
+
+        Args:
+            delivery_fee: Delivery fee in dollars
+
+        Returns:
+            str: Stripe Price id
+        """
+        fee_cents = int(round(delivery_fee * 100))
+        lookup_key = self._lookup_key(fee_cents)
+
+        price_id = self._prices.get(lookup_key)
+        if price_id:
+            self.stats["hits"] += 1
+            return price_id
+
+        # One creator per process; others wait for its result
+        with self._lock:
+            price_id = self._prices.get(lookup_key)
+            if not price_id:
+                price_id = self._load(lookup_key)
+                if price_id:
+                    self.stats["loaded"] += 1
+                else:
+                    price_id = self._fetch_or_create(lookup_key, fee_cents)
+                self._prices[lookup_key] = price_id
+
+        return price_id
+
+    def create_checkout_session(self, delivery_fee: float, success_url: str, cancel_url: str,
+                                metadata: Dict[str, str], **params):
+        """
+        Checkout Session for one order, the only API call once the price is cached
+
+        Args:
+            delivery_fee: Delivery fee in dollars
+            success_url: Where Stripe sends the customer after paying
+            cancel_url: Where Stripe sends the customer if they back out
+            metadata: Stored on the session (phone_number, user_id, ...)
+            **params: Extra Session.create parameters
+
+        Returns:
+            stripe.checkout.Session: The new session
+        """
+        return stripe.checkout.Session.create(
+            payment_method_types=['card'],
+            line_items=[{'price': self.price_for_fee(delivery_fee), 'quantity': 1}],
+            mode='payment',
+            success_url=success_url,
+            cancel_url=cancel_url,
+            metadata=metadata,
+            **params
+        )
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"cached_prices": len(self._prices), **self.stats}
@@ -0,0 +1,136 @@
+import json
+import time
+import logging
+from typing import Any, Dict, List, Optional
+
+from sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+class StripeEventStore(SqliteStore):
+    SCHEMA = (
+        '''
+            CREATE TABLE IF NOT EXISTS stripe_events (
+                event_id TEXT PRIMARY KEY,
+                type TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'received',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                received_at REAL NOT NULL,
+                claimed_at REAL,
+                processed_at REAL,
+                last_error TEXT
+            )
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS idx_stripe_events_status
+            ON stripe_events (status, received_at)
+        ''',
+    )
+
+    def __init__(self, db_path: str, stale_after: float = 300.0):
+        """
+        Stripe webhook events, stored once by event id and processed once
+
+        The webhook only verifies the signature and calls record(), so Stripe
+        gets its 200 straight away; redeliveries of the same event id are
+        ignored by the primary key. A worker claims each event before running
+        its side effects, so concurrent or repeated jobs for one event do the
+        work once. Failed events stay in the table for replay.
+
+        Args:
+            db_path: Path to the SQLite database
+            stale_after: Seconds before an event left 'processing' by a
+                crashed worker may be claimed again
+        """
+        self.db_path = db_path
+        self.stale_after = stale_after
+
+        self._init_table()
+
+    def record(self, event: Dict[str, Any]) -> bool:
+        """
+        Store a verified event
+
+        Args:
+            event: Event as sent by Stripe (id, type, data, ...)
+
+        Returns:
+            bool: False if the event id was already stored
+        """
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute(
+            "INSERT OR IGNORE INTO stripe_events (event_id, type, payload, received_at) VALUES (?, ?, ?, ?)",
+            (event['id'], event['type'], json.dumps(event), time.time())
+        )
+        stored = c.rowcount == 1
+        conn.commit()
+        conn.close()
+        return stored
+
+    def claim(self, event_id: str, force: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Take an event for processing
+
+        Args:
+            event_id: Stripe event id
+            force: Also claim events already processed or ignored (replay)
+
+        Returns:
+            dict: The event, or None if it is missing, done or being processed
+        """
+        now = time.time()
+        query = (
+            "UPDATE stripe_events SET status = 'processing', attempts = attempts + 1, claimed_at = ? "
+            "WHERE event_id = ? AND (status IN ('received', 'failed') OR (status = 'processing' AND claimed_at < ?)"
+        )
+        query += " OR status IN ('processed', 'ignored'))" if force else ")"
+
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute(query, (now, event_id, now - self.stale_after))
+        row = None
+        if c.rowcount == 1:
+            row = c.execute("SELECT payload FROM stripe_events WHERE event_id = ?", (event_id,)).fetchone()
+        conn.commit()
+        conn.close()
+        return json.loads(row[0]) if row else None
+
+    def finish(self, event_id: str, status: str, error: Optional[str] = None):
+        """Mark an event processed, ignored (no handler) or failed"""
+        conn = self._connect()
+        conn.execute(
+            "UPDATE stripe_events SET status = ?, processed_at = ?, last_error = ? WHERE event_id = ?",
+            (status, time.time(), error, event_id)
+        )
+        conn.commit()
+        conn.close()
+
+    def event_ids(self, statuses: List[str], since: Optional[float] = None) -> List[str]:
+        """Ids of events in any of the given statuses, oldest first"""
+        query = f"SELECT event_id FROM stripe_events WHERE status IN ({', '.join('?' * len(statuses))})"
+        params = list(statuses)
+        if since is not None:
+            query += " AND received_at >= ?"
+            params.append(since)
+        query += " ORDER BY received_at"
+
+        conn = self._connect()
+        ids = [row[0] for row in conn.execute(query, params).fetchall()]
+        conn.close()
+        return ids
+
+    def snapshot(self) -> Dict[str, Any]:
+        conn = self._connect()
+        statuses = dict(conn.execute("SELECT status, COUNT(*) FROM stripe_events GROUP BY status").fetchall())
+        oldest = conn.execute(
+            "SELECT MIN(received_at) FROM stripe_events WHERE status IN ('received', 'processing')"
+        ).fetchone()[0]
+        conn.close()
+
+        return {
+            "statuses": statuses,
+            "oldest_unprocessed_seconds": round(time.time() - oldest, 1) if oldest else 0.0
+        }
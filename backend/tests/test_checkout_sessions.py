@@ -0,0 +1,107 @@
+import sqlite3
+
+import pytest
+
+from checkout_sessions import CheckoutSessionIndex, load_export
+
+
+@pytest.fixture
+def index(tmp_path):
+    db = str(tmp_path / "app.db")
+    # Owned by app.py's init_db
+    conn = sqlite3.connect(db)
+    conn.execute('''
+        CREATE TABLE payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            amount DECIMAL(10,2) NOT NULL,
+            payment_method TEXT NOT NULL,
+            transaction_id TEXT,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    conn.close()
+    return CheckoutSessionIndex(db)
+
+
+def payments(index):
+    conn = sqlite3.connect(index.db_path)
+    rows = conn.execute("SELECT order_id, amount, transaction_id FROM payments ORDER BY id").fetchall()
+    conn.close()
+    return rows
+
+
+def write_csv(tmp_path, text):
+    path = tmp_path / "export.csv"
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+def test_load_export_reads_each_amount_format(tmp_path):
+    path = write_csv(tmp_path, (
+        "id,amount_total,Amount,payment_status,metadata[order_id],metadata[phone_number]\n"
+        "cs_1,1200,,paid,7,+15551234567\n"
+        "cs_2,12.50,,paid,,\n"
+        "cs_3,,\"$1,200.00\",unpaid,x,\n"
+        "cs_4,abc,,paid,,\n"
+        "pi_5,100,,paid,,\n"
+    ))
+    rows = load_export(path)
+
+    assert [row['session_id'] for row in rows] == ['cs_1', 'cs_2', 'cs_3']
+    assert [row['amount'] for row in rows] == [12.0, 12.5, 1200.0]
+    assert [row['paid'] for row in rows] == [True, True, False]
+    assert rows[0]['order_id'] == 7 and rows[0]['phone_number'] == '+15551234567'
+    assert rows[2]['order_id'] is None
+
+
+def test_load_export_requires_a_status_column(tmp_path):
+    path = write_csv(tmp_path, "id,amount_total\ncs_1,1200\n")
+    with pytest.raises(ValueError, match="status"):
+        load_export(path)
+
+
+def test_record_and_mark_paid(index):
+    index.record('cs_1', 1, '+15551234567', 3.99, order_id=7, location='Library')
+    index.mark_paid('cs_1', 12.0, payment_id=3)
+
+    session = index.lookup('cs_1')
+    assert (session['status'], session['amount_paid'], session['payment_id']) == ('paid', 12.0, 3)
+    assert session['location'] == 'Library'
+    assert index.lookup('cs_missing') is None
+
+
+def test_reconcile_links_payments_recorded_without_an_order(index):
+    index.record('cs_1', 1, '+15551234567', 3.99, order_id=7)
+    conn = sqlite3.connect(index.db_path)
+    conn.execute("INSERT INTO payments (order_id, amount, payment_method, transaction_id, status) "
+                 "VALUES (0, 12.0, 'stripe', 'cs_1', 'completed')")
+    conn.commit()
+    conn.close()
+
+    stats = index.reconcile()
+    assert stats['orders_linked'] == 1
+    assert stats['sessions_linked'] == 1
+    assert stats['payments_unlinked'] == 0
+    assert payments(index) == [(7, 12, 'cs_1')]
+    assert index.lookup('cs_1')['status'] == 'paid'
+
+
+def test_reconcile_adds_payments_missing_from_the_webhook(index):
+    index.record('cs_1', 1, '+15551234567', 3.99, order_id=7)
+    export = [
+        {'session_id': 'cs_1', 'amount': 12.0, 'paid': True, 'order_id': None, 'phone_number': None},
+        {'session_id': 'cs_2', 'amount': 8.0, 'paid': True, 'order_id': 9, 'phone_number': '+15557654321'},
+        {'session_id': 'cs_3', 'amount': 5.0, 'paid': False, 'order_id': None, 'phone_number': None}
+    ]
+
+    stats = index.reconcile(export)
+    assert stats['export_rows'] == 3
+    assert stats['unknown_sessions'] == 2
+    assert stats['payments_added'] == 2
+    assert payments(index) == [(7, 12, 'cs_1'), (9, 8, 'cs_2')]
+
+    # Running it again adds nothing
+    assert index.reconcile(export)['payments_added'] == 0
@@ -0,0 +1,155 @@
+import sqlite3
+import threading
+import time
+
+from job_queue import DurableJobQueue, TimerWheel
+
+
+def job_row(db, job_id):
+    conn = sqlite3.connect(db)
+    conn.row_factory = sqlite3.Row
+    row = conn.execute("SELECT * FROM scheduled_jobs WHERE id = ?", (job_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def test_timer_wheel_fires_jobs_when_due():
+    wheel = TimerWheel(tick=1.0, size=8)
+    start = wheel.current_tick
+    wheel.add(1, start + 2)
+    wheel.add(2, start + 5)
+
+    assert wheel.advance(start + 1) == []
+    assert wheel.advance(start + 2) == [1]
+    assert wheel.advance(start + 6) == [2]
+    assert wheel.count == 0
+
+
+def test_timer_wheel_keeps_entries_for_a_later_rotation():
+    wheel = TimerWheel(tick=1.0, size=4)
+    start = wheel.current_tick
+    # Same slot as start + 1, one rotation later
+    wheel.add(1, start + 5)
+
+    assert wheel.advance(start + 1) == []
+    assert wheel.count == 1
+    assert wheel.advance(start + 5) == [1]
+
+
+def test_timer_wheel_fires_overdue_timers_on_the_next_advance():
+    wheel = TimerWheel(tick=1.0, size=8)
+    wheel.add(1, 0)
+    assert wheel.advance(wheel.current_tick) == [1]
+
+
+def test_enqueue_ignores_a_repeated_dedupe_key(tmp_path):
+    queue = DurableJobQueue(str(tmp_path / "app.db"))
+
+    assert queue.enqueue('batch_close', {'batch_id': 1}, dedupe_key='batch_close:1') is not None
+    assert queue.enqueue('batch_close', {'batch_id': 1}, dedupe_key='batch_close:1') is None
+    assert queue.pending_count() == 1
+
+
+def test_a_job_is_claimed_once(tmp_path):
+    queue = DurableJobQueue(str(tmp_path / "app.db"))
+    queue.owner = 'test'
+    job_id = queue.enqueue('batch_close')
+
+    assert queue._claim(job_id)['attempts'] == 1
+    assert queue._claim(job_id) is None
+
+
+def test_failed_job_is_retried_with_backoff_then_failed(tmp_path):
+    db = str(tmp_path / "app.db")
+    outcomes = []
+    queue = DurableJobQueue(db, max_attempts=2, retry_delay=10,
+                            on_complete=lambda kind, lag, duration, outcome: outcomes.append(outcome))
+    queue.owner = 'test'
+
+    def broken(payload):
+        raise RuntimeError("boom")
+
+    queue.register('batch_close', broken)
+    job_id = queue.enqueue('batch_close')
+
+    before = time.time()
+    queue._execute(queue._claim(job_id))
+    row = job_row(db, job_id)
+    assert row['status'] == 'pending'
+    assert row['last_error'] == 'boom'
+    assert row['run_at'] >= before + 10
+
+    queue._execute(queue._claim(job_id))
+    assert job_row(db, job_id)['status'] == 'failed'
+    assert outcomes == ['retry', 'error']
+
+
+def test_only_the_owner_finishes_a_job(tmp_path):
+    db = str(tmp_path / "app.db")
+    queue = DurableJobQueue(db)
+    queue.owner = 'old-leader'
+    job_id = queue.enqueue('batch_close')
+    queue._claim(job_id)
+
+    queue.owner = 'new-leader'
+    queue._finish(job_id, 'done')
+    assert job_row(db, job_id)['status'] == 'running'
+
+
+def test_stale_running_jobs_are_requeued(tmp_path):
+    db = str(tmp_path / "app.db")
+    queue = DurableJobQueue(db, lease_timeout=60)
+    queue.owner = 'test'
+    job_id = queue.enqueue('batch_close')
+    queue._claim(job_id)
+
+    queue._requeue_stale(time.time())
+    assert job_row(db, job_id)['status'] == 'running'
+
+    queue._requeue_stale(time.time() + 120)
+    assert job_row(db, job_id)['status'] == 'pending'
+
+
+def test_dispatcher_runs_a_locally_enqueued_job(tmp_path):
+    queue = DurableJobQueue(str(tmp_path / "app.db"), tick=0.05, refresh_interval=60)
+    ran = threading.Event()
+    queue.register('admin_digest', lambda payload: ran.set())
+
+    queue.start()
+    try:
+        # Enqueued after the first poll, so only the wake-up delivers it
+        time.sleep(0.1)
+        queue.enqueue('admin_digest', delay=0.05)
+        assert ran.wait(2)
+    finally:
+        queue.stop()
+
+
+def test_running_job_lease_is_renewed(tmp_path):
+    db = str(tmp_path / "app.db")
+    queue = DurableJobQueue(db, tick=0.05, lease_timeout=0.3)
+    started, release = threading.Event(), threading.Event()
+
+    def slow(payload):
+        started.set()
+        release.wait(5)
+
+    queue.register('batch_close', slow)
+    queue.start()
+    try:
+        job_id = queue.enqueue('batch_close')
+        assert started.wait(2)
+
+        # Well past the lease timeout, another dispatcher still sees it owned
+        time.sleep(0.6)
+        DurableJobQueue(db, lease_timeout=0.3)._requeue_stale(time.time())
+        assert job_row(db, job_id)['status'] == 'running'
+
+        release.set()
+        deadline = time.time() + 2
+        while job_row(db, job_id)['status'] != 'done' and time.time() < deadline:
+            time.sleep(0.02)
+        assert job_row(db, job_id)['status'] == 'done'
+    finally:
+        release.set()
+        queue.stop()
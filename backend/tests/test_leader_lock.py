@@ -0,0 +1,68 @@
+import os
+import time
+
+from leader_lock import LeaderLease
+
+
+def test_only_one_process_holds_the_lease(tmp_path):
+    db = str(tmp_path / "app.db")
+    first = LeaderLease(db, "scheduler")
+    second = LeaderLease(db, "scheduler")
+
+    assert first.try_acquire()
+    assert not second.try_acquire()
+    assert first.try_acquire()  # renewing our own lease
+    assert second.current_holder() == first.holder_id
+
+
+def test_expired_lease_can_be_taken_over(tmp_path):
+    db = str(tmp_path / "app.db")
+    first = LeaderLease(db, "scheduler", ttl=0.05)
+    second = LeaderLease(db, "scheduler", ttl=0.05)
+
+    assert first.try_acquire()
+    time.sleep(0.1)
+    assert first.current_holder() is None
+    assert second.try_acquire()
+    assert not first.try_acquire()
+
+
+def test_release_hands_over_and_fires_callbacks(tmp_path):
+    db = str(tmp_path / "app.db")
+    events = []
+    first = LeaderLease(db, "scheduler", on_elected=lambda: events.append("elected"),
+                        on_demoted=lambda: events.append("demoted"))
+    second = LeaderLease(db, "scheduler")
+
+    first._set_leader(first.try_acquire())
+    first.release()
+
+    assert events == ["elected", "demoted"]
+    assert not first.is_leader
+    assert second.try_acquire()
+
+
+def test_leases_with_different_names_are_independent(tmp_path):
+    db = str(tmp_path / "app.db")
+    assert LeaderLease(db, "scheduler").try_acquire()
+    assert LeaderLease(db, "outbox").try_acquire()
+
+
+def test_forked_processes_do_not_share_the_lease(tmp_path):
+    # gunicorn --preload creates the lease before forking workers
+    lease = LeaderLease(str(tmp_path / "app.db"), "scheduler")
+    read_end, write_end = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        os.write(write_end, b"1" if lease.try_acquire() else b"0")
+        os._exit(0)
+
+    os.close(write_end)
+    child_acquired = os.read(read_end, 1) == b"1"
+    os.close(read_end)
+    os.waitpid(pid, 0)
+
+    assert child_acquired
+    assert not lease.try_acquire()
@@ -0,0 +1,155 @@
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+
+from sms_outbox import SmsOutbox
+
+
+class FakeMessages:
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+        self.done = threading.Event()
+
+    def create(self, **params):
+        if self.error:
+            raise self.error
+        self.sent.append(params)
+        self.done.set()
+        return SimpleNamespace(sid=f"SM{len(self.sent)}")
+
+
+class TwilioError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+
+def make_outbox(tmp_path, error=None, **kwargs):
+    client = SimpleNamespace(messages=FakeMessages(error))
+    return SmsOutbox(str(tmp_path / "app.db"), client, '+15550000000', **kwargs), client.messages
+
+
+def message_row(outbox, message_id):
+    conn = sqlite3.connect(outbox.db_path)
+    conn.row_factory = sqlite3.Row
+    row = conn.execute("SELECT * FROM outbound_messages WHERE id = ?", (message_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def test_enqueue_normalizes_and_counts_segments(tmp_path):
+    outbox, _ = make_outbox(tmp_path)
+    message_id = outbox.enqueue('+15551234567', "Your order’s on the way — thanks!")
+
+    row = message_row(outbox, message_id)
+    assert row['body'] == "Your order's on the way - thanks!"
+    assert row['encoding'] == 'GSM-7'
+    assert row['segments'] == 1
+
+
+def test_dedupe_key_queues_a_message_once(tmp_path):
+    outbox, _ = make_outbox(tmp_path)
+    assert outbox.enqueue('+15551234567', 'hi', dedupe_key='batch:1:+15551234567') is not None
+    assert outbox.enqueue('+15551234567', 'hi', dedupe_key='batch:1:+15551234567') is None
+    assert outbox.enqueue_many([
+        {'to_number': '+15551234567', 'body': 'hi', 'dedupe_key': 'batch:1:+15551234567'},
+        {'to_number': '+15557654321', 'body': 'hi', 'dedupe_key': 'batch:1:+15557654321'}
+    ]) == 1
+    assert len(outbox.messages('batch:1:')) == 2
+
+
+def test_claimed_message_is_sent_once(tmp_path):
+    outbox, messages = make_outbox(tmp_path, status_callback_url='https://example.com/status')
+    message_id = outbox.enqueue('+15551234567', 'hi')
+
+    claimed = outbox._claim_due(time.time(), 10)
+    assert outbox._claim_due(time.time(), 10) == []
+    outbox._deliver(claimed[0])
+
+    row = message_row(outbox, message_id)
+    assert row['status'] == 'sent'
+    assert row['message_sid'] == 'SM1'
+    assert messages.sent[0]['status_callback'] == 'https://example.com/status'
+
+
+def test_transient_errors_are_retried_with_backoff(tmp_path):
+    outbox, _ = make_outbox(tmp_path, error=TwilioError(503), retry_delay=5, max_attempts=2)
+    message_id = outbox.enqueue('+15551234567', 'hi')
+
+    before = time.time()
+    outbox._deliver(outbox._claim_due(time.time(), 10)[0])
+    row = message_row(outbox, message_id)
+    assert row['status'] == 'queued'
+    assert row['send_at'] >= before + 5
+
+    outbox._deliver(outbox._claim_due(time.time() + 10, 10)[0])
+    assert message_row(outbox, message_id)['status'] == 'failed'
+
+
+def test_permanent_errors_fail_without_retrying(tmp_path):
+    outbox, _ = make_outbox(tmp_path, error=TwilioError(400))
+    message_id = outbox.enqueue('+15551234567', 'hi')
+
+    outbox._deliver(outbox._claim_due(time.time(), 10)[0])
+    row = message_row(outbox, message_id)
+    assert row['status'] == 'failed'
+    assert row['attempts'] == 1
+
+
+def test_stale_sending_messages_are_requeued(tmp_path):
+    outbox, _ = make_outbox(tmp_path, stale_after=60)
+    message_id = outbox.enqueue('+15551234567', 'hi')
+    outbox._claim_due(time.time(), 10)
+
+    outbox._requeue_stale(time.time() + 120)
+    assert message_row(outbox, message_id)['status'] == 'queued'
+
+
+def test_record_status_matches_on_message_sid(tmp_path):
+    outbox, _ = make_outbox(tmp_path)
+    message_id = outbox.enqueue('+15551234567', 'hi')
+    outbox._deliver(outbox._claim_due(time.time(), 10)[0])
+
+    assert outbox.record_status('SM1', 'undelivered', '30006')
+    assert not outbox.record_status('SMunknown', 'delivered')
+    row = message_row(outbox, message_id)
+    assert (row['delivery_status'], row['error_code']) == ('undelivered', '30006')
+
+
+def test_background_sender_delivers_queued_messages(tmp_path):
+    outbox, messages = make_outbox(tmp_path, poll_interval=0.05)
+    outbox.start()
+    try:
+        outbox.enqueue('+15551234567', 'hi')
+        assert messages.done.wait(2)
+    finally:
+        outbox.stop()
+    assert messages.sent[0]['to'] == '+15551234567'
+
+
+def test_only_the_latest_claim_records_the_outcome(tmp_path):
+    outbox, _ = make_outbox(tmp_path, stale_after=60)
+    message_id = outbox.enqueue('+15551234567', 'hi')
+    slow = outbox._claim_due(time.time(), 10)[0]
+
+    # The slow send goes stale and another sender claims the message
+    outbox._requeue_stale(time.time() + 120)
+    fresh = outbox._claim_due(time.time() + 120, 10)[0]
+
+    assert not outbox._finish(message_id, slow['claim_token'], 'failed', error='timeout')
+    assert message_row(outbox, message_id)['status'] == 'sending'
+    assert outbox._finish(message_id, fresh['claim_token'], 'sent', message_sid='SM2')
+    assert message_row(outbox, message_id)['message_sid'] == 'SM2'
+
+
+def test_requeued_message_can_still_be_finished_by_its_sender(tmp_path):
+    outbox, _ = make_outbox(tmp_path, stale_after=60)
+    message_id = outbox.enqueue('+15551234567', 'hi')
+    slow = outbox._claim_due(time.time(), 10)[0]
+    outbox._requeue_stale(time.time() + 120)
+
+    # Sent before anyone else claimed it, so it is not sent again
+    assert outbox._finish(message_id, slow['claim_token'], 'sent', message_sid='SM1')
+    assert outbox._claim_due(time.time() + 120, 10) == []
@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import pytest
+
+import sms_rate_limit
+from sms_rate_limit import SmsRateLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(sms_rate_limit, 'time', SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def test_refill_is_capped_at_the_burst(tmp_path):
+    limiter = SmsRateLimiter(str(tmp_path / "app.db"))
+    assert limiter._refill(None, 1.0, 5, 100.0) == 5.0
+    assert limiter._refill((1.0, 98.0), 1.0, 5, 100.0) == 3.0
+    assert limiter._refill((1.0, 0.0), 1.0, 5, 100.0) == 5.0
+    # A clock step backwards never removes tokens
+    assert limiter._refill((2.0, 200.0), 1.0, 5, 100.0) == 2.0
+
+
+def test_phone_is_limited_after_its_burst_and_refills(tmp_path, clock):
+    limiter = SmsRateLimiter(str(tmp_path / "app.db"), phone_rate=1.0, phone_burst=3)
+
+    assert [limiter.allow('15551234567') for _ in range(4)] == [None, None, None, 'phone']
+    assert limiter.allow('15557654321') is None
+
+    clock[0] += 1
+    assert limiter.allow('15551234567') is None
+    assert limiter.allow('15551234567') == 'phone'
+    assert limiter.snapshot()['dropped']['phone']['dropped'] == 2
+
+
+def test_global_limit_applies_across_phones(tmp_path, clock):
+    limiter = SmsRateLimiter(str(tmp_path / "app.db"), global_rate=1.0, global_burst=2)
+
+    assert limiter.allow('15550000001') is None
+    assert limiter.allow('15550000002') is None
+    assert limiter.allow('15550000003') == 'global'
+
+
+def test_phone_drops_leave_the_global_bucket_alone(tmp_path, clock):
+    limiter = SmsRateLimiter(str(tmp_path / "app.db"), phone_burst=1, global_rate=0.0, global_burst=3)
+
+    assert limiter.allow('15551234567') is None
+    for _ in range(5):
+        assert limiter.allow('15551234567') == 'phone'
+    assert limiter.allow('15550000002') is None
+    assert limiter.allow('15550000003') is None
+
+
+def test_buckets_are_shared_between_instances(tmp_path, clock):
+    db = str(tmp_path / "app.db")
+    first = SmsRateLimiter(db, phone_burst=1)
+    second = SmsRateLimiter(db, phone_burst=1)
+
+    assert first.allow('15551234567') is None
+    assert second.allow('15551234567') == 'phone'
+
+
+def test_full_phone_buckets_are_purged(tmp_path, clock):
+    limiter = SmsRateLimiter(str(tmp_path / "app.db"), phone_rate=1.0, phone_burst=2)
+    limiter.allow('15551234567')
+    assert limiter.snapshot()['phones_tracked'] == 1
+
+    limiter._purge(clock[0] + 10)
+    assert limiter.snapshot()['phones_tracked'] == 0
@@ -0,0 +1,66 @@
+from sms_segments import SegmentStats, SmsRenderer, count_segments, gsm_normalize, is_gsm7
+
+
+def test_empty_message_has_no_segments():
+    assert count_segments("")["segments"] == 0
+
+
+def test_gsm7_single_and_concatenated_limits():
+    assert count_segments("a" * 160) == {"encoding": "GSM-7", "units": 160, "segments": 1}
+    assert count_segments("a" * 161)["segments"] == 2
+    assert count_segments("a" * 306)["segments"] == 2
+    assert count_segments("a" * 307)["segments"] == 3
+
+
+def test_extension_characters_cost_two_septets():
+    info = count_segments("€" * 80)
+    assert (info["encoding"], info["units"], info["segments"]) == ("GSM-7", 160, 1)
+    # An escape pair is never split, so 152 septets + "{" starts segment two
+    assert count_segments("a" * 152 + "{" + "a" * 10)["segments"] == 2
+
+
+def test_non_gsm_characters_switch_to_ucs2():
+    assert count_segments("é" * 160)["encoding"] == "GSM-7"
+    assert count_segments("ł" * 70) == {"encoding": "UCS-2", "units": 70, "segments": 1}
+    assert count_segments("ł" * 71)["segments"] == 2
+    assert count_segments("ł" * 134)["segments"] == 2
+
+
+def test_emoji_count_as_surrogate_pairs():
+    assert count_segments("🍕" * 35) == {"encoding": "UCS-2", "units": 70, "segments": 1}
+    assert count_segments("🍕" * 36)["segments"] == 2
+
+
+def test_normalize_replaces_punctuation_but_not_letters():
+    text = gsm_normalize("“Order’s ready” — Zoé’s Café…")
+    assert text == "\"Order's ready\" - Zoé's Café..."
+    assert is_gsm7(text)
+    assert gsm_normalize("Łukasz") == "Łukasz"
+
+
+def test_renderer_picks_the_richest_variant_within_budget():
+    renderer = SmsRenderer(default_budget=1, budgets={"menu": 2})
+
+    assert renderer.render("help", "a" * 200, "short") == "short"
+    assert renderer.render("menu", "a" * 200, "short") == "a" * 200
+
+
+def test_renderer_falls_back_to_the_smallest_variant():
+    renderer = SmsRenderer(default_budget=1)
+    text, info = renderer.choose("menu", ["a" * 400, "a" * 200])
+    assert text == "a" * 200
+    assert info["segments"] == 2
+
+
+def test_stats_track_segments_per_kind():
+    stats = SegmentStats()
+    renderer = SmsRenderer(stats=stats)
+    renderer.render("menu", "a" * 200)
+    renderer.render("menu", "ł")
+    renderer.render("help", "hi")
+
+    snapshot = stats.snapshot()
+    assert snapshot["total_segments"] == 4
+    assert snapshot["kinds"]["menu"] == {
+        "messages": 2, "segments": 3, "ucs2": 1, "max_segments": 2, "avg_segments": 1.5
+    }
@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import pytest
+import stripe
+
+from stripe_catalog import StripeCatalog
+
+
+class FakeStripe:
+    def __init__(self):
+        self.prices = {}
+        self.calls = []
+
+    def list_prices(self, lookup_keys, active, limit):
+        self.calls.append('Price.list')
+        found = [self.prices[key] for key in lookup_keys if key in self.prices]
+        return SimpleNamespace(data=found)
+
+    def create_product(self, name, description, idempotency_key):
+        self.calls.append('Product.create')
+        return SimpleNamespace(id=f"prod_{len(self.calls)}")
+
+    def create_price(self, product, currency, custom_unit_amount, lookup_key, idempotency_key):
+        self.calls.append('Price.create')
+        price = SimpleNamespace(id=f"price_{len(self.calls)}", product=product)
+        self.prices[lookup_key] = price
+        return price
+
+    def create_session(self, **params):
+        self.calls.append('Session.create')
+        return SimpleNamespace(id='cs_test_1', **params)
+
+
+@pytest.fixture
+def fake_stripe(monkeypatch):
+    fake = FakeStripe()
+    monkeypatch.setattr(stripe, 'api_key', 'sk_test_123')
+    monkeypatch.setattr(stripe.Price, 'list', fake.list_prices)
+    monkeypatch.setattr(stripe.Price, 'create', fake.create_price)
+    monkeypatch.setattr(stripe.Product, 'create', fake.create_product)
+    monkeypatch.setattr(stripe.checkout.Session, 'create', fake.create_session)
+    return fake
+
+
+def test_price_is_created_once_per_fee(tmp_path, fake_stripe):
+    catalog = StripeCatalog(str(tmp_path / "app.db"))
+
+    price_id = catalog.price_for_fee(3.99)
+    assert catalog.price_for_fee(3.99) == price_id
+    assert catalog.price_for_fee(5.00) != price_id
+    assert fake_stripe.calls.count('Price.create') == 2
+    assert catalog.snapshot()["hits"] == 1
+
+
+def test_stored_prices_survive_a_restart(tmp_path, fake_stripe):
+    db = str(tmp_path / "app.db")
+    price_id = StripeCatalog(db).price_for_fee(3.99)
+    fake_stripe.calls.clear()
+
+    catalog = StripeCatalog(db)
+    assert catalog.price_for_fee(3.99) == price_id
+    assert fake_stripe.calls == []
+    assert catalog.snapshot()["loaded"] == 1
+
+
+def test_existing_price_is_found_by_lookup_key(tmp_path, fake_stripe):
+    price_id = StripeCatalog(str(tmp_path / "first.db")).price_for_fee(3.99)
+    fake_stripe.calls.clear()
+
+    catalog = StripeCatalog(str(tmp_path / "fresh.db"))
+    assert catalog.price_for_fee(3.99) == price_id
+    assert fake_stripe.calls == ['Price.list']
+    assert catalog.snapshot()["found"] == 1
+
+
+def test_test_and_live_keys_use_separate_prices(tmp_path, fake_stripe, monkeypatch):
+    catalog = StripeCatalog(str(tmp_path / "app.db"))
+    test_key = catalog._lookup_key(399)
+    monkeypatch.setattr(stripe, 'api_key', 'sk_live_123')
+    assert catalog._lookup_key(399) != test_key
+    assert test_key == "treehouse_order_test_usd_399"
+
+
+def test_checkout_session_uses_the_cached_price(tmp_path, fake_stripe):
+    catalog = StripeCatalog(str(tmp_path / "app.db"))
+    price_id = catalog.price_for_fee(3.99)
+    fake_stripe.calls.clear()
+
+    session = catalog.create_checkout_session(3.99, 'https://example.com/ok', 'https://example.com/cancel',
+                                              {'phone_number': '+15551234567'})
+    assert fake_stripe.calls == ['Session.create']
+    assert session.line_items == [{'price': price_id, 'quantity': 1}]
+    assert session.metadata == {'phone_number': '+15551234567'}
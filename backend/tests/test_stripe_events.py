@@ -0,0 +1,68 @@
+import time
+
+import pytest
+
+from stripe_events import StripeEventStore
+
+
+def event(event_id='evt_1', event_type='checkout.session.completed'):
+    return {'id': event_id, 'type': event_type, 'data': {'object': {'id': 'cs_test_1'}}}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return StripeEventStore(str(tmp_path / "app.db"))
+
+
+def test_redelivered_event_is_stored_once(store):
+    assert store.record(event())
+    assert not store.record(event())
+    assert store.event_ids(['received']) == ['evt_1']
+
+
+def test_event_is_claimed_once(store):
+    store.record(event())
+
+    assert store.claim('evt_1') == event()
+    assert store.claim('evt_1') is None
+    assert store.claim('evt_missing') is None
+
+
+def test_processed_event_is_only_claimed_again_on_replay(store):
+    store.record(event())
+    store.claim('evt_1')
+    store.finish('evt_1', 'processed')
+
+    assert store.claim('evt_1') is None
+    assert store.claim('evt_1', force=True) == event()
+
+
+def test_failed_event_can_be_retried(store):
+    store.record(event())
+    store.claim('evt_1')
+    store.finish('evt_1', 'failed', 'boom')
+
+    assert store.event_ids(['failed']) == ['evt_1']
+    assert store.claim('evt_1') is not None
+
+
+def test_stale_processing_claim_is_taken_over(store):
+    store.stale_after = 0
+    store.record(event())
+    store.claim('evt_1')
+    time.sleep(0.01)
+
+    assert store.claim('evt_1') is not None
+
+
+def test_event_ids_filters_by_status_and_age(store):
+    store.record(event('evt_1'))
+    time.sleep(0.01)
+    since = time.time()
+    store.record(event('evt_2'))
+    store.claim('evt_2')
+    store.finish('evt_2', 'ignored')
+
+    assert store.event_ids(['received', 'ignored']) == ['evt_1', 'evt_2']
+    assert store.event_ids(['received', 'ignored'], since=since) == ['evt_2']
+    assert store.snapshot()['statuses'] == {'received': 1, 'ignored': 1}
@@ -0,0 +1,180 @@
+import json
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import uber_direct_delivery
+from uber_direct_delivery import DEFAULT_DROPOFF, QuoteCache, TokenBucket, UberDirectBase
+
+LOCATIONS = {
+    "campus_buildings": {
+        "Library": {"address": "801 S Morgan St, Chicago, IL 60607", "latitude": 41.8718,
+                    "longitude": -87.6498, "phone": "+13125550001", "aliases": ["Daley Library"]},
+        "Student Center West": {"address": "828 S Wolcott Ave, Chicago, IL 60612", "latitude": 41.8717,
+                                "longitude": -87.6732, "phone": "+13125550002", "aliases": ["SCW"]}
+    },
+    "campus_places": {
+        "Marie Robinson Hall": {"latitude": 41.8712, "longitude": -87.6727, "aliases": ["MRH"]}
+    },
+    "restaurant_locations": {
+        # Chipotle and Starbucks are ~50m apart; Portillo's is ~1km away
+        "Chipotle": {"address": "1132 S Clinton St, Chicago, IL 60607", "latitude": 41.8678,
+                     "longitude": -87.6410, "phone": "+13125550003"},
+        "Starbucks": {"address": "1140 S Clinton St, Chicago, IL 60607", "latitude": 41.8674,
+                      "longitude": -87.6412, "phone": "+13125550004"},
+        "Portillo's": {"address": "520 W Taylor St, Chicago, IL 60607", "latitude": 41.8697,
+                       "longitude": -87.6282, "phone": "+13125550005"}
+    }
+}
+
+
+@pytest.fixture
+def planner(tmp_path):
+    path = tmp_path / "locations.json"
+    path.write_text(json.dumps(LOCATIONS))
+    return UberDirectBase.planner(consolidation_radius_m=150, locations_path=str(path))
+
+
+def quote(expires_in=None, quote_id="dqt_1"):
+    data = {"id": quote_id, "fee": 599}
+    if expires_in is not None:
+        expires = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+        data["expires"] = expires.isoformat().replace('+00:00', 'Z')
+    return data
+
+
+def test_quote_cache_key_ignores_window_order_and_blanks():
+    first = QuoteCache.make_key("Chipotle", "Library", {"pickup_ready": "10:00", "dropoff_deadline": "11:00"})
+    second = QuoteCache.make_key("Chipotle", "Library", {"dropoff_deadline": "11:00", "pickup_ready": "10:00",
+                                                         "dropoff_ready": None})
+    assert first == second
+    assert QuoteCache.make_key("Chipotle", "Library") != first
+
+
+def test_quote_cache_stops_serving_quotes_inside_the_margin():
+    cache = QuoteCache(margin=60)
+    cache.put("fresh", quote(expires_in=120))
+    cache.put("closing", quote(expires_in=30))
+
+    assert cache.get("fresh")["id"] == "dqt_1"
+    assert cache.get("closing") is None
+    assert cache.snapshot()["expired"] == 1
+
+
+def test_quote_cache_uses_default_ttl_without_expires(monkeypatch):
+    cache = QuoteCache(margin=0, default_ttl=300)
+    cache.put("key", quote())
+
+    now = uber_direct_delivery.time.time()
+    monkeypatch.setattr(uber_direct_delivery, 'time', SimpleNamespace(time=lambda: now + 301))
+    assert cache.get("key") is None
+
+
+def test_quote_cache_take_and_consume_remove_quotes():
+    cache = QuoteCache()
+    cache.put("a", quote(expires_in=900, quote_id="dqt_a"))
+    cache.put("b", quote(expires_in=900, quote_id="dqt_b"))
+
+    assert cache.get("a", take=True)["id"] == "dqt_a"
+    assert cache.get("a") is None
+    cache.consume("dqt_b")
+    assert cache.get("b") is None
+
+
+def test_quote_cache_evicts_the_soonest_expiring_entry():
+    cache = QuoteCache(margin=0, max_entries=2)
+    cache.put("late", quote(expires_in=900))
+    cache.put("soon", quote(expires_in=300))
+    cache.put("new", quote(expires_in=600))
+
+    assert set(cache.entries) == {"late", "new"}
+
+
+def test_token_bucket_allows_the_burst_then_paces(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(uber_direct_delivery, 'time', SimpleNamespace(monotonic=lambda: clock[0]))
+    bucket = TokenBucket(rate=2.0, burst=3)
+
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+
+    # Refills at rate, never above the burst
+    clock[0] += 60
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() > 0
+
+
+def test_token_bucket_acquire_sleeps_for_the_wait(monkeypatch):
+    slept = []
+    monkeypatch.setattr(uber_direct_delivery, 'time', SimpleNamespace(monotonic=lambda: 100.0, sleep=slept.append))
+    bucket = TokenBucket(rate=4.0, burst=1)
+
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == pytest.approx(0.25)
+    assert slept == [pytest.approx(0.25)]
+
+
+def test_idempotency_key_is_deterministic(planner):
+    orders = [{"order_id": 1}, {"order_id": 2}]
+
+    key = planner.make_idempotency_key(7, "Portillo's", "Student Center West", orders)
+    assert key == "treehouse-batch-7-portillo-s-student-center-west"
+    assert key == planner.make_idempotency_key(7, "Portillo's", "Student Center West")
+    assert key != planner.make_idempotency_key(8, "Portillo's", "Student Center West")
+
+
+def test_idempotency_key_without_a_batch_uses_the_orders(planner):
+    key = planner.make_idempotency_key(None, "Chipotle", "Library", [{"order_id": 1}, {"order_id": 2}])
+
+    assert key == planner.make_idempotency_key(None, "Chipotle", "Library", [{"order_id": 2}, {"order_id": 1}])
+    assert key != planner.make_idempotency_key(None, "Chipotle", "Library", [{"order_id": 3}])
+    assert key != planner.make_idempotency_key(None, "Starbucks", "Library", [{"order_id": 1}, {"order_id": 2}])
+
+
+def test_dropoff_for_matches_aliases_and_nearest_building(planner):
+    assert planner.dropoff_for("Daley Library 3rd floor") == "Library"
+    assert planner.dropoff_for("scw") == "Student Center West"
+    # A residence hall goes to the building nearest it
+    assert planner.dropoff_for("MRH room 210") == "Student Center West"
+    assert planner.dropoff_for("somewhere else") == DEFAULT_DROPOFF
+    assert planner.dropoff_for(None) == DEFAULT_DROPOFF
+
+
+def test_route_orders_groups_by_dropoff(planner):
+    orders = [
+        {"order_id": 1, "dorm_building": "Library"},
+        {"order_id": 2, "dorm_building": "MRH"},
+        {"order_id": 3, "dorm_building": None}
+    ]
+    routes = planner.route_orders(orders)
+
+    assert {name: [order["order_id"] for order in routed] for name, routed in routes.items()} == {
+        "Library": [1, 3],
+        "Student Center West": [2]
+    }
+
+
+def test_consolidate_jobs_merges_nearby_restaurants_per_dropoff(planner):
+    jobs = [
+        ("Chipotle", "Library", [{"order_id": 1}, {"order_id": 2}]),
+        ("Starbucks", "Library", [{"order_id": 3}]),
+        ("Portillo's", "Library", [{"order_id": 4}]),
+        ("Starbucks", "Student Center West", [{"order_id": 5}])
+    ]
+    merged = planner.consolidate_jobs(jobs, planner.consolidation_radius_km)
+
+    by_route = {(pickup, destination): orders for pickup, destination, orders in merged}
+    assert set(by_route) == {
+        ("Chipotle", "Library"), ("Portillo's", "Library"), ("Starbucks", "Student Center West")
+    }
+    # The pickup is the restaurant with the most orders; each order keeps its own
+    assert [(order["order_id"], order["restaurant"]) for order in by_route[("Chipotle", "Library")]] == [
+        (1, "Chipotle"), (2, "Chipotle"), (3, "Starbucks")
+    ]
+
+
+def test_consolidate_jobs_keeps_far_restaurants_apart(planner):
+    jobs = [("Chipotle", "Library", [{"order_id": 1}]), ("Starbucks", "Library", [{"order_id": 2}])]
+    assert len(planner.consolidate_jobs(jobs, 0.01)) == 2
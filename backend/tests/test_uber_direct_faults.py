@@ -0,0 +1,110 @@
+import time
+import uuid
+
+import pytest
+import requests
+
+from uber_direct_delivery import UberDirectDelivery
+from uber_direct_stub import UberDirectStub
+
+ORDERS = [{"customer_name": "Test", "order_number": "1", "order_id": 1}]
+
+
+@pytest.fixture
+def stub():
+    with UberDirectStub() as stub:
+        yield stub
+
+
+def make_client(cls, stub):
+    # A fresh client id each time, so no token or rate limiter is shared
+    # with another test's stub
+    return cls(
+        client_id=f"test-{uuid.uuid4().hex[:8]}",
+        client_secret="test",
+        customer_id="test-customer",
+        auth_url=stub.auth_url,
+        api_base_url=stub.url,
+        rate_limit=1000,
+        rate_burst=1000,
+        backoff_base=0.01,
+        read_timeout=2.0
+    )
+
+
+@pytest.fixture
+def client(stub):
+    client = make_client(UberDirectDelivery, stub)
+    client.get_access_token()
+    yield client
+    client.close()
+
+
+def book(client, idempotency_key="treehouse-batch-1-chipotle-library"):
+    quote = client.create_quote("Chipotle", "Library", use_cache=False)
+    return client.create_delivery("Chipotle", "Library", ORDERS, quote, idempotency_key=idempotency_key)
+
+
+def test_429_waits_for_retry_after(stub, client):
+    stub.inject('deliveries', status=429, retry_after=0.3)
+
+    started = time.monotonic()
+    book(client)
+    assert time.monotonic() - started >= 0.3
+    assert stub.stats['booked'] == 1
+
+
+def test_5xx_is_retried(stub, client):
+    stub.inject('deliveries', status=503, count=2)
+
+    assert book(client)['id'].startswith('del_')
+    assert stub.stats['faults'] == 2
+    assert stub.stats['booked'] == 1
+
+
+def test_lost_response_after_booking_books_once(stub, client):
+    stub.inject('deliveries', disconnect=True)
+
+    delivery = book(client)
+    assert stub.stats['booked'] == 1
+    assert stub.stats['replayed'] == 1
+    assert stub.bookings["treehouse-batch-1-chipotle-library"]['id'] == delivery['id']
+
+
+def test_no_retry_without_an_idempotency_key(stub, client):
+    stub.inject('deliveries', status=503)
+    with pytest.raises(requests.exceptions.HTTPError):
+        book(client, idempotency_key=None)
+    # A retry would have gone through and booked
+    assert 'booked' not in stub.stats
+
+    stub.inject('deliveries', disconnect=True)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        book(client, idempotency_key=None)
+    assert stub.stats['booked'] == 1
+    assert 'replayed' not in stub.stats
+
+
+@pytest.mark.parametrize('blocking', [False, True], ids=['sync', 'async'])
+def test_batch_with_faults_books_each_restaurant_once(stub, blocking):
+    if blocking:
+        from uber_direct_async import AsyncUberDirectDelivery, BlockingAsyncUberDirect
+        client = BlockingAsyncUberDirect(make_client(AsyncUberDirectDelivery, stub))
+    else:
+        client = make_client(UberDirectDelivery, stub)
+    batch = {
+        "batch_id": 1,
+        "restaurants": {name: list(ORDERS) for name in ("Chipotle", "McDonald's", "Starbucks")}
+    }
+
+    stub.inject('deliveries', status=503, count=2)
+    stub.inject('deliveries', status=429, retry_after=0.1)
+    stub.inject('deliveries', disconnect=True)
+    try:
+        assert len(client.process_batch(batch)) == 3
+        # Running the batch again books nothing new
+        client.process_batch(batch)
+    finally:
+        client.close()
+
+    assert stub.stats['booked'] == 3
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+from flask import Flask
+
+from webhook_dedupe import EMPTY_TWIML, WebhookDedupe
+
+
+@pytest.fixture
+def dedupe(tmp_path):
+    return WebhookDedupe(str(tmp_path / "app.db"), wait=0.2, poll_interval=0.05)
+
+
+def make_app(dedupe, handler):
+    app = Flask(__name__)
+    app.add_url_rule('/webhook/sms', 'sms', dedupe.deduplicate(handler), methods=['POST'])
+    return app.test_client()
+
+
+def test_retry_replays_the_stored_reply(dedupe):
+    calls = []
+
+    def handler():
+        calls.append(1)
+        return f"<Response><Message>reply {len(calls)}</Message></Response>", 200, {'Content-Type': 'text/xml'}
+
+    client = make_app(dedupe, handler)
+    first = client.post('/webhook/sms', data={'MessageSid': 'SM1', 'Body': 'menu'})
+    retry = client.post('/webhook/sms', data={'MessageSid': 'SM1', 'Body': 'menu'})
+
+    assert calls == [1]
+    assert retry.data == first.data
+    assert retry.mimetype == 'text/xml'
+    assert dedupe.snapshot()['replayed'] == 1
+
+
+def test_failed_delivery_releases_its_claim(dedupe):
+    calls = []
+
+    def handler():
+        calls.append(1)
+        if len(calls) == 1:
+            return "error", 500
+        return "ok"
+
+    client = make_app(dedupe, handler)
+    assert client.post('/webhook/sms', data={'MessageSid': 'SM1'}).status_code == 500
+    assert client.post('/webhook/sms', data={'MessageSid': 'SM1'}).data == b"ok"
+    assert len(calls) == 2
+
+
+def test_requests_without_a_sid_always_run(dedupe):
+    calls = []
+    client = make_app(dedupe, lambda: calls.append(1) or "ok")
+
+    client.post('/webhook/sms', data={'Body': 'menu'})
+    client.post('/webhook/sms', data={'Body': 'menu'})
+    assert len(calls) == 2
+    assert dedupe.snapshot()['unkeyed'] == 2
+
+
+def test_claim_is_exclusive_until_stale(dedupe):
+    assert dedupe._claim('SM1')
+    assert not dedupe._claim('SM1')
+
+    dedupe.stale_after = 0
+    time.sleep(0.01)
+    assert dedupe._claim('SM1')
+
+
+def test_retry_during_processing_is_acknowledged_without_a_reply(dedupe):
+    dedupe._claim('SM1')
+
+    response = dedupe._replay('SM1')
+    assert response.get_data(as_text=True) == EMPTY_TWIML
+    assert dedupe.snapshot()['in_flight'] == 1
+
+
+def test_expired_replies_are_purged(dedupe):
+    dedupe._claim('SM1')
+    dedupe.ttl = 0
+    time.sleep(0.01)
+    dedupe._purge()
+    assert dedupe._stored('SM1') is None
@@ -0,0 +1,297 @@
+import asyncio
+import threading
+import logging
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from uber_direct_delivery import RETRYABLE_STATUSES, UberDirectBase, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncUberDirectDelivery(UberDirectBase):
+    def __init__(self, client_id: str, client_secret: str, customer_id: str, test_mode: bool = True,
+                 pool_size: int = 20, **kwargs):
+        """
+        asyncio Uber Direct client with the same surface as UberDirectDelivery
+        
+        Quotes and deliveries for many batches can be in flight on one event
+        loop. Tokens and rate limits are shared with the blocking client.
+        
+        Args:
+            client_id: Uber Direct API client ID
+            client_secret: Uber Direct API client secret
+            customer_id: Uber Direct customer ID
+            test_mode: Whether to use test mode with robo couriers
+            pool_size: Maximum open connections to the API
+            **kwargs: Connection, token and rate limit options for UberDirectBase
+        """
+        super().__init__(client_id, client_secret, customer_id, test_mode, **kwargs)
+        self.pool_size = pool_size
+        self.session = None
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created lazily so it binds to the loop that uses it
+        if self.session is None or self.session.closed:
+            connect_timeout, read_timeout = self.timeout
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+            )
+        return self.session
+    
+    async def _post(self, url: str, token: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """POST JSON under the shared rate limiter and return the decoded body"""
+        wait = self.rate_limiter.reserve()
+        if wait:
+            logger.info(f"Rate limited, waited {wait:.2f}s")
+            await asyncio.sleep(wait)
+        
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {token}'
+        }
+        
+        async with self._get_session().post(url, headers=headers, json=payload) as response:
+            if response.status == 401:
+                self.token_provider.invalidate()
+            if response.status >= 400 and response.status not in RETRYABLE_STATUSES:
+                logger.error(f"Response: {await response.text()}")
+            response.raise_for_status()
+            return await response.json()
+    
+    async def _post_json(self, url: str, payload: Dict[str, Any], action: str,
+                         idempotent: bool = True) -> Dict[str, Any]:
+        """POST with the same retry policy as UberDirectDelivery._post_json"""
+        for attempt in range(self.delivery_retries + 1):
+            retries_left = attempt < self.delivery_retries
+            unsafe_retries_left = retries_left and idempotent
+            
+            try:
+                token = await self.get_access_token()
+                return await self._post(url, token, payload)
+            
+            except aiohttp.ClientResponseError as e:
+                if e.status not in RETRYABLE_STATUSES or not (
+                    unsafe_retries_left or (retries_left and e.status == 429)
+                ):
+                    logger.error(f"Error creating {action}: {e}")
+                    raise
+                
+                retry_after = parse_retry_after(e.headers.get('Retry-After')) if e.status == 429 and e.headers else None
+                delay = self.backoff_delay(attempt, retry_after)
+                logger.warning(
+                    f"Creating {action} got HTTP {e.status}, "
+                    f"retrying in {delay:.2f}s (attempt {attempt + 1}/{self.delivery_retries})"
+                )
+                await asyncio.sleep(delay)
+            
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if not unsafe_retries_left:
+                    logger.error(f"Error creating {action} after {attempt + 1} attempts: {e}")
+                    raise
+                
+                delay = self.backoff_delay(attempt)
+                logger.warning(f"Creating {action} failed ({e!r}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+    
+    async def close(self):
+        """Close pooled connections"""
+        if self.session is not None:
+            await self.session.close()
+    
+    async def get_access_token(self) -> str:
+        """
+        Get OAuth token from Uber Direct API
+        
+        Returns:
+            str: Access token
+        """
+        token = self.token_provider.cached_token()
+        if token:
+            return token
+        
+        # Token fetches are rare and go through the shared blocking provider
+        return await asyncio.to_thread(self.token_provider.get_token)
+    
+    async def create_quote(self, restaurant_name: str, destination_name: str,
+                           delivery_windows: Dict[str, str] = None, use_cache: bool = True) -> Dict[str, Any]:
+        """
+        Create a delivery quote for a restaurant to a destination
+        
+        Args:
+            restaurant_name: Name of the restaurant
+            destination_name: Name of the campus building for delivery
+            delivery_windows: Optional dictionary with delivery window timestamps
+            use_cache: Book with a cached quote for the same route and window if one
+                is still valid
+            
+        Returns:
+            dict: Quote data
+        """
+        cache_key = self.quote_cache.make_key(restaurant_name, destination_name, delivery_windows)
+        if use_cache:
+            # Taken, not peeked, so concurrent batches never book the same quote
+            cached = self.quote_cache.get(cache_key, take=True)
+            if cached:
+                logger.info(f"Reusing quote {cached['id']} for {restaurant_name} to {destination_name}")
+                return cached
+        
+        url = f"{self.api_base_url}/v1/customers/{self.customer_id}/delivery_quotes"
+        payload = self.build_quote_payload(restaurant_name, destination_name, delivery_windows)
+        quote_data = await self._post_json(url, payload, f"quote for {restaurant_name}")
+        
+        self.log_quote(restaurant_name, destination_name, quote_data)
+        return quote_data
+    
+    async def create_delivery(self, restaurant_name: str, destination_name: str,
+                              orders: List[Dict[str, Any]], quote: Dict[str, Any],
+                              delivery_windows: Dict[str, str] = None,
+                              idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Create a delivery for a restaurant with consolidated orders
+        
+        Args:
+            restaurant_name: Name of the restaurant
+            destination_name: Name of the campus building for delivery
+            orders: List of orders with customer name and items
+            quote: Quote data from create_quote
+            delivery_windows: Optional dictionary with delivery window timestamps
+            idempotency_key: Key from make_idempotency_key
+            
+        Returns:
+            dict: Delivery data
+        """
+        url = f"{self.api_base_url}/v1/customers/{self.customer_id}/deliveries"
+        payload = self.build_delivery_payload(
+            restaurant_name, destination_name, orders, quote, delivery_windows, idempotency_key
+        )
+        
+        # Without a key a retried timeout could book a second courier
+        delivery_data = await self._post_json(
+            url, payload, f"delivery for {restaurant_name}", idempotent=idempotency_key is not None
+        )
+        
+        self.quote_cache.consume(quote["id"])
+        self.log_delivery(delivery_data)
+        return delivery_data
+    
+    async def estimate_fee(self, restaurant_name: str, destination_name: str = "Library",
+                           delivery_windows: Dict[str, str] = None) -> Dict[str, Any]:
+        """
+        Estimate the delivery fee for a route, served from the quote cache when possible
+        
+        Args:
+            restaurant_name: Name of the restaurant
+            destination_name: Name of the campus building for delivery
+            delivery_windows: Optional dictionary with delivery window timestamps
+            
+        Returns:
+            dict: Fee, currency, ETA and whether the quote came from cache
+        """
+        cache_key = self.quote_cache.make_key(restaurant_name, destination_name, delivery_windows)
+        cached = self.quote_cache.get(cache_key)
+        if cached:
+            return self.summarize_quote(cached, True)
+        
+        quote = await self.create_quote(restaurant_name, destination_name, delivery_windows, use_cache=False)
+        self.quote_cache.put(cache_key, quote)
+        return self.summarize_quote(quote, False)
+    
+    async def process_batch(self, batch_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """
+        Process a batch of orders grouped by restaurant and drop-off
+        
+        Args:
+            batch_data: Dictionary with campus location and orders by restaurant
+            
+        Returns:
+            dict: Delivery data keyed by delivery_key(restaurant, destination)
+        """
+        delivery_windows, jobs = self.plan_batch(batch_data)
+        batch_id = batch_data.get("batch_id")
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        async def process_restaurant(restaurant_name, destination_name, orders):
+            async with semaphore:
+                logger.info(f"\n========= Processing {restaurant_name} =========")
+                logger.info(f"Consolidating {len(orders)} orders for delivery to {destination_name}")
+                
+                quote = await self.create_quote(restaurant_name, destination_name, delivery_windows)
+                idempotency_key = self.make_idempotency_key(batch_id, restaurant_name, destination_name, orders)
+                delivery = await self.create_delivery(
+                    restaurant_name, destination_name, orders, quote, delivery_windows, idempotency_key
+                )
+                
+                return {
+                    "restaurant": restaurant_name,
+                    "restaurants": sorted({order.get("restaurant", restaurant_name) for order in orders}),
+                    "quote": quote,
+                    "delivery": delivery,
+                    "orders": orders,
+                    "destination": destination_name
+                }
+        
+        results = await asyncio.gather(
+            *(process_restaurant(*job) for job in jobs),
+            return_exceptions=True
+        )
+        
+        deliveries = {}
+        for (restaurant_name, destination_name, _), result in zip(jobs, results):
+            key = self.delivery_key(restaurant_name, destination_name)
+            if isinstance(result, Exception):
+                logger.error(f"Error processing {key}: {result}")
+            else:
+                deliveries[key] = result
+        
+        logger.info("\n========= All deliveries have been processed! =========")
+        return deliveries
+
+
+class BlockingAsyncUberDirect:
+    def __init__(self, client: AsyncUberDirectDelivery):
+        """
+        Blocking facade over AsyncUberDirectDelivery for existing callers
+        
+        All calls run on one background event loop, so batches processed from
+        different worker threads share its connections and overlap their I/O.
+        
+        Args:
+            client: Async client to drive
+        """
+        self.client = client
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='uber-direct-loop', daemon=True)
+        self._thread.start()
+    
+    def __getattr__(self, name):
+        # Locations, payload builders etc. come straight from the client
+        return getattr(self.client, name)
+    
+    def _run(self, coroutine, timeout: Optional[float] = None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+    
+    def get_access_token(self) -> str:
+        return self._run(self.client.get_access_token())
+    
+    def create_quote(self, *args, **kwargs) -> Dict[str, Any]:
+        return self._run(self.client.create_quote(*args, **kwargs))
+    
+    def create_delivery(self, *args, **kwargs) -> Dict[str, Any]:
+        return self._run(self.client.create_delivery(*args, **kwargs))
+    
+    def estimate_fee(self, *args, **kwargs) -> Dict[str, Any]:
+        return self._run(self.client.estimate_fee(*args, **kwargs))
+    
+    def process_batch(self, batch_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        return self._run(self.client.process_batch(batch_data))
+    
+    def close(self):
+        """Close the client's connections and stop the event loop"""
+        try:
+            self._run(self.client.close(), timeout=5)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout=5)
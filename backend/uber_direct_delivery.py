@@ -1,91 +1,207 @@
 import requests
+import hashlib
 import json
+import math
+import os
+import random
+import re
+import threading
 import time
 import logging
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from typing import List, Dict, Any, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class UberDirectDelivery:
-    def __init__(self, client_id: str, client_secret: str, customer_id: str, test_mode: bool = True):
+UBER_AUTH_URL = 'https://auth.uber.com/oauth/v2/token'
+UBER_API_BASE_URL = 'https://api.uber.com'
+
+DEFAULT_DROPOFF = "Library"
+
+DEFAULT_LOCATIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'delivery_locations.json')
+
+# Every order is packed the same way, so manifest items share one dict
+MANIFEST_DIMENSIONS = {"length": 25, "height": 15, "depth": 20}
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def normalize_place(text: Optional[str]) -> str:
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', (text or '').lower()).split())
+
+
+# Distinct free-text locations remembered by dropoff_for; users type
+# anything, so the cache is capped and the oldest entries are dropped
+DROPOFF_CACHE_SIZE = 1024
+
+# Statuses worth retrying; anything else is a problem with the request itself
+RETRYABLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header given in seconds or as an HTTP date
+    
+    Returns:
+        float: Seconds to wait, or None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def load_locations(path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Load drop-off buildings, residence halls and restaurants from a JSON file
+    
+    Args:
+        path: File to read (defaults to data/delivery_locations.json)
+        
+    Returns:
+        dict: campus_buildings, campus_places and restaurant_locations
+    """
+    path = path or DEFAULT_LOCATIONS_PATH
+    with open(path) as f:
+        locations = json.load(f)
+    
+    required = {
+        "campus_buildings": ("address", "latitude", "longitude", "phone"),
+        "campus_places": ("latitude", "longitude"),
+        "restaurant_locations": ("address", "latitude", "longitude", "phone")
+    }
+    for section, fields in required.items():
+        if section == "campus_places" and section not in locations:
+            continue
+        if not locations.get(section):
+            raise ValueError(f"{path}: '{section}' is missing or empty")
+        for name, location in locations[section].items():
+            missing = [field for field in fields if field not in location]
+            if missing:
+                raise ValueError(f"{path}: {section} '{name}' is missing {', '.join(missing)}")
+    
+    return locations
+
+class UberTokenProvider:
+    def __init__(self, client_id: str, client_secret: str, auth_url: str = UBER_AUTH_URL,
+                 scope: str = 'eats.deliveries', cache_path: Optional[str] = None,
+                 refresh_ahead: float = 600.0, timeout: tuple = (3.05, 15.0), max_retries: int = 3,
+                 refresh_backoff: float = 30.0, refresh_backoff_cap: float = 900.0,
+                 max_auth_failures: int = 5):
         """
-        Initialize Uber Direct delivery service
+        Thread-safe OAuth token cache shared by every UberDirectDelivery
+        using the same credentials
         
         Args:
             client_id: Uber Direct API client ID
             client_secret: Uber Direct API client secret
-            customer_id: Uber Direct customer ID
-            test_mode: Whether to use test mode with robo couriers
+            auth_url: OAuth token endpoint
+            scope: OAuth scope to request
+            cache_path: Optional file to persist the token across restarts
+                and share it between worker processes
+            refresh_ahead: Seconds before expiry to refresh in the background
+            timeout: (connect, read) timeouts for token requests
+            max_retries: Retries for token requests
+            refresh_backoff: Seconds before the first retry of a failed
+                background refresh; doubles on each further failure
+            refresh_backoff_cap: Longest wait between background retries
+            max_auth_failures: Rejected credentials in a row after which the
+                background refresh gives up (get_token still works on demand)
         """
         self.client_id = client_id
         self.client_secret = client_secret
-        self.customer_id = customer_id
-        self.test_mode = test_mode
+        self.auth_url = auth_url
+        self.scope = scope
+        self.cache_path = cache_path
+        self.refresh_ahead = refresh_ahead
+        self.timeout = timeout
+        self.refresh_backoff = refresh_backoff
+        self.refresh_backoff_cap = refresh_backoff_cap
+        self.max_auth_failures = max_auth_failures
         self.access_token = None
-        self.token_expiry = None
-        
-        # Single campus drop-off location - Richard J Daley Library
-        self.campus_buildings = {
-            "Library": {
-                "address": "801 S Morgan St, Chicago, IL 60607",
-                "latitude": 41.8718,  # Approximate coordinates
-                "longitude": -87.6498,
-                "phone": "+13129962724"  # Library phone number
-            }
-        }
+        self.expires_at = 0.0
         
-        # Restaurant locations with actual addresses
-        self.restaurant_locations = {
-            "Chipotle": {
-                "address": "1132 S Clinton St, Chicago, IL 60607",
-                "latitude": 41.8678,  # Approximate coordinates
-                "longitude": -87.6410,
-                "phone": "+13122434300"  # You may want to update with actual phone
-            },
-            "McDonald's": {
-                "address": "2315 W Ogden Ave, Chicago, IL 60608",
-                "latitude": 41.8630,  # Approximate coordinates
-                "longitude": -87.6861,
-                "phone": "+17734550650"  # You may want to update with actual phone
-            },
-            "Chick-fil-A": {
-                "address": "1106 S Clinton St, Chicago, IL 60607",
-                "latitude": 41.8679,  # Approximate coordinates
-                "longitude": -87.6410,
-                "phone": "+13124619110"  # You may want to update with actual phone
-            },
-            "Portillo's": {
-                "address": "520 W Taylor St, Chicago, IL 60607",
-                "latitude": 41.8697,  # Approximate coordinates
-                "longitude": -87.6407,
-                "phone": "+13128772300"  # You may want to update with actual phone
-            },
-            "Starbucks": {
-                "address": "1430 W Taylor St, Chicago, IL 60607",
-                "latitude": 41.8692,  # Approximate coordinates
-                "longitude": -87.6629,
-                "phone": "+13122267773"  # You may want to update with actual phone
-            }
-        }
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._stop = threading.Event()
+        
+        # Token requests are safe to repeat, so also retry gateway errors
+        self.session = requests.Session()
+        self.session.mount(self.auth_url, HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=2,
+            max_retries=Retry(
+                total=max_retries,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset(['POST']),
+                backoff_factor=0.3,
+                raise_on_status=False
+            )
+        ))
+        
+        self._load_cache()
     
-    def get_access_token(self) -> str:
-        """
-        Get OAuth token from Uber Direct API
+    def _is_valid(self, now: float) -> bool:
+        # Never hand out a token in its last minute
+        return bool(self.access_token) and now < self.expires_at - 60
+    
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
         
-        Returns:
-            str: Access token
-        """
-        # Check if token is still valid
-        current_time = time.time()
-        if self.access_token and self.token_expiry and current_time < self.token_expiry:
-            logger.info("Using existing access token")
-            return self.access_token
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            if cached.get('client_id') == self.client_id and cached.get('expires_at', 0) > self.expires_at:
+                self.access_token = cached['access_token']
+                self.expires_at = cached['expires_at']
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable token cache {self.cache_path}: {e}")
+    
+    def _save_cache(self):
+        if not self.cache_path:
+            return
         
         try:
-            url = 'https://auth.uber.com/oauth/v2/token'
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'client_id': self.client_id,
+                    'access_token': self.access_token,
+                    'expires_at': self.expires_at
+                }, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning(f"Could not write token cache {self.cache_path}: {e}")
+    
+    def _fetch(self) -> str:
+        """Request a new token; caller must hold the lock"""
+        try:
             headers = {
                 'Content-Type': 'application/x-www-form-urlencoded'
             }
@@ -93,16 +209,17 @@ class UberDirectDelivery:
                 'client_id': self.client_id,
                 'client_secret': self.client_secret,
                 'grant_type': 'client_credentials',
-                'scope': 'eats.deliveries'
+                'scope': self.scope
             }
             
-            response = requests.post(url, headers=headers, data=payload)
+            requested_at = time.time()
+            response = self.session.post(self.auth_url, headers=headers, data=payload, timeout=self.timeout)
             response.raise_for_status()
             
             token_data = response.json()
             self.access_token = token_data['access_token']
-            # Set expiry to 10 minutes before actual expiry to be safe
-            self.token_expiry = current_time + token_data.get('expires_in', 3600) - 600
+            self.expires_at = requested_at + token_data.get('expires_in', 3600)
+            self._save_cache()
             
             logger.info("Access token obtained successfully")
             return self.access_token
@@ -113,6 +230,488 @@ class UberDirectDelivery:
                 logger.error(f"Response: {e.response.text}")
             raise
     
+    def get_token(self) -> str:
+        """
+        Get a valid access token, fetching one only if none is cached
+        
+        Returns:
+            str: Access token
+        """
+        now = time.time()
+        if self._is_valid(now):
+            return self.access_token
+        
+        with self._lock:
+            # Another thread, or another process via the cache file, may have
+            # refreshed while we waited for the lock
+            if not self._is_valid(now):
+                self._load_cache()
+            if self._is_valid(now):
+                return self.access_token
+            return self._fetch()
+    
+    def cached_token(self) -> Optional[str]:
+        """Return the current token without blocking, or None if it needs a fetch"""
+        return self.access_token if self._is_valid(time.time()) else None
+    
+    def invalidate(self):
+        """Forget the cached token, e.g. after a 401"""
+        with self._lock:
+            self.access_token = None
+            self.expires_at = 0.0
+    
+    def _refresh_loop(self):
+        failures = 0
+        auth_failures = 0
+        while not self._stop.is_set():
+            wait = self.expires_at - self.refresh_ahead - time.time() if self.access_token else 0
+            if wait > 0 and self._stop.wait(wait):
+                return
+            
+            try:
+                with self._lock:
+                    self._load_cache()
+                    # Skip the request if another process already refreshed
+                    if not self.access_token or self.expires_at - self.refresh_ahead <= time.time():
+                        self._fetch()
+                failures = 0
+                auth_failures = 0
+            except Exception as e:
+                failures += 1
+                response = getattr(e, 'response', None)
+                if response is not None and response.status_code in (400, 401, 403):
+                    auth_failures += 1
+                    if auth_failures >= self.max_auth_failures:
+                        logger.error(
+                            f"Uber rejected the credentials {auth_failures} times in a row; "
+                            f"stopping background token refresh: {e}"
+                        )
+                        return
+                
+                delay = min(self.refresh_backoff * 2 ** (failures - 1), self.refresh_backoff_cap)
+                logger.error(f"Background token refresh failed, retrying in {delay:.0f}s: {e}")
+                if self._stop.wait(delay):
+                    return
+    
+    def start_background_refresh(self):
+        """Refresh the token shortly before it expires so callers never wait"""
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+        
+        self._stop.clear()
+        self._refresh_thread = threading.Thread(target=self._refresh_loop, name='uber-token-refresh', daemon=True)
+        self._refresh_thread.start()
+    
+    def stop(self):
+        self._stop.set()
+
+
+_token_providers = {}
+_token_providers_lock = threading.Lock()
+
+def get_token_provider(client_id: str, client_secret: str, auth_url: str = UBER_AUTH_URL,
+                       **kwargs) -> UberTokenProvider:
+    """
+    Get the process-wide token provider for a set of credentials
+    
+    Args:
+        client_id: Uber Direct API client ID
+        client_secret: Uber Direct API client secret
+        auth_url: OAuth token endpoint
+        **kwargs: Passed to UberTokenProvider when it is first created
+        
+    Returns:
+        UberTokenProvider: Shared provider
+    """
+    key = (client_id, auth_url)
+    with _token_providers_lock:
+        provider = _token_providers.get(key)
+        if provider is None:
+            provider = UberTokenProvider(client_id, client_secret, auth_url, **kwargs)
+            _token_providers[key] = provider
+        return provider
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        """
+        Thread-safe token bucket rate limiter
+        
+        Args:
+            rate: Tokens added per second
+            burst: Maximum tokens held (requests allowed back to back)
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def reserve(self, tokens: float = 1) -> float:
+        """
+        Take tokens, going into debt if the bucket is short
+        
+        Returns:
+            float: Seconds the caller must wait before using the tokens
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
+    
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Block until tokens are available
+        
+        Returns:
+            float: Seconds spent waiting
+        """
+        # Sleep outside the lock so other callers can queue their reservations
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(client_id: str, rate: float, burst: int) -> TokenBucket:
+    """
+    Get the process-wide rate limiter for an Uber Direct account
+    
+    Args:
+        client_id: Uber Direct API client ID
+        rate: Requests per second allowed
+        burst: Requests allowed back to back
+        
+    Returns:
+        TokenBucket: Shared limiter
+    """
+    key = (client_id, rate, burst)
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = TokenBucket(rate, burst)
+            _rate_limiters[key] = limiter
+        return limiter
+
+
+class QuoteCache:
+    def __init__(self, margin: float = 60.0, default_ttl: float = 300.0, max_entries: int = 256):
+        """
+        Thread-safe cache of delivery quotes keyed by route and delivery window
+        
+        Args:
+            margin: Seconds before a quote's expiry that it stops being served,
+                leaving time to create the delivery
+            default_ttl: Lifetime for quotes without an expires field
+            max_entries: Entries kept before the soonest-expiring is dropped
+        """
+        self.margin = margin
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "consumed": 0}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(restaurant_name: str, destination_name: str,
+                 delivery_windows: Optional[Dict[str, str]] = None) -> tuple:
+        windows = tuple(sorted((k, v) for k, v in (delivery_windows or {}).items() if v))
+        return (restaurant_name, destination_name, windows)
+    
+    def _expires_at(self, quote: Dict[str, Any]) -> float:
+        expires = quote.get('expires')
+        if expires:
+            try:
+                return datetime.fromisoformat(expires.replace('Z', '+00:00')).timestamp()
+            except ValueError:
+                pass
+        return time.time() + self.default_ttl
+    
+    def get(self, key: tuple, take: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Look up an unexpired quote
+        
+        Args:
+            key: Key from make_key
+            take: Remove the quote so no other caller books with it
+            
+        Returns:
+            dict: Quote data, or None on a miss
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            
+            expires_at, quote = entry
+            if time.time() >= expires_at - self.margin:
+                del self.entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            
+            self.stats["hits"] += 1
+            if take:
+                del self.entries[key]
+            return quote
+    
+    def put(self, key: tuple, quote: Dict[str, Any]):
+        with self._lock:
+            if key not in self.entries and len(self.entries) >= self.max_entries:
+                soonest = min(self.entries, key=lambda k: self.entries[k][0])
+                del self.entries[soonest]
+            self.entries[key] = (self._expires_at(quote), quote)
+    
+    def consume(self, quote_id: str):
+        """Drop a quote once a delivery has been booked with it"""
+        with self._lock:
+            for key, (_, quote) in list(self.entries.items()):
+                if quote.get('id') == quote_id:
+                    del self.entries[key]
+                    self.stats["consumed"] += 1
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self.entries),
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else None
+            }
+
+
+class UberDirectBase:
+    def __init__(self, client_id: str, client_secret: str, customer_id: str, test_mode: bool = True,
+                 auth_url: str = UBER_AUTH_URL, api_base_url: str = UBER_API_BASE_URL,
+                 connect_timeout: float = 3.05, read_timeout: float = 15.0, max_retries: int = 3,
+                 token_provider: Optional[UberTokenProvider] = None,
+                 token_cache_path: Optional[str] = None, proactive_token_refresh: bool = False,
+                 rate_limit: float = 5.0, rate_burst: int = 10, max_concurrency: int = 5,
+                 quote_cache: Optional[QuoteCache] = None, delivery_retries: int = 4,
+                 backoff_base: float = 0.5, backoff_cap: float = 8.0, max_retry_after: float = 60.0,
+                 multi_pickup: bool = False, consolidation_radius_m: float = 150.0,
+                 locations_path: Optional[str] = None):
+        """
+        Locations, payload building and shared token/rate limit state used by
+        both the blocking and the asyncio Uber Direct clients
+        
+        Args:
+            client_id: Uber Direct API client ID
+            client_secret: Uber Direct API client secret
+            customer_id: Uber Direct customer ID
+            test_mode: Whether to use test mode with robo couriers
+            auth_url: OAuth token endpoint
+            api_base_url: Base URL of the Uber Direct API
+            connect_timeout: Seconds to wait for a connection
+            read_timeout: Seconds to wait for a response
+            max_retries: Retries for connection failures
+            token_provider: Token cache to use (defaults to the shared one
+                for these credentials)
+            token_cache_path: Optional file the shared token is persisted to
+            proactive_token_refresh: Refresh the token in the background
+                before it expires (one thread per set of credentials)
+            rate_limit: Quote/delivery requests per second across every
+                client using these credentials
+            rate_burst: Requests allowed back to back before rate_limit applies
+            max_concurrency: Restaurants processed in parallel by process_batch
+            quote_cache: Cache for quotes (a fresh one by default)
+            delivery_retries: Retries for quotes and deliveries on transient errors
+            backoff_base: First retry backoff ceiling in seconds
+            backoff_cap: Largest backoff ceiling in seconds
+            max_retry_after: Longest Retry-After we are willing to honour
+            multi_pickup: Book one courier for restaurants within
+                consolidation_radius_m of each other
+            consolidation_radius_m: Distance in metres under which restaurants
+                share a courier
+            locations_path: JSON file of buildings, residence halls and
+                restaurants (defaults to data/delivery_locations.json)
+        """
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.customer_id = customer_id
+        self.test_mode = test_mode
+        self.auth_url = auth_url
+        self.api_base_url = api_base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        
+        # Tokens are shared by every client with the same credentials, so a
+        # new client per batch no longer costs an OAuth round trip
+        self.token_provider = token_provider or get_token_provider(
+            client_id,
+            client_secret,
+            auth_url,
+            cache_path=token_cache_path,
+            timeout=self.timeout,
+            max_retries=max_retries
+        )
+        if proactive_token_refresh:
+            self.token_provider.start_background_refresh()
+        
+        # Uber rate limits per account, so every client shares one bucket
+        self.rate_limiter = get_rate_limiter(client_id, rate_limit, rate_burst)
+        self.max_concurrency = max_concurrency
+        
+        # Quotes for the same route and window are valid for ~15 minutes, so
+        # fee estimates and the next batch can reuse them
+        self.quote_cache = quote_cache or QuoteCache()
+        
+        self.delivery_retries = delivery_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_retry_after = max_retry_after
+        
+        self.multi_pickup = multi_pickup
+        self.consolidation_radius_km = consolidation_radius_m / 1000.0
+        
+        self._load_places(locations_path)
+    
+    @classmethod
+    def planner(cls, consolidation_radius_m: float = 150.0, locations_path: Optional[str] = None):
+        """
+        Instance for routing and consolidation only
+        
+        Skips __init__, so no token provider or rate limiter is registered
+        and nothing is left running; the instance cannot call the API.
+        
+        Args:
+            consolidation_radius_m: Default radius for simulate_consolidation
+            locations_path: JSON file of buildings, residence halls and restaurants
+        """
+        planner = cls.__new__(cls)
+        planner.multi_pickup = False
+        planner.consolidation_radius_km = consolidation_radius_m / 1000.0
+        planner._load_places(locations_path)
+        return planner
+    
+    def _load_places(self, locations_path: Optional[str]):
+        """Campus drop-off points, residence halls and restaurants"""
+        locations = load_locations(locations_path)
+        self.campus_buildings = locations["campus_buildings"]
+        
+        # Residence halls that aren't drop-off points; orders from them go to
+        # the nearest building above
+        self.campus_places = locations.get("campus_places", {})
+        self.restaurant_locations = locations["restaurant_locations"]
+        
+        self._build_place_index()
+        self._build_payload_blocks()
+    
+    def _build_place_index(self):
+        """Index every building and residence name/alias for lookup by free text"""
+        self._place_aliases = []
+        for places in (self.campus_buildings, self.campus_places):
+            for name, place in places.items():
+                for alias in [name] + place.get("aliases", []):
+                    self._place_aliases.append((normalize_place(alias), name, place))
+        
+        # Longest first so "student center west" wins over "student center"
+        self._place_aliases.sort(key=lambda entry: len(entry[0]), reverse=True)
+        self._dropoff_cache = {}
+        self._dropoff_lock = threading.Lock()
+    
+    def _build_payload_blocks(self):
+        """
+        Pre-render the request fields for every restaurant and building
+        
+        Locations don't change after construction, so the address JSON,
+        coordinates and contact fields are built once here and merged into
+        each quote and delivery payload.
+        """
+        self._pickup_route = {}
+        self._pickup_contact = {}
+        self._pickup_labels = {}
+        self._external_id_prefix = {}
+        for name, restaurant in self.restaurant_locations.items():
+            self._pickup_route[name] = {
+                "pickup_address": self.format_address(restaurant["address"]),
+                "pickup_latitude": restaurant["latitude"],
+                "pickup_longitude": restaurant["longitude"]
+            }
+            self._pickup_contact[name] = {
+                "pickup_name": name,
+                "pickup_phone_number": restaurant["phone"]
+            }
+            self._pickup_labels[name] = f"{name} ({restaurant['address']})"
+            self._external_id_prefix[name] = name.replace(' ', '-').lower()
+        
+        self._dropoff_route = {}
+        self._dropoff_contact = {}
+        for name, building in self.campus_buildings.items():
+            self._dropoff_route[name] = {
+                "dropoff_address": self.format_address(building["address"]),
+                "dropoff_latitude": building["latitude"],
+                "dropoff_longitude": building["longitude"]
+            }
+            self._dropoff_contact[name] = {
+                "dropoff_name": name,
+                "dropoff_phone_number": building["phone"]
+            }
+    
+    def resolve_place(self, text: Optional[str]) -> Optional[Dict[str, Any]]:
+        """
+        Match a customer's free-text building (e.g. "JST room 1204") to a known place
+        
+        Returns:
+            dict: The matching building or residence, or None
+        """
+        normalized = f" {normalize_place(text)} "
+        for alias, _, place in self._place_aliases:
+            if f" {alias} " in normalized:
+                return place
+        return None
+    
+    def nearest_dropoff(self, latitude: float, longitude: float) -> str:
+        """Name of the drop-off building closest to a point"""
+        return min(
+            self.campus_buildings,
+            key=lambda name: haversine_km(
+                latitude, longitude,
+                self.campus_buildings[name]["latitude"], self.campus_buildings[name]["longitude"]
+            )
+        )
+    
+    def dropoff_for(self, dorm_building: Optional[str]) -> str:
+        """
+        Pick the drop-off building for a customer's stated location
+        
+        Returns:
+            str: Key into campus_buildings (the Library if the location is unknown)
+        """
+        key = normalize_place(dorm_building)
+        dropoff = self._dropoff_cache.get(key)
+        if dropoff is None:
+            place = self.resolve_place(dorm_building)
+            dropoff = self.nearest_dropoff(place["latitude"], place["longitude"]) if place else DEFAULT_DROPOFF
+            with self._dropoff_lock:
+                if len(self._dropoff_cache) >= DROPOFF_CACHE_SIZE:
+                    # Dicts keep insertion order, so this is the oldest entry
+                    self._dropoff_cache.pop(next(iter(self._dropoff_cache)))
+                self._dropoff_cache[key] = dropoff
+        return dropoff
+    
+    def route_orders(self, orders: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+        """Group one restaurant's orders by the drop-off nearest each customer"""
+        routes = {}
+        for order in orders:
+            routes.setdefault(self.dropoff_for(order.get("dorm_building")), []).append(order)
+        return routes
+    
+    def get_access_token(self) -> str:
+        """
+        Get OAuth token from Uber Direct API
+        
+        Returns:
+            str: Access token
+        """
+        return self.token_provider.get_token()
+    
     def format_address(self, address: str) -> str:
         """
         Format address for Uber Direct API
@@ -179,9 +778,44 @@ class UberDirectDelivery:
             "dropoff_deadline_dt": dropoff_deadline.isoformat() + "Z"
         }
     
-    def create_quote(self, restaurant_name: str, destination_name: str, delivery_windows: Dict[str, str] = None) -> Dict[str, Any]:
+    def make_idempotency_key(self, batch_id: Any, restaurant_name: str, destination_name: str,
+                             orders: Optional[List[Dict[str, Any]]] = None) -> str:
         """
-        Create a delivery quote for a restaurant to a destination
+        Deterministic key for one batch's delivery from a restaurant
+        
+        Retries and re-runs of the same batch send the same key, so Uber
+        returns the original delivery instead of booking a second courier.
+        Without a batch id the key is derived from the orders themselves
+        (their order ids, or their full contents if they have none).
+        """
+        def slug(value):
+            return re.sub(r'[^a-z0-9]+', '-', str(value).lower()).strip('-')
+        
+        if batch_id is None:
+            order_refs = sorted(
+                json.dumps(order.get("order_id") or order, sort_keys=True, default=str)
+                for order in orders or []
+            )
+            digest = hashlib.sha1("|".join(order_refs).encode()).hexdigest()[:16]
+            return f"treehouse-orders-{digest}-{slug(restaurant_name)}-{slug(destination_name)}"
+        
+        return f"treehouse-batch-{batch_id}-{slug(restaurant_name)}-{slug(destination_name)}"
+    
+    def backoff_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Seconds to wait before retry number attempt + 1
+        
+        Uses the server's Retry-After when given, otherwise exponential
+        backoff with full jitter so parallel workers don't retry in lockstep.
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+    
+    def build_quote_payload(self, restaurant_name: str, destination_name: str,
+                            delivery_windows: Dict[str, str] = None) -> Dict[str, Any]:
+        """
+        Build the delivery_quotes request body
         
         Args:
             restaurant_name: Name of the restaurant
@@ -189,69 +823,32 @@ class UberDirectDelivery:
             delivery_windows: Optional dictionary with delivery window timestamps
             
         Returns:
-            dict: Quote data
+            dict: Request payload
         """
-        token = self.get_access_token()
+        pickup = self._pickup_route.get(restaurant_name)
+        dropoff = self._dropoff_route.get(destination_name)
         
-        try:
-            url = f"https://api.uber.com/v1/customers/{self.customer_id}/delivery_quotes"
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {token}'
-            }
-            
-            restaurant = self.restaurant_locations.get(restaurant_name)
-            destination = self.campus_buildings.get(destination_name)
-            
-            if not restaurant:
-                raise ValueError(f"Restaurant '{restaurant_name}' not found")
-            if not destination:
-                raise ValueError(f"Destination '{destination_name}' not found")
-            
-            payload = {
-                "pickup_address": self.format_address(restaurant["address"]),
-                "dropoff_address": self.format_address(destination["address"]),
-                "pickup_latitude": restaurant["latitude"],
-                "pickup_longitude": restaurant["longitude"],
-                "dropoff_latitude": destination["latitude"],
-                "dropoff_longitude": destination["longitude"]
-            }
-            
-            # Add delivery windows if provided
-            if delivery_windows:
-                for key, value in delivery_windows.items():
-                    if value:
-                        payload[key] = value
-            
-            response = requests.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            quote_data = response.json()
-            
-            # Display quote info
-            logger.info(f"Quote created for {restaurant_name} to {destination_name}:")
-            logger.info(f"Quote ID: {quote_data['id']}")
-            logger.info(f"Price: ${quote_data['fee']/100:.2f} {quote_data['currency']}")
-            
-            if 'pickup_duration' in quote_data:
-                logger.info(f"Estimated pickup time: {quote_data['pickup_duration']} minutes")
-            
-            if 'dropoff_eta' in quote_data:
-                dropoff_time = datetime.fromisoformat(quote_data['dropoff_eta'].replace('Z', '+00:00'))
-                logger.info(f"Estimated dropoff time: {dropoff_time.strftime('%I:%M:%S %p')}")
-            
-            return quote_data
+        if not pickup:
+            raise ValueError(f"Restaurant '{restaurant_name}' not found")
+        if not dropoff:
+            raise ValueError(f"Destination '{destination_name}' not found")
         
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error creating quote for {restaurant_name}: {e}")
-            if hasattr(e, 'response') and e.response:
-                logger.error(f"Response: {e.response.text}")
-            raise
+        payload = {**pickup, **dropoff}
+        
+        # Add delivery windows if provided
+        if delivery_windows:
+            for key, value in delivery_windows.items():
+                if value:
+                    payload[key] = value
+        
+        return payload
     
-    def create_delivery(self, restaurant_name: str, destination_name: str, 
-                        orders: List[Dict[str, Any]], quote: Dict[str, Any],
-                        delivery_windows: Dict[str, str] = None) -> Dict[str, Any]:
+    def build_delivery_payload(self, restaurant_name: str, destination_name: str,
+                               orders: List[Dict[str, Any]], quote: Dict[str, Any],
+                               delivery_windows: Dict[str, str] = None,
+                               idempotency_key: Optional[str] = None) -> Dict[str, Any]:
         """
-        Create a delivery for a restaurant with consolidated orders
+        Build the deliveries request body with orders consolidated into a manifest
         
         Args:
             restaurant_name: Name of the restaurant
@@ -259,113 +856,124 @@ class UberDirectDelivery:
             orders: List of orders with customer name and items
             quote: Quote data from create_quote
             delivery_windows: Optional dictionary with delivery window timestamps
+            idempotency_key: Key from make_idempotency_key, also used as external_id
             
         Returns:
-            dict: Delivery data
+            dict: Request payload
         """
-        token = self.get_access_token()
+        if restaurant_name not in self._pickup_route:
+            raise ValueError(f"Restaurant '{restaurant_name}' not found")
+        if destination_name not in self._dropoff_route:
+            raise ValueError(f"Destination '{destination_name}' not found")
         
-        try:
-            restaurant = self.restaurant_locations.get(restaurant_name)
-            destination = self.campus_buildings.get(destination_name)
-            
-            if not restaurant:
-                raise ValueError(f"Restaurant '{restaurant_name}' not found")
-            if not destination:
-                raise ValueError(f"Destination '{destination_name}' not found")
-            
-            # Consolidate orders into a manifest
-            manifest_items = []
-            
-            for order in orders:
-                customer_name = order.get("customer_name", "Unknown")
-                order_number = order.get("order_number", "")
-                
-                # Create item identifier based on order number and customer name
-                item_identifier = f"#{order_number} " if order_number else ""
-                item_identifier += f"for {customer_name}"
-                
-                # Add the order as a single manifest item
-                manifest_items.append({
-                    "name": f"Order {item_identifier}",
-                    "quantity": 1,
-                    "weight": 500,  # Approximate weight in grams
-                    "dimensions": {
-                        "length": 25,
-                        "height": 15,
-                        "depth": 20
-                    }
-                })
-            
-            url = f"https://api.uber.com/v1/customers/{self.customer_id}/deliveries"
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {token}'
-            }
+        # Restaurants next door whose orders ride with this courier
+        extra_pickups = sorted({
+            order["restaurant"] for order in orders
+            if order.get("restaurant") and order["restaurant"] != restaurant_name
+        })
+        
+        # Consolidate orders into a manifest
+        manifest_items = []
+        
+        for order in orders:
+            customer_name = order.get("customer_name", "Unknown")
+            order_number = order.get("order_number", "")
             
-            payload = {
-                "quote_id": quote["id"],
-                "pickup_address": self.format_address(restaurant["address"]),
-                "pickup_name": restaurant_name,
-                "pickup_phone_number": restaurant["phone"],
-                "pickup_latitude": restaurant["latitude"],
-                "pickup_longitude": restaurant["longitude"],
-                "dropoff_address": self.format_address(destination["address"]),
-                "dropoff_name": destination_name,
-                "dropoff_phone_number": destination["phone"],
-                "dropoff_latitude": destination["latitude"],
-                "dropoff_longitude": destination["longitude"],
-                "manifest_items": manifest_items,
-                "external_id": f"{restaurant_name.replace(' ', '-').lower()}-batch-{datetime.now().strftime('%Y%m%d%H%M')}",
-            }
+            # Create item identifier based on order number and customer name
+            item_identifier = f"#{order_number} " if order_number else ""
+            item_identifier += f"for {customer_name}"
+            if extra_pickups:
+                item_identifier += f" ({order.get('restaurant', restaurant_name)})"
             
-            # Add delivery windows if provided
-            if delivery_windows:
-                for key, value in delivery_windows.items():
-                    if value:
-                        payload[key] = value
-            
-            # Add Robo Courier for testing if in test mode
-            if self.test_mode:
-                payload["test_specifications"] = {
-                    "robo_courier_specification": {
-                        "mode": "auto"
-                    }
+            # Add the order as a single manifest item
+            manifest_items.append({
+                "name": f"Order {item_identifier}",
+                "quantity": 1,
+                "weight": 500,  # Approximate weight in grams
+                "dimensions": MANIFEST_DIMENSIONS
+            })
+        
+        payload = {
+            "quote_id": quote["id"],
+            **self._pickup_route[restaurant_name],
+            **self._pickup_contact[restaurant_name],
+            **self._dropoff_route[destination_name],
+            **self._dropoff_contact[destination_name],
+            "manifest_items": manifest_items
+        }
+        
+        if idempotency_key:
+            payload["external_id"] = idempotency_key
+            payload["idempotency_key"] = idempotency_key
+        else:
+            payload["external_id"] = f"{self._external_id_prefix[restaurant_name]}-batch-{datetime.now().strftime('%Y%m%d%H%M')}"
+        
+        if extra_pickups:
+            payload["pickup_notes"] = "Also collect orders from: " + "; ".join(
+                self._pickup_labels[name] for name in extra_pickups
+            )
+        
+        # Add delivery windows if provided
+        if delivery_windows:
+            for key, value in delivery_windows.items():
+                if value:
+                    payload[key] = value
+        
+        # Add Robo Courier for testing if in test mode
+        if self.test_mode:
+            payload["test_specifications"] = {
+                "robo_courier_specification": {
+                    "mode": "auto"
                 }
-            
-            response = requests.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            delivery_data = response.json()
-            
-            # Display delivery info
-            logger.info(f"Delivery created with ID: {delivery_data['id']}")
-            logger.info(f"Status: {delivery_data['status']}")
-            
-            if 'tracking_url' in delivery_data:
-                logger.info(f"Tracking URL: {delivery_data['tracking_url']}")
-            
-            return delivery_data
+            }
         
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error creating delivery for {restaurant_name}: {e}")
-            if hasattr(e, 'response') and e.response:
-                logger.error(f"Response: {e.response.text}")
-            raise
+        return payload
     
-    def process_batch(self, batch_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    def summarize_quote(self, quote: Dict[str, Any], cached: bool) -> Dict[str, Any]:
+        return {
+            "quote_id": quote.get("id"),
+            "fee": quote.get("fee"),
+            "currency": quote.get("currency"),
+            "dropoff_eta": quote.get("dropoff_eta"),
+            "duration": quote.get("duration"),
+            "expires": quote.get("expires"),
+            "cached": cached
+        }
+    
+    def log_quote(self, restaurant_name: str, destination_name: str, quote_data: Dict[str, Any]):
+        # Display quote info
+        logger.info(f"Quote created for {restaurant_name} to {destination_name}:")
+        logger.info(f"Quote ID: {quote_data['id']}")
+        logger.info(f"Price: ${quote_data['fee']/100:.2f} {quote_data['currency']}")
+        
+        if 'pickup_duration' in quote_data:
+            logger.info(f"Estimated pickup time: {quote_data['pickup_duration']} minutes")
+        
+        if 'dropoff_eta' in quote_data:
+            dropoff_time = datetime.fromisoformat(quote_data['dropoff_eta'].replace('Z', '+00:00'))
+            logger.info(f"Estimated dropoff time: {dropoff_time.strftime('%I:%M:%S %p')}")
+    
+    def log_delivery(self, delivery_data: Dict[str, Any]):
+        # Display delivery info
+        logger.info(f"Delivery created with ID: {delivery_data['id']}")
+        logger.info(f"Status: {delivery_data['status']}")
+        
+        if 'tracking_url' in delivery_data:
+            logger.info(f"Tracking URL: {delivery_data['tracking_url']}")
+    
+    def plan_batch(self, batch_data: Dict[str, Any]):
         """
-        Process a batch of orders grouped by restaurant
+        Work out the delivery windows and the deliveries to book
+        
+        Each restaurant's orders are split by the drop-off nearest each
+        customer, giving one delivery per (restaurant, drop-off) pair.
         
         Args:
             batch_data: Dictionary with campus location and orders by restaurant
             
         Returns:
-            dict: Dictionary of delivery data by restaurant
+            tuple: (delivery_windows, [(restaurant, destination, orders), ...])
         """
-        deliveries = {}
-        
-        # Always use the Library as the destination
-        destination_name = "Library"
         restaurants_orders = batch_data.get("restaurants", {})
         
         # Get batch time for delivery windows
@@ -381,33 +989,406 @@ class UberDirectDelivery:
             delivery_windows = self.get_delivery_windows(batch_time)
             logger.info(f"Using delivery windows: {delivery_windows}")
         
+        jobs = []
         for restaurant_name, orders in restaurants_orders.items():
             if not orders:
                 logger.info(f"Skipping {restaurant_name} - no orders")
                 continue
-                
-            logger.info(f"\n========= Processing {restaurant_name} =========")
-            logger.info(f"Consolidating {len(orders)} orders for delivery to {destination_name}")
+            for destination_name, routed in self.route_orders(orders).items():
+                jobs.append((restaurant_name, destination_name, routed))
+        
+        # Only where the account supports a courier collecting from several
+        # restaurants on one delivery
+        if self.multi_pickup:
+            jobs = self.consolidate_jobs(jobs, self.consolidation_radius_km)
+        
+        return delivery_windows, jobs
+    
+    def cluster_restaurants(self, names: List[str], radius_km: float) -> List[List[str]]:
+        """
+        Group restaurants that are within radius_km of each other (single linkage)
+        
+        Returns:
+            list: Clusters of restaurant names; unknown restaurants stay alone
+        """
+        parent = {name: name for name in names}
+        
+        def find(name):
+            while parent[name] != name:
+                parent[name] = parent[parent[name]]
+                name = parent[name]
+            return name
+        
+        located = [name for name in names if name in self.restaurant_locations]
+        for i, first in enumerate(located):
+            a = self.restaurant_locations[first]
+            for second in located[i + 1:]:
+                b = self.restaurant_locations[second]
+                if haversine_km(a["latitude"], a["longitude"], b["latitude"], b["longitude"]) <= radius_km:
+                    parent[find(second)] = find(first)
+        
+        clusters = {}
+        for name in names:
+            clusters.setdefault(find(name), []).append(name)
+        return list(clusters.values())
+    
+    def consolidate_jobs(self, jobs: List[tuple], radius_km: float) -> List[tuple]:
+        """
+        Merge deliveries to the same drop-off from co-located restaurants
+        
+        The restaurant with the most orders becomes the pickup; every order
+        keeps its own 'restaurant' so the manifest and notes name each stop.
+        
+        Args:
+            jobs: (restaurant, destination, orders) tuples from plan_batch
+            radius_km: Distance under which restaurants share a courier
+            
+        Returns:
+            list: (pickup restaurant, destination, orders) tuples
+        """
+        by_destination = {}
+        for restaurant_name, destination_name, orders in jobs:
+            by_destination.setdefault(destination_name, {})[restaurant_name] = orders
+        
+        consolidated = []
+        for destination_name, by_restaurant in by_destination.items():
+            for cluster in self.cluster_restaurants(list(by_restaurant), radius_km):
+                anchor = max(cluster, key=lambda name: len(by_restaurant[name]))
+                orders = [
+                    {**order, "restaurant": order.get("restaurant", name)}
+                    for name in cluster for order in by_restaurant[name]
+                ]
+                consolidated.append((anchor, destination_name, orders))
+        
+        return consolidated
+    
+    def simulate_consolidation(self, batches: List[Dict[str, Any]], radius_km: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Count couriers and quote calls consolidation would have saved, without calling the API
+        
+        Args:
+            batches: Batch data as returned by prepare_batch_for_delivery
+            radius_km: Distance to test (defaults to the configured radius)
+            
+        Returns:
+            dict: Totals and how often each restaurant group was merged
+        """
+        radius_km = self.consolidation_radius_km if radius_km is None else radius_km
+        separate = 0
+        consolidated = 0
+        merged_groups = {}
+        
+        for batch_data in batches:
+            jobs = [
+                (restaurant_name, destination_name, routed)
+                for restaurant_name, orders in batch_data.get("restaurants", {}).items() if orders
+                for destination_name, routed in self.route_orders(orders).items()
+            ]
+            merged = self.consolidate_jobs(jobs, radius_km)
+            separate += len(jobs)
+            consolidated += len(merged)
+            
+            for _, _, orders in merged:
+                group = sorted({order["restaurant"] for order in orders})
+                if len(group) > 1:
+                    label = " + ".join(group)
+                    merged_groups[label] = merged_groups.get(label, 0) + 1
+        
+        return {
+            "radius_m": round(radius_km * 1000, 1),
+            "batches": len(batches),
+            "couriers_separate": separate,
+            "couriers_consolidated": consolidated,
+            "couriers_saved": separate - consolidated,
+            # One quote per delivery, so quote calls drop by the same amount
+            "quote_calls_saved": separate - consolidated,
+            "saved_pct": round(100.0 * (separate - consolidated) / separate, 1) if separate else 0.0,
+            "merged_groups": dict(sorted(merged_groups.items(), key=lambda item: -item[1]))
+        }
+    
+    @staticmethod
+    def delivery_key(restaurant_name: str, destination_name: str) -> str:
+        """Key for a delivery in process_batch results"""
+        return f"{restaurant_name} @ {destination_name}"
+
+
+class UberDirectDelivery(UberDirectBase):
+    def __init__(self, client_id: str, client_secret: str, customer_id: str, test_mode: bool = True,
+                 pool_size: int = 10, **kwargs):
+        """
+        Initialize Uber Direct delivery service
+        
+        Args:
+            client_id: Uber Direct API client ID
+            client_secret: Uber Direct API client secret
+            customer_id: Uber Direct customer ID
+            test_mode: Whether to use test mode with robo couriers
+            pool_size: Keep-alive connections kept per host
+            **kwargs: Connection, token and rate limit options for UberDirectBase
+        """
+        super().__init__(client_id, client_secret, customer_id, test_mode, **kwargs)
+        
+        # One pooled session per client so quotes and deliveries reuse the
+        # same TLS connections instead of a new handshake per request
+        self.session = self._build_session(pool_size, self.max_retries)
+    
+    def _build_session(self, pool_size: int, max_retries: int) -> requests.Session:
+        """
+        Create the keep-alive session used for quote and delivery calls
+        
+        Args:
+            pool_size: Connections kept per host
+            max_retries: Retry budget for the transport adapters
+            
+        Returns:
+            requests.Session: Configured session
+        """
+        session = requests.Session()
+        
+        # Creating a delivery is not idempotent, so only retry failures where
+        # the request never reached the server
+        api_retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=0,
+            other=0,
+            allowed_methods=None,
+            backoff_factor=0.3,
+            raise_on_status=False
+        )
+        
+        session.mount(
+            self.api_base_url,
+            HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=api_retry)
+        )
+        
+        return session
+    
+    def _post(self, url: str, **kwargs) -> requests.Response:
+        """POST through the pooled session with the configured timeouts"""
+        kwargs.setdefault('timeout', self.timeout)
+        
+        waited = self.rate_limiter.acquire()
+        if waited:
+            logger.info(f"Rate limited, waited {waited:.2f}s")
+        
+        response = self.session.post(url, **kwargs)
+        
+        # A revoked token should be replaced on the next call, not reused
+        # until its advertised expiry
+        if response.status_code == 401:
+            self.token_provider.invalidate()
+        
+        return response
+    
+    def _post_json(self, url: str, payload: Dict[str, Any], action: str,
+                   idempotent: bool = True) -> Dict[str, Any]:
+        """
+        POST a JSON body, retrying connection errors, timeouts, 429 and 5xx
+        
+        Args:
+            url: Endpoint to call
+            payload: JSON request body
+            action: What is being created, for log messages
+            idempotent: False if repeating the request could create a second
+                object; then only 429s, which the server rejected, are retried
+            
+        Returns:
+            dict: Decoded response body
+        """
+        for attempt in range(self.delivery_retries + 1):
+            retries_left = attempt < self.delivery_retries
+            unsafe_retries_left = retries_left and idempotent
             
             try:
-                # Create quote
-                quote = self.create_quote(restaurant_name, destination_name, delivery_windows)
+                # Fetched per attempt in case a 401 invalidated the token
+                headers = {
+                    'Content-Type': 'application/json',
+                    'Authorization': f'Bearer {self.get_access_token()}'
+                }
                 
-                # Create delivery with the quote
-                delivery = self.create_delivery(restaurant_name, destination_name, orders, quote, delivery_windows)
+                response = self._post(url, headers=headers, json=payload)
                 
-                # Store the delivery data
-                deliveries[restaurant_name] = {
-                    "quote": quote,
-                    "delivery": delivery,
-                    "orders": orders,
-                    "destination": destination_name
-                }
+                if response.status_code in RETRYABLE_STATUSES and (
+                    unsafe_retries_left or (retries_left and response.status_code == 429)
+                ):
+                    retry_after = parse_retry_after(response.headers.get('Retry-After')) if response.status_code == 429 else None
+                    delay = self.backoff_delay(attempt, retry_after)
+                    logger.warning(
+                        f"Creating {action} got HTTP {response.status_code}, "
+                        f"retrying in {delay:.2f}s (attempt {attempt + 1}/{self.delivery_retries})"
+                    )
+                    time.sleep(delay)
+                    continue
                 
-                # Wait to avoid rate limits
-                time.sleep(1)
-            except Exception as e:
-                logger.error(f"Error processing {restaurant_name}: {e}")
+                response.raise_for_status()
+                return response.json()
+            
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if not unsafe_retries_left:
+                    logger.error(f"Error creating {action} after {attempt + 1} attempts: {e}")
+                    raise
+                
+                delay = self.backoff_delay(attempt)
+                logger.warning(f"Creating {action} failed ({e}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+            
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Error creating {action}: {e}")
+                if hasattr(e, 'response') and e.response:
+                    logger.error(f"Response: {e.response.text}")
+                raise
+    
+    def close(self):
+        """Close pooled connections"""
+        self.session.close()
+    
+    def create_quote(self, restaurant_name: str, destination_name: str, delivery_windows: Dict[str, str] = None,
+                     use_cache: bool = True) -> Dict[str, Any]:
+        """
+        Create a delivery quote for a restaurant to a destination
+        
+        Args:
+            restaurant_name: Name of the restaurant
+            destination_name: Name of the campus building for delivery
+            delivery_windows: Optional dictionary with delivery window timestamps
+            use_cache: Book with a cached quote for the same route and window if one
+                is still valid
+            
+        Returns:
+            dict: Quote data
+        """
+        cache_key = self.quote_cache.make_key(restaurant_name, destination_name, delivery_windows)
+        if use_cache:
+            # Taken, not peeked, so concurrent batches never book the same quote
+            cached = self.quote_cache.get(cache_key, take=True)
+            if cached:
+                logger.info(f"Reusing quote {cached['id']} for {restaurant_name} to {destination_name}")
+                return cached
+        
+        url = f"{self.api_base_url}/v1/customers/{self.customer_id}/delivery_quotes"
+        payload = self.build_quote_payload(restaurant_name, destination_name, delivery_windows)
+        
+        # Quotes book nothing, so they are always safe to retry
+        quote_data = self._post_json(url, payload, f"quote for {restaurant_name}")
+        
+        self.log_quote(restaurant_name, destination_name, quote_data)
+        return quote_data
+    
+    def create_delivery(self, restaurant_name: str, destination_name: str, 
+                        orders: List[Dict[str, Any]], quote: Dict[str, Any],
+                        delivery_windows: Dict[str, str] = None,
+                        idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Create a delivery for a restaurant with consolidated orders
+        
+        Transient failures are retried with backoff only when an
+        idempotency_key is given, so a retry after a lost response can't book
+        a second courier.
+        
+        Args:
+            restaurant_name: Name of the restaurant
+            destination_name: Name of the campus building for delivery
+            orders: List of orders with customer name and items
+            quote: Quote data from create_quote
+            delivery_windows: Optional dictionary with delivery window timestamps
+            idempotency_key: Key from make_idempotency_key
+            
+        Returns:
+            dict: Delivery data
+        """
+        url = f"{self.api_base_url}/v1/customers/{self.customer_id}/deliveries"
+        payload = self.build_delivery_payload(
+            restaurant_name, destination_name, orders, quote, delivery_windows, idempotency_key
+        )
+        
+        delivery_data = self._post_json(
+            url, payload, f"delivery for {restaurant_name}", idempotent=idempotency_key is not None
+        )
+        
+        # A quote books one delivery; the next batch needs a fresh one
+        self.quote_cache.consume(quote["id"])
+        self.log_delivery(delivery_data)
+        return delivery_data
+    
+    def estimate_fee(self, restaurant_name: str, destination_name: str = "Library",
+                     delivery_windows: Dict[str, str] = None) -> Dict[str, Any]:
+        """
+        Estimate the delivery fee for a route, served from the quote cache when possible
+        
+        Args:
+            restaurant_name: Name of the restaurant
+            destination_name: Name of the campus building for delivery
+            delivery_windows: Optional dictionary with delivery window timestamps
+            
+        Returns:
+            dict: Fee, currency, ETA and whether the quote came from cache
+        """
+        cache_key = self.quote_cache.make_key(restaurant_name, destination_name, delivery_windows)
+        cached = self.quote_cache.get(cache_key)
+        if cached:
+            return self.summarize_quote(cached, True)
+        
+        # Keep the quote so the batch that follows can book with it
+        quote = self.create_quote(restaurant_name, destination_name, delivery_windows, use_cache=False)
+        self.quote_cache.put(cache_key, quote)
+        return self.summarize_quote(quote, False)
+    
+    def process_batch(self, batch_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """
+        Process a batch of orders grouped by restaurant
+        
+        Args:
+            batch_data: Dictionary with campus location and orders by restaurant
+            
+        Returns:
+            dict: Delivery data keyed by delivery_key(restaurant, destination)
+        """
+        deliveries = {}
+        delivery_windows, jobs = self.plan_batch(batch_data)
+        
+        if not jobs:
+            return deliveries
+        
+        batch_id = batch_data.get("batch_id")
+        
+        def process_restaurant(restaurant_name, destination_name, orders):
+            logger.info(f"\n========= Processing {restaurant_name} =========")
+            logger.info(f"Consolidating {len(orders)} orders for delivery to {destination_name}")
+            
+            # Create quote
+            quote = self.create_quote(restaurant_name, destination_name, delivery_windows)
+            
+            # Create delivery with the quote
+            idempotency_key = self.make_idempotency_key(batch_id, restaurant_name, destination_name, orders)
+            delivery = self.create_delivery(
+                restaurant_name, destination_name, orders, quote, delivery_windows, idempotency_key
+            )
+            
+            return {
+                "restaurant": restaurant_name,
+                "restaurants": sorted({order.get("restaurant", restaurant_name) for order in orders}),
+                "quote": quote,
+                "delivery": delivery,
+                "orders": orders,
+                "destination": destination_name
+            }
+        
+        # Deliveries are independent, so run them side by side; the shared
+        # rate limiter replaces the old fixed sleep between restaurants
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(jobs))) as executor:
+            futures = {
+                self.delivery_key(restaurant_name, destination_name):
+                    executor.submit(process_restaurant, restaurant_name, destination_name, orders)
+                for restaurant_name, destination_name, orders in jobs
+            }
+            
+            for key, future in futures.items():
+                try:
+                    deliveries[key] = future.result()
+                except Exception as e:
+                    logger.error(f"Error processing {key}: {e}")
         
         logger.info("\n========= All deliveries have been processed! =========")
         return deliveries
@@ -450,10 +1431,12 @@ def prepare_batch_for_delivery(batch_id: int, database_connection) -> Dict[str,
         JOIN order_items oi ON o.id = oi.order_id
         JOIN menu_items mi ON oi.menu_item_id = mi.id
         JOIN menus m ON mi.menu_id = m.id
-        WHERE bo.batch_id = ?
+        WHERE bo.batch_id = ? AND o.status != 'in_delivery'
         GROUP BY o.id
     """, (batch_id,))
     
+    # Orders booked by an earlier, partly failed attempt are left out so a
+    # retry only books what is still waiting
     orders = cursor.fetchall()
     
     # Organize orders by restaurant
@@ -499,15 +1482,58 @@ def prepare_batch_for_delivery(batch_id: int, database_connection) -> Dict[str,
         
         restaurants[restaurant_name].append({
             "order_id": order_id,
+            "restaurant": restaurant_name,
             "customer_name": customer_name,
+            "dorm_building": order[3],
+            "room_number": order[4],
             "order_number": order_number,
             "items": order_items
         })
     
-    # Always use Library for drop-off
+    # Drop-off buildings are chosen per order by UberDirectBase.plan_batch
     return {
         "batch_id": batch_id,
         "batch_time": batch_time,  # Include batch time for delivery windows
-        "location": "Library",  # Fixed to Library for all batches
+        "location": DEFAULT_DROPOFF,  # Fallback for customers with no known building
         "restaurants": restaurants
     }
+
+
+def load_batch_routes(database_connection, limit: int) -> List[Dict[str, Any]]:
+    """
+    Restaurants and customer buildings of the most recent batches, in one query
+    
+    Only what routing needs (no items or order numbers), for
+    UberDirectBase.simulate_consolidation.
+    
+    Args:
+        database_connection: SQLite database connection
+        limit: Number of batches, newest first
+        
+    Returns:
+        list: Dicts with batch_id and restaurants, like prepare_batch_for_delivery
+    """
+    rows = database_connection.execute("""
+        SELECT b.id, o.id, u.dorm_building, MIN(m.restaurant_name)
+        FROM (SELECT id FROM delivery_batches ORDER BY id DESC LIMIT ?) b
+        LEFT JOIN batch_orders bo ON bo.batch_id = b.id
+        LEFT JOIN orders o ON o.id = bo.order_id
+        LEFT JOIN users u ON u.id = o.user_id
+        LEFT JOIN order_items oi ON oi.order_id = o.id
+        LEFT JOIN menu_items mi ON mi.id = oi.menu_item_id
+        LEFT JOIN menus m ON m.id = mi.menu_id
+        GROUP BY b.id, o.id
+        ORDER BY b.id DESC
+    """, (limit,)).fetchall()
+    
+    batches = {}
+    for batch_id, order_id, dorm_building, restaurant_name in rows:
+        restaurants = batches.setdefault(batch_id, {})
+        if restaurant_name:
+            restaurants.setdefault(restaurant_name, []).append({
+                "order_id": order_id,
+                "restaurant": restaurant_name,
+                "dorm_building": dorm_building
+            })
+    
+    return [{"batch_id": batch_id, "restaurants": restaurants} for batch_id, restaurants in batches.items()]
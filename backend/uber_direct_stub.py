@@ -0,0 +1,294 @@
+import argparse
+import json
+import math
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+import logging
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+QUOTES_PATH = re.compile(r'^/v1/customers/([^/]+)/delivery_quotes$')
+DELIVERIES_PATH = re.compile(r'^/v1/customers/([^/]+)/deliveries$')
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real API
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without TCP_NODELAY the
+    # client's delayed ACK adds ~40ms to every keep-alive response
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.stub.count('connections')
+
+    def log_message(self, format, *args):
+        # Silence the default per-request stderr logging
+        pass
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _route(self) -> str:
+        if self.path == '/oauth/v2/token':
+            return 'token'
+        if QUOTES_PATH.match(self.path):
+            return 'quotes'
+        if DELIVERIES_PATH.match(self.path):
+            return 'deliveries'
+        return 'other'
+
+    def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self._read_body()
+        stub.count('requests')
+
+        delay = stub.response_delay()
+        if delay:
+            time.sleep(delay)
+
+        route = self._route()
+
+        retry_after = stub.check_rate_limit() if route in ('quotes', 'deliveries') else None
+        if retry_after is not None:
+            stub.count('rate_limited')
+            self._send_json(429, {"code": "rate_limit_exceeded", "message": "Too many requests"},
+                            {'Retry-After': str(retry_after)})
+            return
+
+        fault = stub.next_fault(route)
+        if not fault and route in ('quotes', 'deliveries') and stub.error_rate and random.random() < stub.error_rate:
+            fault = {"status": random.choice((500, 503))}
+        if fault and fault.get('status'):
+            stub.count('faults')
+            headers = {'Retry-After': str(fault['retry_after'])} if fault.get('retry_after') is not None else {}
+            self._send_json(fault['status'], {"code": "injected_fault", "message": "Injected by stub"}, headers)
+            return
+
+        if self.path == '/oauth/v2/token':
+            stub.count('tokens')
+            self._send_json(200, {
+                "access_token": f"stub-token-{uuid.uuid4().hex[:12]}",
+                "expires_in": 2592000,
+                "token_type": "Bearer"
+            })
+        elif QUOTES_PATH.match(self.path):
+            stub.count('quotes')
+            self._send_json(200, stub.make_quote())
+        elif DELIVERIES_PATH.match(self.path):
+            stub.count('deliveries')
+            payload = json.loads(body or b'{}')
+            delivery = stub.make_delivery(payload)
+            if fault and fault.get('disconnect'):
+                # The delivery is booked but the client never sees the answer
+                stub.count('faults')
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            self._send_json(200, delivery)
+        else:
+            self._send_json(404, {"code": "not_found", "message": f"No route for {self.path}"})
+
+
+class UberDirectStub:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 jitter: float = 0.0, error_rate: float = 0.0,
+                 rate_limit: Optional[float] = None, rate_burst: int = 10):
+        """
+        Local stand-in for the Uber Direct auth, quote and delivery endpoints
+
+        Args:
+            host: Interface to bind
+            port: Port to bind (0 picks a free port)
+            latency: Seconds to sleep before answering each request
+            jitter: Extra random latency, up to this many seconds
+            error_rate: Fraction of quote/delivery requests answered with a 5xx
+            rate_limit: Quote/delivery requests per second before answering 429
+            rate_burst: Requests allowed back to back under rate_limit
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self._allowance = float(rate_burst)
+        self._allowance_updated = time.monotonic()
+        self.stats = {}
+        self.faults = {}
+        self.bookings = {}
+        self._stats_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _StubHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def auth_url(self) -> str:
+        return f"{self.url}/oauth/v2/token"
+
+    def count(self, name: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def response_delay(self) -> float:
+        return self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def check_rate_limit(self) -> Optional[int]:
+        """
+        Take one request from the server-side allowance
+
+        Returns:
+            int: Retry-After seconds if the request is over the limit, else None
+        """
+        if not self.rate_limit:
+            return None
+
+        with self._stats_lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate_burst, self._allowance + (now - self._allowance_updated) * self.rate_limit)
+            self._allowance_updated = now
+
+            if self._allowance >= 1:
+                self._allowance -= 1
+                return None
+            return max(1, math.ceil((1 - self._allowance) / self.rate_limit))
+
+    def inject(self, route: str, status: Optional[int] = None, count: int = 1,
+               retry_after: Optional[float] = None, disconnect: bool = False):
+        """
+        Make the next requests to a route fail
+
+        Args:
+            route: token, quotes or deliveries
+            status: HTTP status to answer with instead of handling the request
+            count: Number of requests to fail
+            retry_after: Retry-After header to send with the status
+            disconnect: Book the delivery, then drop the connection unanswered
+        """
+        with self._stats_lock:
+            self.faults.setdefault(route, []).extend(
+                [{"status": status, "retry_after": retry_after, "disconnect": disconnect}] * count
+            )
+
+    def next_fault(self, route: str) -> Optional[Dict[str, Any]]:
+        with self._stats_lock:
+            queue = self.faults.get(route)
+            return queue.pop(0) if queue else None
+
+    def make_quote(self) -> Dict[str, Any]:
+        now = datetime.utcnow()
+        return {
+            "id": f"dqt_{uuid.uuid4().hex[:20]}",
+            "fee": 599,
+            "currency": "usd",
+            "currency_type": "USD",
+            "created": now.isoformat() + "Z",
+            "expires": (now + timedelta(minutes=15)).isoformat() + "Z",
+            "dropoff_eta": (now + timedelta(minutes=35)).isoformat() + "Z",
+            "duration": 35,
+            "pickup_duration": 10
+        }
+
+    def make_delivery(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        # Like the real API, a repeated idempotency key returns the original
+        # delivery rather than booking another courier
+        key = payload.get("idempotency_key")
+        with self._stats_lock:
+            if key and key in self.bookings:
+                self.stats['replayed'] = self.stats.get('replayed', 0) + 1
+                return self.bookings[key]
+
+        delivery_id = f"del_{uuid.uuid4().hex[:20]}"
+        delivery = {
+            "id": delivery_id,
+            "quote_id": payload.get("quote_id"),
+            "external_id": payload.get("external_id"),
+            "status": "pending",
+            "fee": 599,
+            "currency": "usd",
+            "tracking_url": f"{self.url}/track/{delivery_id}"
+        }
+
+        with self._stats_lock:
+            self.stats['booked'] = self.stats.get('booked', 0) + 1
+            if key:
+                self.bookings[key] = delivery
+        return delivery
+
+    def start(self) -> 'UberDirectStub':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='uber-direct-stub', daemon=True)
+        self._thread.start()
+        logger.info(f"Uber Direct stub listening on {self.url}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local Uber Direct stand-in")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Extra random latency, up to this many seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of quote/delivery requests failing with 5xx")
+    parser.add_argument('--rate-limit', type=float, default=None, help="Quote/delivery requests per second before 429s")
+    parser.add_argument('--rate-burst', type=int, default=10)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    stub = UberDirectStub(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        rate_burst=args.rate_burst
+    )
+
+    print("Point the app at the stub with:")
+    print(f"  export UBER_AUTH_URL={stub.auth_url}")
+    print(f"  export UBER_API_BASE_URL={stub.url}")
+
+    try:
+        stub._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub._server.server_close()
+        print(f"Stats: {stub.stats}")
+
+
+if __name__ == '__main__':
+    main()
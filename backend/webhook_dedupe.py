@@ -0,0 +1,200 @@
+import functools
+import sqlite3
+import threading
+import time
+import logging
+from typing import Any, Dict, Optional
+
+from flask import Response, make_response, request
+
+from sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+# Empty TwiML: acknowledges the message without replying
+EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+
+
+class WebhookDedupe(SqliteStore):
+    SCHEMA = (
+        '''
+            CREATE TABLE IF NOT EXISTS webhook_replies (
+                message_sid TEXT PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'processing',
+                status_code INTEGER,
+                mimetype TEXT,
+                body TEXT,
+                created_at REAL NOT NULL,
+                completed_at REAL
+            )
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS idx_webhook_replies_created_at
+            ON webhook_replies (created_at)
+        ''',
+    )
+
+    def __init__(self, db_path: str, key_param: str = 'MessageSid', ttl: float = 3600.0,
+                 wait: float = 10.0, stale_after: float = 60.0, poll_interval: float = 0.1,
+                 purge_every: int = 100):
+        """
+        Replays the stored response when Twilio retries a webhook
+
+        Twilio retries a webhook that times out with the same MessageSid. The
+        first delivery claims the SID in the webhook_replies table and stores
+        its response; retries get that response back instead of running the
+        handler again. A retry that arrives while the first delivery is still
+        running waits up to `wait` seconds for its result.
+
+        Args:
+            db_path: Path to the SQLite database
+            key_param: Request value identifying a delivery
+            ttl: Seconds a stored response is kept
+            wait: Longest a retry waits for the first delivery to finish
+            stale_after: Seconds before a claim from a crashed worker is released
+            poll_interval: Seconds between checks while waiting
+            purge_every: Expired rows are deleted once per this many requests
+        """
+        self.db_path = db_path
+        self.key_param = key_param
+        self.ttl = ttl
+        self.wait = wait
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.purge_every = purge_every
+        self.stats = {"handled": 0, "replayed": 0, "waited": 0, "in_flight": 0, "unkeyed": 0}
+        self._requests = 0
+        self._lock = threading.Lock()
+
+        self._init_table()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _claim(self, key: str) -> bool:
+        """Claim a delivery; False if another request already has it"""
+        now = time.time()
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute(
+            "INSERT OR IGNORE INTO webhook_replies (message_sid, created_at) VALUES (?, ?)",
+            (key, now)
+        )
+        claimed = c.rowcount == 1
+        if not claimed:
+            # Take over a claim left behind by a worker that died mid-request
+            c.execute(
+                "UPDATE webhook_replies SET created_at = ? WHERE message_sid = ? AND status = 'processing' AND created_at < ?",
+                (now, key, now - self.stale_after)
+            )
+            claimed = c.rowcount == 1
+        conn.commit()
+        conn.close()
+        return claimed
+
+    def _stored(self, key: str) -> Optional[sqlite3.Row]:
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        row = conn.execute(
+            "SELECT status, status_code, mimetype, body FROM webhook_replies WHERE message_sid = ?",
+            (key,)
+        ).fetchone()
+        conn.close()
+        return row
+
+    def _store(self, key: str, response: Response):
+        conn = self._connect()
+        conn.execute(
+            "UPDATE webhook_replies SET status = 'done', status_code = ?, mimetype = ?, body = ?, completed_at = ? "
+            "WHERE message_sid = ?",
+            (response.status_code, response.mimetype, response.get_data(as_text=True), time.time(), key)
+        )
+        conn.commit()
+        conn.close()
+
+    def _release(self, key: str):
+        """Forget a claim so Twilio's retry runs the handler again"""
+        conn = self._connect()
+        conn.execute("DELETE FROM webhook_replies WHERE message_sid = ? AND status = 'processing'", (key,))
+        conn.commit()
+        conn.close()
+
+    def _purge(self):
+        conn = self._connect()
+        conn.execute("DELETE FROM webhook_replies WHERE created_at < ?", (time.time() - self.ttl,))
+        conn.commit()
+        conn.close()
+
+    def _replay(self, key: str) -> Optional[Response]:
+        """
+        Response for a delivery another request has claimed
+
+        Returns:
+            Response: The stored or an empty response, or None if the claim
+            was released and the handler should run
+        """
+        deadline = time.monotonic() + self.wait
+        waited = False
+
+        while True:
+            row = self._stored(key)
+            if row is None:
+                # The first delivery failed and released its claim
+                return None
+            if row['status'] == 'done':
+                self._count('waited' if waited else 'replayed')
+                logger.info(f"Replaying stored response for retried webhook {key}")
+                return Response(row['body'], status=row['status_code'], mimetype=row['mimetype'])
+            if time.monotonic() >= deadline:
+                break
+            waited = True
+            time.sleep(self.poll_interval)
+
+        # Still running: acknowledge without a reply so Twilio stops
+        # retrying; the first delivery does the work
+        self._count('in_flight')
+        logger.warning(f"Webhook {key} retried while still in progress; acknowledging without a reply")
+        return Response(EMPTY_TWIML, mimetype='text/xml')
+
+    def deduplicate(self, view):
+        """Decorator for a Twilio webhook view"""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.values.get(self.key_param)
+            if not key:
+                self._count('unkeyed')
+                return view(*args, **kwargs)
+
+            with self._lock:
+                self._requests += 1
+                purge = self._requests % self.purge_every == 0
+            if purge:
+                try:
+                    self._purge()
+                except Exception as e:
+                    logger.error(f"Error purging stored webhook responses: {e}")
+
+            if not self._claim(key):
+                replay = self._replay(key)
+                if replay is not None or not self._claim(key):
+                    return replay or Response(EMPTY_TWIML, mimetype='text/xml')
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                self._release(key)
+                raise
+
+            if 200 <= response.status_code < 300:
+                self._store(key, response)
+            else:
+                self._release(key)
+            self._count('handled')
+            return response
+
+        return wrapper
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.stats)